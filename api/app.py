@@ -1,89 +1,180 @@
 import asyncio
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import RedirectResponse
+import time
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer
-import requests
+import httpx
 
 from utils import *
 
+# Upper bound on concurrent Gmail requests shared by all endpoints
+GMAIL_MAX_CONCURRENCY = 10
+# Upper bound on the number of pages a single /emails/stream request follows
+MAX_STREAM_PAGES = 10000
+# Stage timings and counters served at /metrics; when disabled nothing is recorded
+METRICS_ENABLED = True
+# JSON lines file receiving one trace record per labeled email, None to disable
+TRACE_LOG_PATH = None
+# Seconds a user's label list is reused before Gmail is asked again; creating a label drops it
+LABELS_CACHE_TTL = 300
+# Seconds /token waits for the login it was asked about to come back from Google
+TOKEN_WAIT_TIMEOUT = 300
+# Model labeling jobs use unless they ask for another one
+DEFAULT_MODEL = "llama3.2:1b"
+# Load DEFAULT_MODEL on the ollama server when the API starts, so the first job does not wait for it
+WARM_UP_ON_START = True
+
+class RecordResponse(JSONResponse):
+    """
+        JSON response holding email_agent records (Email, Label), encoded in one pass by
+        email_agent.dumps. Handlers return it directly so FastAPI's jsonable_encoder does
+        not first copy every record into a dict
+    """
+    def render(self, content):
+        return load_email_agent().dumps(content)
+
 class DataManager:
-    def __init__(self):
-        self.__google_flow = AuthFlowGoogle()
+    def __init__(self, gmail_transport: httpx.AsyncBaseTransport = None, gmail_quota_per_second: float = USER_QUOTA_PER_SECOND, session_store: SessionStore = None):
+        """
+            gmail_transport replaces the network for every Gmail call, e.g. with a stand-in server.
+            session_store keeps pending logins, in memory unless another store is given
+        """
         self.__token_manager_api = JWTManager()
+        self.__sessions = SessionManager(AuthFlowGoogle(), self.__token_manager_api, session_store)
+        self.__metrics = load_email_agent().Metrics(TRACE_LOG_PATH) if METRICS_ENABLED else None
+        self.__gmail_api = GmailAPI(
+            max_concurrency=GMAIL_MAX_CONCURRENCY,
+            transport=gmail_transport,
+            quota_per_second=gmail_quota_per_second,
+            metrics=self.__metrics,
+            labels_ttl=LABELS_CACHE_TTL
+        )
+        self.__job_manager = JobManager(self.__gmail_api, metrics=self.__metrics)
 
     @property
-    def google_flow(self):
-        return self.__google_flow
+    def sessions(self):
+        return self.__sessions
     @property
     def token_manager_api(self):
         return self.__token_manager_api
+    @property
+    def gmail_api(self):
+        return self.__gmail_api
+    @property
+    def job_manager(self):
+        return self.__job_manager
+    @property
+    def metrics(self):
+        return self.__metrics
 
 
-app = FastAPI()
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl='token')
 data_store = DataManager()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if WARM_UP_ON_START:
+        data_store.job_manager.warm_up(DEFAULT_MODEL)
+    yield
+    await data_store.gmail_api.aclose()
+    if data_store.metrics is not None:
+        data_store.metrics.close()
+
+app = FastAPI(lifespan=lifespan)
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl='token')
+
+if METRICS_ENABLED:
+    @app.middleware("http")
+    async def time_requests(request: Request, call_next):
+        started = time.perf_counter()
+        response = await call_next(request)
+        # Label by route template so per-message paths share one series
+        route = request.scope.get("route")
+        data_store.metrics.observe(
+            "http_request_seconds",
+            time.perf_counter() - started,
+            route=route.path if route is not None else "unmatched",
+            method=request.method,
+            status=response.status_code
+        )
+        return response
+
+@app.get("/metrics")
+async def get_metrics():
+    if data_store.metrics is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled")
+    return PlainTextResponse(data_store.metrics.render(), media_type="text/plain; version=0.0.4")
+
+async def get_gmail(token: str = Depends(oauth2_scheme)):
+    """
+        Resolves the API token to the caller's Google access token, reusing recent
+        verifications, and returns a Gmail client bound to it
+    """
+    try:
+        payload = data_store.token_manager_api.verify_jwt_token_cached(token)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=f"Invalid API token: {str(e)}"
+        )
+    if not payload.get("sub"):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="API token has no user, please log in again"
+        )
+    return GmailUserClient(data_store.gmail_api, payload.get("access_token"), payload["sub"])
+
 @app.get("/")
-def close_tab():
+async def close_tab():
     return {'command': "You may now close this tab as authentication is complete"}
 
-@app.get("/auth/login")
-def login():
-    flow = data_store.google_flow.flow
-    auth_url, _ = flow.authorization_url(
-        access_type="offline",
-        prompt="consent",
-        include_granted_scopes="false"
-    )
-    return RedirectResponse(auth_url)
+@app.post("/auth/login")
+async def login():
+    """
+        Starts a login. Open login_url in a browser, then redeem the API token with
+        GET /token?session_id=...
+    """
+    session_id, auth_url = data_store.sessions.start()
+    return {"session_id": session_id, "login_url": auth_url}
 
 @app.get('/auth/callback')
-def callback(code: str):
-    flow = data_store.google_flow.flow
-    flow.fetch_token(code=code)
-    creds = flow.credentials
-    data_store.token_manager_api.create_jwt_token({'access_token': creds.token})
+async def callback(code: str, state: str):
+    flow = data_store.sessions.create_flow(state)
+    if flow is None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unknown or expired login")
+    try:
+        # Exchanging the code is a blocking request
+        await asyncio.to_thread(flow.fetch_token, code=code)
+        access_token = flow.credentials.token
+        profile = await data_store.gmail_api.get_profile(access_token)
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Google login failed: {str(e)}"
+        )
+    data_store.sessions.complete(state, profile["emailAddress"], access_token)
     return RedirectResponse('http://localhost:8000/')
 
 @app.get("/token")
-async def get_api_token():
-    if not data_store.token_manager_api.token:
-        try:
-            await asyncio.wait_for(
-                data_store.token_manager_api.token_event.wait(),
-                timeout=300
-            )
-        except asyncio.TimeoutError:
-            raise HTTPException(status_code=408, detail="Token not available yet")
-
-    return {"api_token": data_store.token_manager_api.token}
+async def get_api_token(session_id: str):
+    try:
+        api_token = await data_store.sessions.wait_for_token(session_id, TOKEN_WAIT_TIMEOUT)
+    except KeyError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Unknown or expired login")
+    except TimeoutError:
+        raise HTTPException(status_code=408, detail="Token not available yet")
+    return {"api_token": api_token}
 
 @app.get("/labels")
-def get_labels(token: str = Depends(oauth2_scheme)):
+async def get_labels(gmail: GmailUserClient = Depends(get_gmail)):
     try:
-        payload = data_store.token_manager_api.verify_jwt_token(token)
-        google_token = payload.get('access_token')
-        headers = {"Authorization": f"Bearer {google_token}"}
-
-        resp = requests.get(
-            'https://gmail.googleapis.com/gmail/v1/users/me/labels',
-            headers=headers
-        )
-        resp.raise_for_status()
-        labels = resp.json().get('labels')
-        return { 
-            'labels_user': [
-                {'id': label['id'], 'name': label['name']} 
-                for label in labels 
-                if label.get('type') and label['type'] == 'user'
-            ],
-            'labels_system': [
-                {'id': label['id'], 'name': label['name']}
-                for label in labels 
-                if label.get('type') and label['type'] == 'system'
-            ]
-        }
-    except requests.HTTPError as e:
+        labels = await gmail.list_labels()
+        records = [load_email_agent().Label.from_dict(label) for label in labels]
+        return RecordResponse({
+            'labels_user': [label for label in records if label.type == 'user'],
+            'labels_system': [label for label in records if label.type == 'system']
+        })
+    except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
             detail=f"Gmail API error: {e.response.text}"
@@ -95,30 +186,14 @@ def get_labels(token: str = Depends(oauth2_scheme)):
         )
     
 @app.post("/labels")
-def create_label(new_label_name: str, token: str = Depends(oauth2_scheme)):
+async def create_label(new_label_name: str, gmail: GmailUserClient = Depends(get_gmail)):
     try:
-        payload = data_store.token_manager_api.verify_jwt_token(token)
-        google_token = payload.get("access_token")
-        headers = {
-            "Authorization": f"Bearer {google_token}",
-            "Content-Type": "application/json"
-        }
-        response = requests.post(
-            "https://gmail.googleapis.com/gmail/v1/users/me/labels",
-            headers=headers,
-            json={
-                "name": new_label_name,
-                "labelListVisibility": "labelShow",
-                "messageListVisibility": "show"
-            }
-        )
-        response.raise_for_status()
-        label_info = response.json()
+        label_info = await gmail.create_label(new_label_name)
         return {
             "labelId": label_info.get("id"),
             "name": label_info.get("name")
         }
-    except requests.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
             detail=f"Gmail API error: {e.response.text}"
@@ -130,74 +205,37 @@ def create_label(new_label_name: str, token: str = Depends(oauth2_scheme)):
         )
 
 @app.get("/emails")
-def get_emails(PageToken:str = 'false', token: str = Depends(oauth2_scheme)):
-    chunk_size = 10
+async def get_emails(
+    PageToken:str = 'false',
+    page_size: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    attachments: bool = True,
+    q: str = None,
+    gmail: GmailUserClient = Depends(get_gmail)
+):
+    """
+        q is a Gmail search query, e.g. "after:2024/01/01 before:2024/02/01"
+    """
     try:
-        # Decode API token to get Google OAuth access token
-        payload = data_store.token_manager_api.verify_jwt_token(token)
-        google_token = payload.get("access_token")
-        headers = {"Authorization": f"Bearer {google_token}"}
-
         parameters = {
             "includeSpamTrash": False, 
-            "maxResults": chunk_size,
+            "maxResults": page_size,
         }
         if PageToken != 'false':
-            parameters['nextPageToken'] = PageToken
-        resp = requests.get(
-            "https://gmail.googleapis.com/gmail/v1/users/me/messages",
-            headers=headers,
-            params=parameters
-        )
-        resp.raise_for_status()
-        messages = resp.json().get("messages", [])
-        next_page_token = resp.json().get("nextPageToken", None)
-
-        results = []
-
-        # Step 2: For each message, fetch full details
-        for msg in messages:
-            msg_id = msg["id"]
-            detail_resp = requests.get(
-                f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{msg_id}",
-                headers=headers
-            )
-            detail_resp.raise_for_status()
-            detail = detail_resp.json()
-
-            snipet = detail.get("snipet", "")
-            payload = detail.get("payload", {})
-            headers_list = payload.get("headers", [])
-
-            subject = next((h["value"] for h in headers_list if h["name"] == "Subject"), "No Subject")
-            from_ = next((h["value"] for h in headers_list if h["name"] == "From"), "Unknown Sender")
-            date_ = next((h["value"] for h in headers_list if h["name"] == "Date"), "Unknown Date")
-
-            labels = detail.get("labelIds", [])
-
-            # Attachments metadata
-            attachments = []
-            if "parts" in payload:
-                for part in payload["parts"]:
-                    if part.get("filename"):
-                        attachments.append({
-                            "filename": part["filename"],
-                            "mimeType": part.get("mimeType"),
-                            "size": part.get("body", {}).get("size")
-                        })
-
-            results.append({
-                "id": msg_id,
-                "subject": subject,
-                "from": from_,
-                "date": date_,
-                "labels": labels,
-                "snipet": snipet,
-                "attachments": attachments
-            })
-
-        return {"emails": results, "nextPageToken": next_page_token}
-    except requests.HTTPError as e:
+            parameters['pageToken'] = PageToken
+        if q:
+            parameters['q'] = q
+        page = await gmail.list_messages(parameters)
+        messages = page.get("messages", [])
+        next_page_token = page.get("nextPageToken", None)
+
+        # Step 2: Fetch full details for the whole page through the batch endpoint
+        details = await gmail.batch_get_messages(
+            [msg["id"] for msg in messages], attachments
+        )
+        results = [parse_message(detail) for detail in details]
+
+        return RecordResponse({"emails": results, "nextPageToken": next_page_token})
+    except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
             detail=f"Gmail API error: {e.response.text}"
@@ -209,28 +247,118 @@ def get_emails(PageToken:str = 'false', token: str = Depends(oauth2_scheme)):
         )
     
 
-@app.post("/emails/{msg_id}/label")
-def assign_label(msg_id: str, label_id: str, token: str = Depends(oauth2_scheme)):
+@app.get("/profile")
+async def get_profile(gmail: GmailUserClient = Depends(get_gmail)):
     try:
-        # Decode API token to get Google OAuth access token
-        payload = data_store.token_manager_api.verify_jwt_token(token)
-        google_token = payload.get("access_token")
-        headers = {"Authorization": f"Bearer {google_token}"}
-
-        # Step 1: Call Gmail API to modify message
-        body = {
-            "addLabelIds": [label_id]
+        profile = await gmail.get_profile()
+        return {
+            "emailAddress": profile.get("emailAddress"),
+            "historyId": profile.get("historyId")
         }
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=e.response.status_code,
+            detail=f"Gmail API error: {e.response.text}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Unexpected error: {str(e)}"
+        )
+
+@app.get("/emails/changes")
+async def get_email_changes(since: str, gmail: GmailUserClient = Depends(get_gmail)):
+    """
+        Returns the emails added since history ID `since` and the history ID to resume from.
+        When `since` is too old for Gmail to serve, fullSyncRequired is set and the
+        returned historyId is the mailbox's current one
+    """
+    try:
+        try:
+            msg_ids, history_id = await gmail.list_history(since)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            profile = await gmail.get_profile()
+            return {"emails": [], "historyId": profile.get("historyId"), "fullSyncRequired": True}
 
-        resp = requests.post(
-            f"https://gmail.googleapis.com/gmail/v1/users/me/messages/{msg_id}/modify",
-            headers=headers,
-            json=body
+        details = await gmail.batch_get_messages(msg_ids)
+        return RecordResponse({
+            "emails": [parse_message(detail) for detail in details],
+            "historyId": history_id,
+            "fullSyncRequired": False
+        })
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=e.response.status_code,
+            detail=f"Gmail API error: {e.response.text}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Unexpected error: {str(e)}"
         )
-        resp.raise_for_status()
 
-        return resp.json()
-    except requests.HTTPError as e:
+@app.get("/emails/stream")
+async def stream_emails(
+    pages: int = 1,
+    PageToken: str = 'false',
+    page_size: int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    attachments: bool = True,
+    q: str = None,
+    gmail: GmailUserClient = Depends(get_gmail)
+):
+    """
+        Streams email records as NDJSON while following page tokens server-side.
+        q restricts the listing to a Gmail search query.
+        If pages run out before the mailbox does, the last line is {"nextPageToken": ...};
+        a failure after the stream has started is reported as a final {"error": ...} line
+    """
+    def list_page(page_token):
+        parameters = {
+            "includeSpamTrash": False,
+            "maxResults": page_size,
+        }
+        if page_token:
+            parameters['pageToken'] = page_token
+        if q:
+            parameters['q'] = q
+        return asyncio.ensure_future(gmail.list_messages(parameters))
+
+    dumps = load_email_agent().dumps
+
+    async def records():
+        remaining = min(pages, MAX_STREAM_PAGES)
+        listing = list_page(PageToken if PageToken != 'false' else None)
+        next_page_token = None
+        try:
+            while listing:
+                page = await listing
+                next_page_token = page.get("nextPageToken")
+                remaining -= 1
+                # List the next page while this page's details are being fetched
+                listing = list_page(next_page_token) if next_page_token and remaining > 0 else None
+                msg_ids = [msg["id"] for msg in page.get("messages", [])]
+                async for detail in gmail.iter_messages(msg_ids, attachments):
+                    yield dumps(parse_message(detail)) + b"\n"
+            if next_page_token:
+                yield dumps({"nextPageToken": next_page_token}) + b"\n"
+        except httpx.HTTPStatusError as e:
+            yield dumps({"error": f"Gmail API error: {e.response.text}", "status_code": e.response.status_code}) + b"\n"
+        except Exception as e:
+            yield dumps({"error": f"Unexpected error: {str(e)}", "status_code": 500}) + b"\n"
+        finally:
+            if listing:
+                listing.cancel()
+
+    return StreamingResponse(records(), media_type="application/x-ndjson")
+
+
+@app.post("/emails/{msg_id}/label")
+async def assign_label(msg_id: str, label_id: str, gmail: GmailUserClient = Depends(get_gmail)):
+    try:
+        return await gmail.modify_message(msg_id, [label_id])
+    except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
             detail=f"Gmail API error: {e.response.text}"
@@ -240,3 +368,109 @@ def assign_label(msg_id: str, label_id: str, token: str = Depends(oauth2_scheme)
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Unexpected error: {str(e)}"
         )
+
+@app.post("/emails/labels:batch")
+async def assign_labels_bulk(assignments: dict[str, list[str]], gmail: GmailUserClient = Depends(get_gmail)):
+    """
+        Body maps label IDs to the message IDs that should receive them,
+        e.g. {"Label_1": ["msg_a", "msg_b"]}. Each label is applied with batchModify
+    """
+    try:
+        await asyncio.gather(*(
+            gmail.batch_modify(msg_ids, [label_id])
+            for label_id, msg_ids in assignments.items()
+            if msg_ids
+        ))
+        return {"applied": {label_id: len(msg_ids) for label_id, msg_ids in assignments.items()}}
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=e.response.status_code,
+            detail=f"Gmail API error: {e.response.text}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Unexpected error: {str(e)}"
+        )
+
+@app.post("/threads/labels:batch")
+async def assign_thread_labels_bulk(assignments: dict[str, list[str]], gmail: GmailUserClient = Depends(get_gmail)):
+    """
+        Body maps label IDs to the thread IDs whose messages should all receive them,
+        e.g. {"Label_1": ["thread_a"]}. Threads are modified through Gmail's batch endpoint;
+        threads deleted in the meantime are left out of the returned counts. A thread that
+        already has a user label keeps it: that label is added to its other messages instead,
+        and the thread is listed in "kept" with the label it kept
+    """
+    try:
+        user_label_ids = {label["id"] for label in await gmail.list_labels() if label.get("type") == "user"}
+        labeled = await asyncio.gather(*(
+            gmail.batch_modify_threads(thread_ids, [label_id], user_label_ids)
+            for label_id, thread_ids in assignments.items()
+        ))
+        kept = {
+            thread_id: label_ids[0]
+            for label_id, threads in zip(assignments, labeled)
+            for thread_id, label_ids in threads.items()
+            if label_ids != [label_id]
+        }
+        return {
+            "applied": {
+                label_id: sum(label_ids == [label_id] for label_ids in threads.values())
+                for label_id, threads in zip(assignments, labeled)
+            },
+            "kept": kept
+        }
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(
+            status_code=e.response.status_code,
+            detail=f"Gmail API error: {e.response.text}"
+        )
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Unexpected error: {str(e)}"
+        )
+
+@app.post("/models/warmup")
+async def warm_up_model(model: str = DEFAULT_MODEL, gmail: GmailUserClient = Depends(get_gmail)):
+    """
+        Starts loading model on the ollama server and returns right away; call again to
+        see whether it is "warming", "ready" or "failed"
+    """
+    return data_store.job_manager.warm_up(model)
+
+@app.post("/jobs/label")
+async def start_label_job(
+    pages: int = 1,
+    page_size: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    model: str = DEFAULT_MODEL,
+    concurrency: int = 2,
+    by_thread: bool = False,
+    gmail: GmailUserClient = Depends(get_gmail)
+):
+    """
+        Starts a background labeling job over the first `pages` pages of the mailbox.
+        `concurrency` is the number of model batches in flight against the ollama server.
+        With by_thread, each thread is classified once and labeled as a whole
+    """
+    job = data_store.job_manager.start(gmail.google_token, gmail.user_id, pages, page_size, model, concurrency, by_thread)
+    return job.to_dict()
+
+@app.get("/jobs")
+async def list_jobs(gmail: GmailUserClient = Depends(get_gmail)):
+    return {"jobs": [job.to_dict() for job in data_store.job_manager.list(gmail.user_id)]}
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, gmail: GmailUserClient = Depends(get_gmail)):
+    job = data_store.job_manager.get(job_id, gmail.user_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job.to_dict()
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str, gmail: GmailUserClient = Depends(get_gmail)):
+    job = data_store.job_manager.cancel(job_id, gmail.user_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job.to_dict()
@@ -1,3 +1,8 @@
 from .credentials_manager import SecretManager, SecretName
 from .auth import AuthFlowGoogle
 from .jwt import JWTManager
+from .gmail import GmailAPI, GmailUserClient, MAX_PAGE_SIZE, parse_message
+from .jobs import JobManager, JobStatus
+from .loader import load_email_agent
+from .ratelimit import RetryPolicy, USER_QUOTA_PER_SECOND
+from .sessions import Session, SessionManager, SessionStore
@@ -4,35 +4,43 @@ from .credentials_manager import SecretManager, SecretName
 class AuthFlowGoogle:
     def __init__(self):
         """
-            args define the additional scopes allowed within the authentication process
+            Builds a separate OAuth flow for every login, so concurrent logins never share
+            state or PKCE verifiers
         """
         google_secrets = SecretManager.get_secret(SecretName.GOOGLE)
         self.__redirect_uri = google_secrets['client_redirect_uri']
-        self.__flow = Flow.from_client_config(
-            {
-                'web': {
-                    'client_id': google_secrets['client_id'],
-                    'client_secret': google_secrets['client_secret'],
-                    'auth_uri': "https://accounts.google.com/o/oauth2/auth",
-                    'token_uri': "https://oauth2.googleapis.com/token",
-                }
-            },
-            scopes=[
-                "openid",
-                "https://www.googleapis.com/auth/userinfo.email",
-                "https://www.googleapis.com/auth/userinfo.profile",
-                "https://www.googleapis.com/auth/gmail.modify"
-            ],
-            redirect_uri=google_secrets['client_redirect_uri'],
+        self.__client_config = {
+            'web': {
+                'client_id': google_secrets['client_id'],
+                'client_secret': google_secrets['client_secret'],
+                'auth_uri': "https://accounts.google.com/o/oauth2/auth",
+                'token_uri': "https://oauth2.googleapis.com/token",
+            }
+        }
+        self.__scopes = [
+            "openid",
+            "https://www.googleapis.com/auth/userinfo.email",
+            "https://www.googleapis.com/auth/userinfo.profile",
+            "https://www.googleapis.com/auth/gmail.modify"
+        ]
+
+    def create_flow(self, state: str, code_verifier: str = None):
+        """
+            Flow for the login identified by state; the callback rebuilds it with the
+            code_verifier generated when the authorization URL was made
+        """
+        return Flow.from_client_config(
+            self.__client_config,
+            scopes=self.__scopes,
+            redirect_uri=self.__redirect_uri,
+            state=state,
+            code_verifier=code_verifier
         )
 
     @property
-    def flow(self):
-        return self.__flow
-    @property
     def redirect_uri(self):
         return self.__redirect_uri
     
 if __name__ == '__main__':
     google_auth = AuthFlowGoogle()
-    google_auth.flow
\ No newline at end of file
+    google_auth.create_flow("state")
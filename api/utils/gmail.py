@@ -0,0 +1,579 @@
+import asyncio
+import functools
+import json
+import re
+import time
+import uuid
+from collections import OrderedDict
+from urllib.parse import urlencode
+import httpx
+
+try:
+    import h2  # noqa: F401  (enables HTTP/2 in httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+from .loader import load_email_agent
+from .ratelimit import (
+    QUOTA_UNITS, USER_QUOTA_PER_SECOND, RETRY_STATUSES,
+    AdaptiveConcurrency, RetryPolicy, TokenBucket, is_throttled, retry_after
+)
+
+# Email records are the shared types of the repository-root email_agent package
+email_agent = load_email_agent()
+
+GMAIL_API_BASE = "https://gmail.googleapis.com/gmail/v1/users/me"
+GMAIL_BATCH_URL = "https://gmail.googleapis.com/batch/gmail/v1"
+# Path of the Gmail resources as written inside a multipart batch request
+GMAIL_BATCH_PATH = "/gmail/v1/users/me"
+# Gmail accepts up to 100 calls per batch but recommends no more than 50
+BATCH_MAX_REQUESTS = 50
+# users.messages.batchModify accepts at most 1000 message IDs per call
+MODIFY_MAX_IDS = 1000
+# Messages with these labels are ignored by incremental sync, matching includeSpamTrash=False
+SKIPPED_LABELS = frozenset({"SPAM", "TRASH", "DRAFT"})
+# Upper bound Gmail accepts for maxResults on users.messages.list
+MAX_PAGE_SIZE = 500
+
+# users.messages.list only needs to return the IDs and paging information
+LIST_FIELDS = "messages/id,nextPageToken,resultSizeEstimate"
+# Message reads skip MIME bodies entirely and only return the fields parse_message uses
+METADATA_PARAMS = {
+    "format": "metadata",
+    "metadataHeaders": ["Subject", "From", "Date"],
+    "fields": "id,threadId,labelIds,snippet,historyId,payload(mimeType,headers)"
+}
+# Second, masked read used only for messages that can carry attachments;
+# part bodies are reduced to their size so no attachment or HTML data is transferred
+ATTACHMENT_PARAMS = {
+    "format": "full",
+    "fields": "id,payload(parts(filename,mimeType,body/size))"
+}
+# Thread read made before a thread-level modify: only the label IDs of its messages
+THREAD_LABELS_PARAMS = {
+    "format": "minimal",
+    "fields": "id,messages/labelIds"
+}
+# Top-level MIME types under which Gmail nests attachment parts
+ATTACHMENT_MIME_TYPES = frozenset({"multipart/mixed", "multipart/related", "multipart/report"})
+# Quota buckets and label caches are kept for this many most recently seen access tokens
+MAX_TRACKED_USERS = 1024
+# Seconds a user's label list is served from memory; creating a label drops it right away
+LABELS_CACHE_TTL = 300
+
+class GmailAPI:
+    def __init__(self, max_concurrency: int = 10, timeout: float = 30.0, transport: httpx.AsyncBaseTransport = None, batch_size: int = BATCH_MAX_REQUESTS, quota_per_second: float = USER_QUOTA_PER_SECOND, retry_policy: RetryPolicy = None, metrics=None, labels_ttl: float = LABELS_CACHE_TTL):
+        """
+            Shared, pooled async client for the Gmail REST API. Connections are kept alive
+            and, when the h2 package is installed, multiplexed over HTTP/2.
+            max_concurrency caps the number of in-flight requests across all callers;
+            the actual limit adapts (AIMD) and is halved whenever Gmail throttles us.
+            Each user's calls are paced by a token bucket of quota_per_second quota units,
+            and throttled or failed calls are retried according to retry_policy.
+            transport can be swapped out to point the client at a stand-in server,
+            batch_size is the number of calls packed into one multipart batch request.
+            metrics (email_agent.Metrics), when given, records latency, status codes,
+            retries and quota units per Gmail method.
+            Each user's label list is cached for labels_ttl seconds (0 disables the cache)
+        """
+        self.__max_concurrency = max_concurrency
+        self.__metrics = metrics
+        self.__batch_size = min(batch_size, BATCH_MAX_REQUESTS)
+        self.__concurrency = AdaptiveConcurrency(max_concurrency)
+        self.__quota_per_second = quota_per_second
+        self.__buckets = OrderedDict()
+        self.__labels_ttl = labels_ttl
+        self.__labels_cache = OrderedDict()
+        self.__retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.__client = httpx.AsyncClient(
+            base_url=GMAIL_API_BASE,
+            timeout=timeout,
+            transport=transport,
+            http2=HTTP2_AVAILABLE,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency
+            )
+        )
+
+    @property
+    def max_concurrency(self):
+        return self.__max_concurrency
+    @property
+    def concurrency_limit(self):
+        return self.__concurrency.limit
+
+    @staticmethod
+    def auth_headers(google_token: str):
+        return {"Authorization": f"Bearer {google_token}"}
+
+    def __bucket(self, google_token: str):
+        bucket = self.__buckets.get(google_token)
+        if bucket is None:
+            bucket = self.__buckets[google_token] = TokenBucket(self.__quota_per_second)
+            if len(self.__buckets) > MAX_TRACKED_USERS:
+                self.__buckets.popitem(last=False)
+        else:
+            self.__buckets.move_to_end(google_token)
+        return bucket
+
+    async def request(self, method: str, url: str, google_token: str, headers: dict = None, call: str = "other", units: int = None, **kwargs):
+        """
+            call names the Gmail method (a QUOTA_UNITS key, or "batch"); units is the number
+            of quota units the call costs and defaults to that method's cost
+        """
+        if units is None:
+            units = QUOTA_UNITS.get(call, 1)
+        if self.__metrics is None:
+            return await self.__send(method, url, google_token, headers, call, units, kwargs)
+        started = time.perf_counter()
+        try:
+            return await self.__send(method, url, google_token, headers, call, units, kwargs)
+        finally:
+            self.__metrics.observe("gmail_request_seconds", time.perf_counter() - started, call=call)
+
+    async def __send(self, method: str, url: str, google_token: str, headers: dict, call: str, units: int, kwargs: dict):
+        attempt = 0
+        while True:
+            await self.__bucket(google_token).acquire(units)
+            if self.__metrics is not None:
+                self.__metrics.inc("gmail_quota_units_total", units, call=call)
+            server_delay = None
+            try:
+                async with self.__concurrency:
+                    resp = await self.__client.request(
+                        method,
+                        url,
+                        headers={**self.auth_headers(google_token), **(headers or {})},
+                        **kwargs
+                    )
+                    if self.__metrics is not None:
+                        self.__metrics.inc("gmail_requests_total", call=call, status=resp.status_code)
+                    throttled = is_throttled(resp)
+                    if throttled or resp.status_code in RETRY_STATUSES:
+                        # 503 is how Gmail sheds load it cannot take, treat it like a 429
+                        if throttled or resp.status_code == 503:
+                            self.__concurrency.backoff()
+                        server_delay = retry_after(resp)
+                    else:
+                        self.__concurrency.success()
+                        resp.raise_for_status()
+                        return resp
+            except httpx.TransportError:
+                if self.__metrics is not None:
+                    self.__metrics.inc("gmail_requests_total", call=call, status="error")
+                if attempt >= self.__retry_policy.max_retries:
+                    raise
+            else:
+                if attempt >= self.__retry_policy.max_retries:
+                    resp.raise_for_status()
+            if self.__metrics is not None:
+                self.__metrics.inc("gmail_retries_total", call=call)
+            await asyncio.sleep(self.__retry_policy.delay(attempt, server_delay))
+            attempt += 1
+
+    async def list_labels(self, google_token: str):
+        entry = self.__labels_cache.get(google_token)
+        if entry is not None and entry[0] > time.monotonic():
+            return list(entry[1])
+        resp = await self.request("GET", "/labels", google_token, call="labels.list")
+        labels = resp.json().get("labels", [])
+        if self.__labels_ttl:
+            self.__labels_cache[google_token] = (time.monotonic() + self.__labels_ttl, labels)
+            self.__labels_cache.move_to_end(google_token)
+            if len(self.__labels_cache) > MAX_TRACKED_USERS:
+                self.__labels_cache.popitem(last=False)
+        return list(labels)
+
+    def invalidate_labels(self, google_token: str):
+        self.__labels_cache.pop(google_token, None)
+
+    async def create_label(self, google_token: str, name: str):
+        """
+            Creates the label, or returns the existing one when Gmail reports that the name
+            is taken (created concurrently, or missed by a stale label list)
+        """
+        try:
+            resp = await self.request(
+                "POST",
+                "/labels",
+                google_token,
+                call="labels.create",
+                json={
+                    "name": name,
+                    "labelListVisibility": "labelShow",
+                    "messageListVisibility": "show"
+                }
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 409:
+                raise
+            self.invalidate_labels(google_token)
+            existing = next(
+                (label for label in await self.list_labels(google_token) if label["name"].casefold() == name.casefold()),
+                None
+            )
+            if existing is None:
+                raise
+            return existing
+        self.invalidate_labels(google_token)
+        return resp.json()
+
+    async def list_messages(self, google_token: str, params: dict):
+        resp = await self.request(
+            "GET", "/messages", google_token,
+            call="messages.list",
+            params={"fields": LIST_FIELDS, **params}
+        )
+        return resp.json()
+
+    async def get_profile(self, google_token: str):
+        resp = await self.request("GET", "/profile", google_token, call="getProfile")
+        return resp.json()
+
+    async def list_history(self, google_token: str, start_history_id: str):
+        """
+            Follows users.history.list from start_history_id and returns
+            (IDs of messages added since then, latest history ID).
+            Gmail answers 404 when start_history_id is too old to be served
+        """
+        params = {
+            "startHistoryId": start_history_id,
+            "historyTypes": "messageAdded",
+            "maxResults": 500
+        }
+        msg_ids = []
+        seen = set()
+        history_id = start_history_id
+        while True:
+            resp = await self.request("GET", "/history", google_token, call="history.list", params=params)
+            data = resp.json()
+            history_id = data.get("historyId", history_id)
+            for record in data.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    msg = added.get("message", {})
+                    if msg.get("id") in seen or SKIPPED_LABELS.intersection(msg.get("labelIds", [])):
+                        continue
+                    seen.add(msg["id"])
+                    msg_ids.append(msg["id"])
+            if not data.get("nextPageToken"):
+                return msg_ids, history_id
+            params["pageToken"] = data["nextPageToken"]
+
+    async def get_message(self, google_token: str, msg_id: str, params: dict = METADATA_PARAMS):
+        resp = await self.request(
+            "GET", f"/messages/{msg_id}", google_token,
+            call="messages.get",
+            params=params
+        )
+        return resp.json()
+
+    async def get_thread(self, google_token: str, thread_id: str, params: dict = THREAD_LABELS_PARAMS):
+        resp = await self.request(
+            "GET", f"/threads/{thread_id}", google_token,
+            call="threads.get",
+            params=params
+        )
+        return resp.json()
+
+    async def get_messages(self, google_token: str, msg_ids: list[str]):
+        # Fetches run concurrently, bounded by the shared concurrency limit; order is preserved
+        return await asyncio.gather(*(
+            self.get_message(google_token, msg_id) for msg_id in msg_ids
+        ))
+
+    def __chunks(self, ids: list[str]):
+        return [
+            ids[i:i + self.__batch_size]
+            for i in range(0, len(ids), self.__batch_size)
+        ]
+
+    async def batch_get_messages(self, google_token: str, msg_ids: list[str], attachments: bool = True):
+        """
+            Fetches message metadata through Gmail's multipart batch endpoint, one HTTP call
+            per batch_size messages. Parts that fail inside a batch are retried one by one.
+            With attachments, multipart messages get a second masked read for their part list
+        """
+        pages = await asyncio.gather(*(
+            self.__fetch_chunk(google_token, chunk, attachments) for chunk in self.__chunks(msg_ids)
+        ))
+        return [detail for page in pages for detail in page]
+
+    async def iter_messages(self, google_token: str, msg_ids: list[str], attachments: bool = True):
+        """
+            Same as batch_get_messages, but yields details as soon as each batch completes
+        """
+        tasks = [
+            asyncio.ensure_future(self.__fetch_chunk(google_token, chunk, attachments))
+            for chunk in self.__chunks(msg_ids)
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                for detail in await next_done:
+                    yield detail
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __fetch_chunk(self, google_token: str, msg_ids: list[str], attachments: bool):
+        details = await self.__batch_get_chunk(google_token, msg_ids, METADATA_PARAMS)
+        if not attachments:
+            return details
+
+        multipart = [
+            detail for detail in details
+            if detail.get("payload", {}).get("mimeType") in ATTACHMENT_MIME_TYPES
+        ]
+        if multipart:
+            parts = await self.__batch_get_chunk(
+                google_token, [detail["id"] for detail in multipart], ATTACHMENT_PARAMS
+            )
+            parts_by_id = {part["id"]: part.get("payload", {}).get("parts", []) for part in parts}
+            for detail in multipart:
+                detail["payload"]["parts"] = parts_by_id.get(detail["id"], [])
+        return details
+
+    async def __batch_get_chunk(self, google_token: str, msg_ids: list[str], params: dict, resource: str = "messages"):
+        # The same multipart read serves threads.get, with thread IDs in msg_ids
+        get = self.get_thread if resource == "threads" else self.get_message
+        if len(msg_ids) == 1:
+            try:
+                return [await get(google_token, msg_ids[0], params)]
+            except httpx.HTTPStatusError as e:
+                # Deleted between listing and fetching
+                if e.response.status_code == 404:
+                    return []
+                raise
+
+        query = urlencode(params, doseq=True)
+        boundary = f"batch_{uuid.uuid4().hex}"
+        body = "".join(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <item{i}>\r\n\r\n"
+            f"GET {GMAIL_BATCH_PATH}/{resource}/{msg_id}?{query} HTTP/1.1\r\n\r\n"
+            for i, msg_id in enumerate(msg_ids)
+        ) + f"--{boundary}--\r\n"
+        resp = await self.request(
+            "POST",
+            GMAIL_BATCH_URL,
+            google_token,
+            call="batch",
+            units=QUOTA_UNITS[f"{resource}.get"] * len(msg_ids),
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+            content=body
+        )
+        parts = parse_batch_response(resp)
+
+        if any(status_code == 429 for status_code, _ in parts.values()):
+            self.__concurrency.backoff()
+
+        results = []
+        for i, msg_id in enumerate(msg_ids):
+            status_code, detail = parts.get(f"item{i}", (None, None))
+            if status_code == 404:
+                # Deleted between listing and fetching
+                continue
+            if status_code != 200:
+                # Retried on its own, which paces and backs off like any other call
+                detail = await get(google_token, msg_id, params)
+            results.append(detail)
+        return results
+
+    async def modify_message(self, google_token: str, msg_id: str, add_label_ids: list[str]):
+        resp = await self.request(
+            "POST",
+            f"/messages/{msg_id}/modify",
+            google_token,
+            call="messages.modify",
+            json={"addLabelIds": add_label_ids}
+        )
+        return resp.json()
+
+    async def batch_modify(self, google_token: str, msg_ids: list[str], add_label_ids: list[str]):
+        chunks = [
+            msg_ids[i:i + MODIFY_MAX_IDS]
+            for i in range(0, len(msg_ids), MODIFY_MAX_IDS)
+        ]
+        await asyncio.gather(*(
+            self.request(
+                "POST",
+                "/messages/batchModify",
+                google_token,
+                call="messages.batchModify",
+                json={"ids": chunk, "addLabelIds": add_label_ids}
+            )
+            for chunk in chunks
+        ))
+
+    async def modify_thread(self, google_token: str, thread_id: str, add_label_ids: list[str]):
+        resp = await self.request(
+            "POST",
+            f"/threads/{thread_id}/modify",
+            google_token,
+            call="threads.modify",
+            json={"addLabelIds": add_label_ids}
+        )
+        return resp.json()
+
+    async def batch_modify_threads(self, google_token: str, thread_ids: list[str], add_label_ids: list[str], keep_label_ids: set = None):
+        """
+            Labels every message of the given threads, including the ones that were never listed.
+            Gmail has no threads.batchModify, so the threads.modify calls are packed into
+            multipart batches of batch_size; parts that fail are retried one by one.
+            With keep_label_ids (the user's label IDs), each thread's labels are read first
+            with a masked threads.get in the same kind of batch, and a thread a message of which
+            already has one of them gets that label on its other messages instead of
+            add_label_ids, so it never ends up with two.
+            Returns {thread ID: label IDs added} for the threads that were labeled
+        """
+        labeled = await asyncio.gather(*(
+            self.__modify_threads_chunk(google_token, chunk, add_label_ids, keep_label_ids)
+            for chunk in self.__chunks(thread_ids)
+        ))
+        return {thread_id: label_ids for chunk in labeled for thread_id, label_ids in chunk.items()}
+
+    async def __modify_threads_chunk(self, google_token: str, thread_ids: list[str], add_label_ids: list[str], keep_label_ids: set):
+        assignments = {thread_id: add_label_ids for thread_id in thread_ids}
+        if keep_label_ids:
+            threads = await self.__batch_get_chunk(google_token, thread_ids, THREAD_LABELS_PARAMS, "threads")
+            # Threads deleted since they were listed are left out
+            assignments = {}
+            for thread in threads:
+                # Gmail returns a thread's messages oldest first, so the earliest label wins
+                kept = next((
+                    label_id
+                    for message in thread.get("messages", [])
+                    for label_id in message.get("labelIds", [])
+                    if label_id in keep_label_ids
+                ), None)
+                assignments[thread["id"]] = [kept] if kept is not None else add_label_ids
+        if not assignments:
+            return {}
+        return await self.__batch_modify_threads_chunk(google_token, assignments)
+
+    async def __batch_modify_threads_chunk(self, google_token: str, assignments: dict[str, list[str]]):
+        if len(assignments) == 1:
+            [(thread_id, label_ids)] = assignments.items()
+            try:
+                await self.modify_thread(google_token, thread_id, label_ids)
+            except httpx.HTTPStatusError as e:
+                # Deleted since it was listed
+                if e.response.status_code == 404:
+                    return {}
+                raise
+            return assignments
+
+        boundary = f"batch_{uuid.uuid4().hex}"
+        body = "".join(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <item{i}>\r\n\r\n"
+            f"POST {GMAIL_BATCH_PATH}/threads/{thread_id}/modify HTTP/1.1\r\n"
+            "Content-Type: application/json\r\n\r\n"
+            f"{json.dumps({'addLabelIds': label_ids})}\r\n"
+            for i, (thread_id, label_ids) in enumerate(assignments.items())
+        ) + f"--{boundary}--\r\n"
+        resp = await self.request(
+            "POST",
+            GMAIL_BATCH_URL,
+            google_token,
+            call="batch",
+            units=QUOTA_UNITS["threads.modify"] * len(assignments),
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"},
+            content=body
+        )
+        parts = parse_batch_response(resp)
+
+        if any(status_code == 429 for status_code, _ in parts.values()):
+            self.__concurrency.backoff()
+
+        labeled = {}
+        for i, (thread_id, label_ids) in enumerate(assignments.items()):
+            status_code, _ = parts.get(f"item{i}", (None, None))
+            if status_code == 404:
+                continue
+            if status_code != 200:
+                await self.modify_thread(google_token, thread_id, label_ids)
+            labeled[thread_id] = label_ids
+        return labeled
+
+    async def aclose(self):
+        await self.__client.aclose()
+
+
+class GmailUserClient:
+    def __init__(self, gmail_api: GmailAPI, google_token: str, user_id: str = None):
+        """
+            GmailAPI bound to one user's Google access token: every GmailAPI method
+            is available here without its google_token argument
+        """
+        self.__gmail_api = gmail_api
+        self.__google_token = google_token
+        self.__user_id = user_id
+
+    @property
+    def google_token(self):
+        return self.__google_token
+    @property
+    def user_id(self):
+        return self.__user_id
+
+    def __getattr__(self, name):
+        return functools.partial(getattr(self.__gmail_api, name), self.__google_token)
+
+
+def parse_batch_response(resp: httpx.Response):
+    """
+        Splits a multipart/mixed batch response into {content_id: (status_code, json_body)}
+    """
+    match = re.search(r'boundary="?([^";]+)"?', resp.headers.get("Content-Type", ""))
+    if not match:
+        return {}
+    boundary = match.group(1)
+
+    results = {}
+    for part in resp.text.replace("\r\n", "\n").split(f"--{boundary}"):
+        part = part.strip()
+        if not part or part == "--":
+            continue
+        outer_headers, _, inner = part.partition("\n\n")
+        content_id = re.search(r"Content-ID:\s*<response-(.+?)>", outer_headers, re.IGNORECASE)
+        status_line, _, inner = inner.partition("\n")
+        _, _, body = inner.partition("\n\n")
+        if not content_id:
+            continue
+        try:
+            status_code = int(status_line.split()[1])
+            detail = json.loads(body) if body.strip() else {}
+        except (IndexError, ValueError):
+            status_code, detail = None, None
+        results[content_id.group(1)] = (status_code, detail)
+    return results
+
+
+def parse_message(detail: dict):
+    """
+        Email record of a users.messages.get resource fetched with METADATA_PARAMS
+    """
+    payload = detail.get("payload", {})
+    headers = {h["name"]: h["value"] for h in payload.get("headers", [])}
+
+    # Attachments metadata
+    attachments = [
+        email_agent.Attachment(part["filename"], part.get("mimeType"), part.get("body", {}).get("size"))
+        for part in payload.get("parts", ())
+        if part.get("filename")
+    ]
+
+    return email_agent.Email(
+        id=detail.get("id"),
+        thread_id=detail.get("threadId"),
+        subject=headers.get("Subject", "No Subject"),
+        sender=headers.get("From", "Unknown Sender"),
+        date=headers.get("Date", "Unknown Date"),
+        labels=detail.get("labelIds", []),
+        snippet=detail.get("snippet", ""),
+        attachments=attachments
+    )
@@ -0,0 +1,348 @@
+import asyncio
+import hashlib
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from pathlib import Path
+
+from .gmail import GmailAPI, parse_message
+from .loader import load_email_agent
+
+# Finished jobs are kept around this long so clients can still read their results
+JOB_RETENTION_SECONDS = 3600
+# Agents kept for reuse by later jobs, one per (owner, model), least recently used dropped first
+MAX_CACHED_AGENTS = 64
+# A model warmed up this recently is taken to still be loaded (the agent keeps it for KEEP_ALIVE)
+WARM_UP_INTERVAL = 600
+
+class JobStatus(Enum):
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+class LabelJob:
+    def __init__(self, owner: str, pages: int, page_size: int, model: str, concurrency: int, by_thread: bool = False):
+        self.id = uuid.uuid4().hex
+        self.owner = owner
+        self.pages = pages
+        self.page_size = page_size
+        self.model = model
+        self.concurrency = concurrency
+        self.by_thread = by_thread
+        self.status = JobStatus.RUNNING
+        self.error = None
+        # Estimated number of emails the job will go through, known after the first page
+        self.total = None
+        self.fetched = 0
+        self.labeled = 0
+        self.skipped = 0
+        self.created = 0
+        # Threads labeled with one thread-level modify, in by_thread mode
+        self.threads = 0
+        # Seconds from the start of the job to its first decided label
+        self.first_label_seconds = None
+        self.started_at = time.time()
+        self.finished_at = None
+        self.task = None
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        done = self.labeled + self.skipped
+        rate = done / elapsed if elapsed > 0 else 0.0
+        # resultSizeEstimate is only an estimate, never report fewer than already done
+        total = max(self.total, done) if self.total is not None else None
+        eta = None
+        if self.status == JobStatus.RUNNING and total is not None and rate > 0:
+            eta = (total - done) / rate
+        return {
+            "id": self.id,
+            "status": self.status.value,
+            "error": self.error,
+            "pages": self.pages,
+            "page_size": self.page_size,
+            "model": self.model,
+            "concurrency": self.concurrency,
+            "by_thread": self.by_thread,
+            "total": total,
+            "fetched": self.fetched,
+            "labeled": self.labeled,
+            "skipped": self.skipped,
+            "created": self.created,
+            "threads": self.threads,
+            "first_label_seconds": self.first_label_seconds,
+            "elapsed_seconds": elapsed,
+            "emails_per_second": rate,
+            "eta_seconds": eta
+        }
+
+
+class JobManager:
+    def __init__(self, gmail_api: GmailAPI, rules_dir: str = "sender_rules", metrics=None):
+        """
+            Owns long-running labeling jobs. Each job runs as an asyncio task on the API's
+            event loop; model calls are pushed to worker threads, at most `concurrency`
+            batches at a time. Each owner (user ID) learns its own sender rules under rules_dir.
+            A by_thread job classifies each thread once and labels it with one thread modify;
+            a thread that already has a user label keeps that label.
+            Agents are shared by the jobs of an owner and model rather than built per job, and
+            warm_up loads a model ahead of the first job.
+            metrics (email_agent.Metrics), when given, times every stage and traces each email
+        """
+        self.__gmail_api = gmail_api
+        self.__metrics = metrics
+        self.__rules_dir = Path(rules_dir)
+        self.__rules = {}
+        self.__agents = OrderedDict()
+        # model → (warm-up task, loop time it started)
+        self.__warm_ups = {}
+        self.__jobs = {}
+
+    def start(self, google_token: str, owner: str, pages: int, page_size: int, model: str, concurrency: int, by_thread: bool = False):
+        self.__prune()
+        job = LabelJob(owner, pages, page_size, model, max(concurrency, 1), by_thread)
+        job.task = asyncio.create_task(self.__run(job, google_token))
+        self.__jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str, owner: str):
+        job = self.__jobs.get(job_id)
+        return job if job is not None and job.owner == owner else None
+
+    def list(self, owner: str):
+        return [job for job in self.__jobs.values() if job.owner == owner]
+
+    def cancel(self, job_id: str, owner: str):
+        job = self.get(job_id, owner)
+        if job is not None and job.status == JobStatus.RUNNING:
+            job.task.cancel()
+        return job
+
+    def warm_up(self, model: str):
+        """
+            Loads model on the ollama server in a worker thread, at most once per
+            WARM_UP_INTERVAL. Returns {"model", "status", "seconds"}: status is "warming",
+            "ready" or "failed"; seconds is how long the load took once it is done
+        """
+        loop = asyncio.get_running_loop()
+        task, started = self.__warm_ups.get(model, (None, None))
+        # A failed warm-up is retried right away, a finished one once the model may have been unloaded
+        if task is None or (task.done() and (self.__failed(task) or loop.time() - started > WARM_UP_INTERVAL)):
+            task = asyncio.ensure_future(asyncio.to_thread(self.__warm_up, load_email_agent().Agent(model=model)))
+            # The outcome is read on the next call; this keeps asyncio from logging it as never retrieved
+            task.add_done_callback(self.__failed)
+            self.__warm_ups[model] = (task, loop.time())
+        if not task.done():
+            return {"model": model, "status": "warming", "seconds": None}
+        if self.__failed(task):
+            return {"model": model, "status": "failed", "seconds": None}
+        return {"model": model, "status": "ready", "seconds": task.result()}
+
+    @staticmethod
+    def __failed(task: asyncio.Task):
+        return task.cancelled() or task.exception() is not None
+
+    def __warm_up(self, agent):
+        started = time.perf_counter()
+        agent.warm_up()
+        seconds = time.perf_counter() - started
+        if self.__metrics is not None:
+            self.__metrics.observe("llm_warmup_seconds", seconds, model=agent.model)
+        return seconds
+
+    def __agent_for(self, owner: str, model: str, email_agent):
+        key = (owner, model)
+        agent = self.__agents.get(key)
+        if agent is None:
+            agent = email_agent.Agent(model=model, rules=self.__rules_for(owner, email_agent), metrics=self.__metrics)
+            self.__agents[key] = agent
+            if len(self.__agents) > MAX_CACHED_AGENTS:
+                self.__agents.popitem(last=False)
+        self.__agents.move_to_end(key)
+        return agent
+
+    def __prune(self):
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        for job_id in [
+            job_id for job_id, job in self.__jobs.items()
+            if job.finished_at is not None and job.finished_at < cutoff
+        ]:
+            del self.__jobs[job_id]
+
+    def __rules_for(self, owner: str, email_agent):
+        rules = self.__rules.get(owner)
+        if rules is None:
+            self.__rules_dir.mkdir(parents=True, exist_ok=True)
+            # Hashed so user IDs (email addresses) never end up in file names
+            name = hashlib.sha256(owner.encode()).hexdigest()[:32]
+            rules = self.__rules[owner] = email_agent.SenderRules(str(self.__rules_dir / f"{name}.json"))
+        return rules
+
+    async def __fetch_page(self, google_token: str, page_size: int, page_token: str):
+        parameters = {
+            "includeSpamTrash": False,
+            "maxResults": page_size,
+        }
+        if page_token:
+            parameters['pageToken'] = page_token
+        started = time.perf_counter()
+        page = await self.__gmail_api.list_messages(google_token, parameters)
+        listed = time.perf_counter()
+        details = await self.__gmail_api.batch_get_messages(
+            google_token, [msg["id"] for msg in page.get("messages", [])]
+        )
+        if self.__metrics is not None:
+            self.__metrics.observe("stage_seconds", listed - started, stage="list")
+            self.__metrics.observe("stage_seconds", time.perf_counter() - listed, stage="fetch")
+        return page, [parse_message(detail) for detail in details]
+
+    async def __run(self, job: LabelJob, google_token: str):
+        next_page = None
+        try:
+            email_agent = load_email_agent()
+            agent = self.__agent_for(job.owner, job.model, email_agent)
+            if job.by_thread:
+                agent = email_agent.ThreadLabeler(agent, self.__metrics)
+            # Threads already sent to Gmail; their later messages need no modify of their own
+            applied_threads = set()
+            metrics = self.__metrics
+            tracing = metrics is not None and metrics.tracing
+
+            labels = email_agent.LabelIndex({
+                label['name']: label['id']
+                for label in await self.__gmail_api.list_labels(google_token)
+                if label.get('type') == 'user'
+            })
+            known_ids = labels.ids()
+            create_lock = asyncio.Lock()
+            slots = asyncio.Semaphore(job.concurrency)
+
+            async def get_or_create(name):
+                """
+                    Returns (label name, label ID), reusing the existing label name matches
+                """
+                async with create_lock:
+                    existing = labels.resolve(name)
+                    if existing is not None:
+                        return existing, labels.get(existing)
+                    started = time.perf_counter()
+                    label_info = await self.__gmail_api.create_label(google_token, name.strip())
+                    if metrics is not None:
+                        metrics.observe("stage_seconds", time.perf_counter() - started, stage="create_label")
+                    labels.add(label_info["name"], label_info["id"])
+                    job.created += 1
+                    return label_info["name"], label_info["id"]
+
+            async def classify(batch):
+                async with slots:
+                    started = time.perf_counter()
+                    generated = await asyncio.to_thread(agent.generate_labels, batch, labels.names())
+                    elapsed = time.perf_counter() - started
+                    if metrics is not None:
+                        metrics.observe("stage_seconds", elapsed, stage="classify")
+                    return batch, generated, elapsed * 1000 / len(batch)
+
+            next_page = asyncio.create_task(self.__fetch_page(google_token, job.page_size, None))
+            for page_number in range(job.pages):
+                page, emails = await next_page
+                next_page = None
+                if job.total is None:
+                    job.total = min(page.get("resultSizeEstimate", job.pages * job.page_size), job.pages * job.page_size)
+                # Fetch the next page while this one is being classified
+                if page.get("nextPageToken") and page_number + 1 < job.pages:
+                    next_page = asyncio.create_task(self.__fetch_page(google_token, job.page_size, page["nextPageToken"]))
+                job.fetched += len(emails)
+
+                if job.by_thread:
+                    # The rest of a thread keeps the user label one of its listed messages
+                    # already has, rather than a new one the thread modify would add to it too
+                    for msg in emails:
+                        label_id = next((lbl for lbl in msg.labels if lbl in known_ids), None)
+                        if label_id is not None:
+                            agent.assign(msg.thread_id or msg.id, labels.name_of(label_id))
+
+                # Skip if email already has a known label
+                pending = [
+                    msg for msg in emails
+                    if not any(lbl in known_ids for lbl in msg.labels)
+                ]
+                job.skipped += len(emails) - len(pending)
+                if metrics is not None:
+                    metrics.inc("emails_total", len(emails) - len(pending), outcome="skipped")
+
+                # by_thread: one message per thread is classified; the thread modify covers the rest
+                leads, followers = pending, {}
+                if job.by_thread:
+                    threads = email_agent.group_by_thread(pending)
+                    leads = [email_agent.representative(messages) for messages in threads.values()]
+                    followers = {
+                        lead.id: [msg for msg in messages if msg is not lead]
+                        for lead, messages in zip(leads, threads.values())
+                    }
+                    if metrics is not None and len(pending) > len(leads):
+                        metrics.inc("labels_total", len(pending) - len(leads), source="thread")
+                batches = [
+                    leads[i:i + agent.batch_size]
+                    for i in range(0, len(leads), agent.batch_size)
+                ]
+                assignments = {}
+                decisions = []
+                # Batches are taken as they finish, so the first label does not wait for the whole page
+                for classified in asyncio.as_completed([classify(batch) for batch in batches]):
+                    batch, generated, latency_ms = await classified
+                    for msg in batch:
+                        lbl, label_id = await get_or_create(generated[msg.id])
+                        if job.first_label_seconds is None:
+                            job.first_label_seconds = time.time() - job.started_at
+                            if metrics is not None:
+                                metrics.observe("time_to_first_label_seconds", job.first_label_seconds)
+                        if not job.by_thread:
+                            assignments.setdefault(label_id, []).append(msg.id)
+                        elif (msg.thread_id or msg.id) not in applied_threads:
+                            thread_id = msg.thread_id or msg.id
+                            applied_threads.add(thread_id)
+                            assignments.setdefault(label_id, []).append(thread_id)
+                        if tracing:
+                            decisions.extend((member, lbl, latency_ms) for member in [msg, *followers.get(msg.id, ())])
+
+                started = time.perf_counter()
+                if job.by_thread:
+                    # A thread that already has a user label keeps it rather than getting a second one
+                    user_label_ids = labels.ids()
+                    await asyncio.gather(*(
+                        self.__gmail_api.batch_modify_threads(google_token, ids, [label_id], user_label_ids)
+                        for label_id, ids in assignments.items()
+                    ))
+                else:
+                    await asyncio.gather(*(
+                        self.__gmail_api.batch_modify(google_token, ids, [label_id])
+                        for label_id, ids in assignments.items()
+                    ))
+                if job.by_thread:
+                    job.threads = len(applied_threads)
+                job.labeled += len(pending)
+                if metrics is not None:
+                    metrics.observe("stage_seconds", time.perf_counter() - started, stage="apply")
+                    metrics.inc("emails_total", len(pending), outcome="labeled")
+                for msg, lbl, latency_ms in decisions:
+                    metrics.trace(job=job.id, page=page_number, id=msg.id, label=lbl, classify_ms=latency_ms)
+                if next_page is None:
+                    break
+            job.status = JobStatus.COMPLETED
+        except asyncio.CancelledError:
+            job.status = JobStatus.CANCELLED
+        except Exception as e:
+            job.status = JobStatus.FAILED
+            job.error = str(e)
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+            # Sender rules learned since their last autosave
+            rules = self.__rules.get(job.owner)
+            if rules is not None:
+                try:
+                    rules.flush()
+                except OSError as e:
+                    job.error = job.error or str(e)
+            job.finished_at = time.time()
@@ -1,32 +1,60 @@
-import asyncio
+import threading
+import time
+from collections import OrderedDict
 from jose import jwt
 from datetime import datetime, timedelta, UTC
 from .credentials_manager import SecretManager, SecretName
 
 class JWTManager:
-    def __init__(self, token_expiry_time:int=None):
+    def __init__(self, token_expiry_time:int=None, cache_size:int=256, cache_ttl:float=300):
+        """
+            Verified tokens are kept in an LRU cache of cache_size entries for at most
+            cache_ttl seconds, and never past the token's own exp claim
+        """
         jwt_secrets = SecretManager.get_secret(SecretName.JWT_API)
         self.__secret = jwt_secrets['jwt_secret']
         self.__decode_secret = jwt_secrets['jwt_decode_secret']
         self.__algorithm = jwt_secrets['jwt_algorithm']
         self.__jwt_expiry_seconds = token_expiry_time if token_expiry_time else jwt_secrets.get('jwt_expiry_seconds', 3600)
-        self.__token = None
-        self.token_event = asyncio.Event()
+        self.__cache_size = cache_size
+        self.__cache_ttl = cache_ttl
+        self.__cache = OrderedDict()
+        # Tokens may be verified from worker threads as well as the event loop
+        self.__cache_lock = threading.Lock()
 
     def create_jwt_token(self, data: dict):
-        if not self.__token:
-            to_encode = data.copy()
-            expire = datetime.now(UTC) + timedelta(seconds=self.__jwt_expiry_seconds)
-            to_encode.update({"exp": expire})
-            self.token_event.set()
-            self.__token = jwt.encode(to_encode, self.__secret, algorithm=self.__algorithm)
-    
-    @property
-    def token(self):
-        return self.__token
+        """
+            Returns a new API token carrying data; every login gets its own
+        """
+        to_encode = data.copy()
+        expire = datetime.now(UTC) + timedelta(seconds=self.__jwt_expiry_seconds)
+        to_encode.update({"exp": expire})
+        return jwt.encode(to_encode, self.__secret, algorithm=self.__algorithm)
 
     def verify_jwt_token(self, token: str):
-        assert self.__token is not None, 'Need to define the token to compare against'
         decoded_private = jwt.decode(token, self.__decode_secret, algorithms=[self.__algorithm])
         decoded = jwt.decode(decoded_private['api_token'], self.__secret, algorithms=[self.__algorithm])
         return decoded
+
+    def verify_jwt_token_cached(self, token: str):
+        """
+            Same as verify_jwt_token, but skips both decode passes for a recently verified token
+        """
+        now = time.time()
+        with self.__cache_lock:
+            entry = self.__cache.get(token)
+            if entry is not None:
+                decoded, expires_at = entry
+                if now < expires_at:
+                    self.__cache.move_to_end(token)
+                    return decoded
+                del self.__cache[token]
+
+        decoded = self.verify_jwt_token(token)
+        expires_at = min(now + self.__cache_ttl, decoded.get('exp', now))
+        if expires_at > now:
+            with self.__cache_lock:
+                self.__cache[token] = (decoded, expires_at)
+                if len(self.__cache) > self.__cache_size:
+                    self.__cache.popitem(last=False)
+        return decoded
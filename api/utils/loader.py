@@ -0,0 +1,13 @@
+import sys
+from pathlib import Path
+
+def load_email_agent():
+    """
+        email_agent lives at the repository root, one level above the API package
+    """
+    try:
+        import email_agent
+    except ImportError:
+        sys.path.append(str(Path(__file__).resolve().parents[2]))
+        import email_agent
+    return email_agent
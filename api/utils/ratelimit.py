@@ -0,0 +1,133 @@
+import asyncio
+import random
+import time
+from datetime import datetime, UTC
+from email.utils import parsedate_to_datetime
+
+# Gmail quota units charged per call, see https://developers.google.com/gmail/api/reference/quota.
+# Calls inside a multipart batch are charged individually
+QUOTA_UNITS = {
+    "labels.list": 1,
+    "labels.create": 5,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "threads.get": 10,
+    "threads.modify": 10,
+    "history.list": 2,
+    "getProfile": 1,
+}
+# Gmail's per-user rate limit: 15,000 quota units per minute
+USER_QUOTA_PER_SECOND = 250
+# Statuses worth retrying: rate limited, or a transient backend failure
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Gmail reports some rate limits as 403 with one of these reasons in the body
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+def is_throttled(resp):
+    """
+        True when Gmail rejected the call because of a rate limit rather than a real error
+    """
+    if resp.status_code == 429:
+        return True
+    return resp.status_code == 403 and any(reason in resp.text for reason in RATE_LIMIT_REASONS)
+
+def retry_after(resp):
+    """
+        Seconds the server asked us to wait through Retry-After, or None
+    """
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(UTC)).total_seconds(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+            Refills `rate` units per second up to `capacity` (one second's worth by default).
+            acquire reserves its units immediately and sleeps until the bucket has paid
+            them back, so a call larger than the capacity still goes through
+        """
+        self.__rate = rate
+        self.__capacity = capacity if capacity else rate
+        self.__tokens = self.__capacity
+        self.__updated = time.monotonic()
+
+    @property
+    def rate(self):
+        return self.__rate
+
+    async def acquire(self, units: float = 1):
+        now = time.monotonic()
+        self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+        self.__tokens -= units
+        if self.__tokens < 0:
+            await asyncio.sleep(-self.__tokens / self.__rate)
+
+
+class AdaptiveConcurrency:
+    def __init__(self, maximum: int, minimum: int = 1, initial: int = None, cooldown: float = 1.0):
+        """
+            AIMD limit on in-flight requests. Each success raises the limit by 1/limit
+            (about one slot per round of requests) up to maximum; a throttled response
+            halves it, at most once per cooldown seconds so a burst of 429s from the same
+            round only counts once
+        """
+        self.__maximum = maximum
+        self.__minimum = minimum
+        self.__limit = float(initial if initial else maximum)
+        self.__cooldown = cooldown
+        self.__last_backoff = 0.0
+        self.__in_flight = 0
+        self.__condition = asyncio.Condition()
+
+    @property
+    def limit(self):
+        return int(self.__limit)
+    @property
+    def in_flight(self):
+        return self.__in_flight
+
+    def success(self):
+        self.__limit = min(self.__maximum, self.__limit + 1 / self.__limit)
+
+    def backoff(self):
+        now = time.monotonic()
+        if now - self.__last_backoff >= self.__cooldown:
+            self.__last_backoff = now
+            self.__limit = max(self.__minimum, self.__limit / 2)
+
+    async def __aenter__(self):
+        async with self.__condition:
+            await self.__condition.wait_for(lambda: self.__in_flight < int(self.__limit))
+            self.__in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.__condition:
+            self.__in_flight -= 1
+            self.__condition.notify_all()
+
+
+class RetryPolicy:
+    def __init__(self, max_retries: int = 5, base_delay: float = 0.5, max_delay: float = 32.0):
+        """
+            Exponential backoff with full jitter; a server-provided Retry-After wins
+        """
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, server_delay: float = None):
+        if server_delay is not None:
+            return min(server_delay, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
@@ -0,0 +1,158 @@
+import asyncio
+import secrets
+import threading
+import time
+
+from .auth import AuthFlowGoogle
+from .jwt import JWTManager
+
+# Seconds a started login can take to come back through the Google callback and be redeemed
+LOGIN_TTL = 600
+# How often a /token wait re-reads the store, so a login completed by another API process is seen
+SESSION_POLL_INTERVAL = 1.0
+
+class Session:
+    def __init__(self, id: str, code_verifier: str = None, user_id: str = None, api_token: str = None, created_at: float = None):
+        """
+            One login. Pending until the Google callback fills in user_id and api_token
+        """
+        self.id = id
+        self.code_verifier = code_verifier
+        self.user_id = user_id
+        self.api_token = api_token
+        self.created_at = created_at if created_at is not None else time.time()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "code_verifier": self.code_verifier,
+            "user_id": self.user_id,
+            "api_token": self.api_token,
+            "created_at": self.created_at
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+
+
+class SessionStore:
+    def __init__(self):
+        """
+            In-memory session store, the default. Override get/put/delete to keep sessions
+            elsewhere (e.g. Redis, with Session.to_dict/from_dict) and share them between
+            API processes. Keys are "login:<state>"
+        """
+        self.__sessions = {}
+        self.__lock = threading.Lock()
+
+    def get(self, key: str):
+        now = time.time()
+        with self.__lock:
+            entry = self.__sessions.get(key)
+            if entry is None:
+                return None
+            session, expires_at = entry
+            if now >= expires_at:
+                del self.__sessions[key]
+                return None
+            return session
+
+    def put(self, key: str, session: Session, ttl: float):
+        now = time.time()
+        with self.__lock:
+            self.__sessions[key] = (session, now + ttl)
+            # Expired entries are dropped on writes, so abandoned logins do not pile up
+            for stale in [k for k, (_, expires_at) in self.__sessions.items() if expires_at <= now]:
+                del self.__sessions[stale]
+
+    def delete(self, key: str):
+        with self.__lock:
+            self.__sessions.pop(key, None)
+
+
+class SessionManager:
+    def __init__(self, google_flow: AuthFlowGoogle, token_manager: JWTManager, store: SessionStore = None):
+        """
+            Per-user logins: every login gets its own OAuth state, PKCE verifier, API token
+            and wait, so any number of accounts can sign in to one API concurrently
+        """
+        self.__google_flow = google_flow
+        self.__token_manager = token_manager
+        self.__store = store if store is not None else SessionStore()
+        # state → event set by the callback; only wakes waiters in this process
+        self.__waiters = {}
+
+    @property
+    def store(self):
+        return self.__store
+
+    def start(self):
+        """
+            Returns (session ID, Google authorization URL). The session ID doubles as the
+            OAuth state, so the callback finds its login without any shared flow
+        """
+        session_id = secrets.token_urlsafe(32)
+        flow = self.__google_flow.create_flow(session_id)
+        auth_url, _ = flow.authorization_url(
+            access_type="offline",
+            prompt="consent",
+            include_granted_scopes="false"
+        )
+        self.__store.put(f"login:{session_id}", Session(session_id, flow.code_verifier), LOGIN_TTL)
+        return session_id, auth_url
+
+    def create_flow(self, session_id: str):
+        """
+            The flow of a pending login, or None if there is no such login
+        """
+        session = self.__store.get(f"login:{session_id}")
+        if session is None or session.user_id is not None:
+            return None
+        return self.__google_flow.create_flow(session_id, session.code_verifier)
+
+    def complete(self, session_id: str, user_id: str, access_token: str):
+        """
+            Issues the user's API token and wakes whoever waits on the login
+        """
+        session = self.__store.get(f"login:{session_id}")
+        if session is None:
+            return None
+        session.user_id = user_id
+        session.api_token = self.__token_manager.create_jwt_token({
+            "access_token": access_token,
+            "sub": user_id,
+            "sid": session_id
+        })
+        self.__store.put(f"login:{session_id}", session, LOGIN_TTL)
+        event = self.__waiters.pop(session_id, None)
+        if event is not None:
+            event.set()
+        return session
+
+    async def wait_for_token(self, session_id: str, timeout: float):
+        """
+            The login's API token once its callback has run. It can be redeemed once.
+            Raises KeyError for an unknown or expired login and TimeoutError after timeout
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        event = self.__waiters.setdefault(session_id, asyncio.Event())
+        try:
+            while True:
+                session = self.__store.get(f"login:{session_id}")
+                if session is None:
+                    raise KeyError(session_id)
+                if session.api_token is not None:
+                    self.__store.delete(f"login:{session_id}")
+                    return session.api_token
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError(session_id)
+                try:
+                    await asyncio.wait_for(event.wait(), min(remaining, SESSION_POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self.__waiters.get(session_id) is event and not event.is_set():
+                self.__waiters.pop(session_id, None)
@@ -0,0 +1,44 @@
+"""
+    Per-request cost of resolving an API token to the caller's Google access token:
+    JWTManager.verify_jwt_token (two jwt.decode passes every call) against
+    JWTManager.verify_jwt_token_cached.
+
+    Run from the repository root:  python benchmarks/bench_auth.py
+"""
+import argparse
+import sys
+import time
+
+from jose import jwt
+
+from harness import BENCH_SECRETS, ROOT, install_settings
+
+def time_calls(fn, token: str, iterations: int):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(token)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    install_settings()
+    sys.path.insert(0, str(ROOT / "api"))
+    from utils.jwt import JWTManager
+
+    manager = JWTManager()
+    token = manager.create_jwt_token({"access_token": "ya29.bench-google-token", "sub": "bench@example.com"})
+    secrets = BENCH_SECRETS["jwt_secrets_api"]
+    # Clients send the API token wrapped in a second token signed with the decode secret
+    api_token = jwt.encode({"api_token": token}, secrets["jwt_decode_secret"], algorithm=secrets["jwt_algorithm"])
+
+    uncached = time_calls(manager.verify_jwt_token, api_token, args.iterations)
+    cached = time_calls(manager.verify_jwt_token_cached, api_token, args.iterations)
+    print(f"verify_jwt_token         {uncached:8.2f} us/request")
+    print(f"verify_jwt_token_cached  {cached:8.2f} us/request")
+    print(f"saved                    {uncached - cached:8.2f} us/request ({uncached / cached:.1f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,310 @@
+"""
+    Offline end-to-end labeling benchmark.
+
+    Starts api/app.py against a synthetic Gmail mailbox (MockGmail) and a fake ollama,
+    then labels the whole mailbox through GmailClient the way a front-end would:
+      pipeline  LabelingPipeline + Agent in this process (what test.py runs)
+      job       POST /jobs/label and poll until the job finishes (what main.py runs)
+
+    Reports emails/sec, time to the first label, per-stage latency percentiles, requests per
+    email and peak RSS. --no-warmup measures a cold start, where the first call loads the model.
+    Save a run with --output and compare a later one against it with --baseline:
+
+      python benchmarks/bench_e2e.py --messages 10000 --output before.json
+      python benchmarks/bench_e2e.py --messages 10000 --baseline before.json
+"""
+import argparse
+import math
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+
+import fake_ollama
+from harness import ROOT, compare, install_settings, peak_rss_mb, percentiles, read_result, revision, write_result
+
+# Seconds to wait for the API process to come up
+STARTUP_TIMEOUT = 30
+# Seconds between job progress polls in job mode
+POLL_INTERVAL = 0.2
+
+class Timings:
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, stage: str, seconds: float):
+        self.samples.setdefault(stage, []).append(seconds * 1000)
+
+    def report(self):
+        return {stage: percentiles(samples) for stage, samples in self.samples.items()}
+
+
+class TimedClient:
+    """
+        GmailClient wrapper recording how long each pipeline-facing call takes
+    """
+    def __init__(self, client, timings: Timings):
+        self.__client = client
+        self.__timings = timings
+
+    def __getattr__(self, name):
+        return getattr(self.__client, name)
+
+    def iter_emails(self, pages=1, page_size=10, query=None):
+        emails = self.__client.iter_emails(pages, page_size, query)
+        while True:
+            started = time.perf_counter()
+            try:
+                msg = next(emails)
+            except StopIteration:
+                return
+            self.__timings.add("fetch_ms", time.perf_counter() - started)
+            yield msg
+
+    def create_label(self, name: str):
+        started = time.perf_counter()
+        label_id = self.__client.create_label(name)
+        self.__timings.add("create_label_ms", time.perf_counter() - started)
+        return label_id
+
+    def apply_labels_bulk(self, assignments: dict[str, list[str]]):
+        started = time.perf_counter()
+        result = self.__client.apply_labels_bulk(assignments)
+        self.__timings.add("apply_ms", time.perf_counter() - started)
+        return result
+
+    def apply_thread_labels_bulk(self, assignments: dict[str, list[str]]):
+        started = time.perf_counter()
+        result = self.__client.apply_thread_labels_bulk(assignments)
+        self.__timings.add("apply_ms", time.perf_counter() - started)
+        return result
+
+
+class TimedAgent:
+    """
+        Agent wrapper recording the latency of each classified batch
+    """
+    def __init__(self, agent, timings: Timings):
+        self.__agent = agent
+        self.__timings = timings
+
+    def __getattr__(self, name):
+        return getattr(self.__agent, name)
+
+    def generate_labels(self, emails, existing_labels, batch_size: int = None):
+        started = time.perf_counter()
+        labels = self.__agent.generate_labels(emails, existing_labels, batch_size)
+        self.__timings.add("classify_batch_ms", time.perf_counter() - started)
+        return labels
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_api(args, workdir: str):
+    port = free_port()
+    command = [
+        sys.executable, str(Path(__file__).with_name("serve_api.py")),
+        "--port", str(port),
+        "--messages", str(args.messages),
+        "--gmail-latency", str(args.gmail_latency),
+        "--throttle-rate", str(args.throttle_rate),
+        "--retry-after", str(args.retry_after),
+        "--token-latency", str(args.token_latency),
+        "--prompt-token-latency", str(args.prompt_token_latency),
+        "--load-latency", str(args.load_latency),
+        "--seed", str(args.seed),
+    ]
+    if args.no_warmup:
+        command += ["--no-warmup"]
+    if args.quota:
+        command += ["--quota", str(args.quota)]
+    process = subprocess.Popen(command, cwd=workdir)
+    api_base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"API process exited with status {process.returncode}")
+        try:
+            requests.get(f"{api_base}/__bench/stats", timeout=1).raise_for_status()
+            return process, api_base
+        except requests.RequestException:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("API process did not start in time")
+
+def build_labeler(args, workdir: str):
+    from email_agent import Agent, EmbeddingClassifier, SenderRules
+
+    rules = None if args.no_rules else SenderRules(str(Path(workdir) / "sender_rules.json"))
+    labeler = Agent(model=args.model, rules=rules, batch_size=args.batch_size)
+    if args.classifier == "embedding":
+        labeler = EmbeddingClassifier(labeler, index_path=str(Path(workdir) / "label_index"), threshold=args.similarity)
+    return labeler
+
+def run_pipeline(args, client, labeler, timings: Timings):
+    """
+        Returns (emails, seconds to the first label, escalation rate)
+    """
+    from utils import LabelingPipeline
+
+    agent = TimedAgent(labeler, timings)
+    pipeline = LabelingPipeline(
+        TimedClient(client, timings),
+        agent,
+        pages=math.ceil(args.messages / args.page_size),
+        page_size=args.page_size,
+        workers=args.workers,
+        apply_chunk_size=args.apply_chunk_size,
+        by_thread=args.threads
+    )
+    stats = pipeline.run()
+    escalation_rate = labeler.escalation_rate if args.classifier == "embedding" else None
+    return stats["labeled"] + stats["skipped"], stats["first_label_seconds"], escalation_rate
+
+def run_job(args, client):
+    job = client.start_label_job(
+        math.ceil(args.messages / args.page_size), args.model, args.workers, args.page_size, args.threads
+    )
+    while job["status"] == "running":
+        time.sleep(POLL_INTERVAL)
+        job = client.get_job(job["id"])
+    if job["status"] != "completed":
+        raise RuntimeError(f"Job ended as {job['status']}: {job['error']}")
+    return job["labeled"] + job["skipped"], job["first_label_seconds"], None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["pipeline", "job"], default="pipeline")
+    parser.add_argument("--messages", type=int, default=1000, help="size of the synthetic mailbox")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=2, help="classifier workers / job concurrency")
+    parser.add_argument("--batch-size", type=int, default=8, help="emails per model call (pipeline mode)")
+    parser.add_argument("--apply-chunk-size", type=int, default=100)
+    parser.add_argument("--no-rules", action="store_true", help="call the model for every email (pipeline mode)")
+    parser.add_argument("--model", default="llama3.2:1b")
+    parser.add_argument(
+        "--classifier", choices=["llm", "embedding"], default="llm",
+        help="embedding: nearest labeled email first, LLM only below --similarity (pipeline mode)"
+    )
+    parser.add_argument("--threads", action="store_true", help="classify and label whole threads (3 messages each)")
+    parser.add_argument("--similarity", type=float, default=0.9, help="cosine threshold of the embedding classifier")
+    parser.add_argument("--gmail-latency", type=float, default=0.02, help="seconds added to every Gmail request")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of Gmail requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=0.0, help="Retry-After sent with injected 429s")
+    parser.add_argument("--quota", type=float, default=None, help="per-user Gmail quota units/s (default: Gmail's 250)")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="seconds per generated token")
+    parser.add_argument("--prompt-token-latency", type=float, default=0.0002, help="seconds per prompt token")
+    parser.add_argument("--load-latency", type=float, default=1.0, help="seconds ollama takes to load a model")
+    parser.add_argument(
+        "--no-warmup", action="store_true",
+        help="do not load the model ahead of the run (pipeline) or at API startup (job), to measure a cold start"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the result as JSON to this path")
+    parser.add_argument("--baseline", help="compare against a result written earlier with --output")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change reported as a regression")
+    args = parser.parse_args()
+
+    install_settings()
+    fake = fake_ollama.install(args.token_latency, args.prompt_token_latency, args.load_latency)
+    sys.path.insert(0, str(ROOT))
+    from email_agent import WarmUp
+    from utils import encode_tok, GmailClient
+
+    timings = Timings()
+    with tempfile.TemporaryDirectory() as workdir:
+        labeler = None
+        if args.mode == "pipeline":
+            labeler = build_labeler(args, workdir)
+            # Like test.py, the model loads while the front-end starts up and logs in
+            if not args.no_warmup:
+                WarmUp(labeler).start()
+        process, api_base = start_api(args, workdir)
+        try:
+            session_id = requests.get(f"{api_base}/__bench/session").json()["session_id"]
+            client = GmailClient(api_base, encode_tok(GmailClient.get_token(api_base, session_id)))
+            started = time.perf_counter()
+            if args.mode == "pipeline":
+                emails, first_label_seconds, escalation_rate = run_pipeline(args, client, labeler, timings)
+            else:
+                emails, first_label_seconds, escalation_rate = run_job(args, client)
+            seconds = time.perf_counter() - started
+            server = requests.get(f"{api_base}/__bench/stats").json()
+        finally:
+            process.terminate()
+            process.wait()
+
+    ollama_stats = fake.stats() if args.mode == "pipeline" else server["ollama"]
+    llm_calls = ollama_stats["calls"]
+    per_email = max(emails, 1)
+    result = {
+        "revision": revision(),
+        "params": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output", "baseline", "threshold")
+        },
+        "metrics": {
+            "emails": emails,
+            "seconds": seconds,
+            "emails_per_second": emails / seconds if seconds > 0 else 0.0,
+            "time_to_first_label_seconds": first_label_seconds,
+            "api_requests_per_email": server["api_requests"] / per_email,
+            "gmail_http_requests_per_email": server["gmail"]["http_requests"] / per_email,
+            "gmail_calls_per_email": server["gmail"]["calls"] / per_email,
+            "llm_calls_per_email": llm_calls / per_email,
+            "prompt_tokens_per_email": ollama_stats["prompt_tokens"] / per_email,
+            "output_tokens_per_email": ollama_stats["output_tokens"] / per_email,
+            "output_tokens_per_llm_call": ollama_stats["output_tokens"] / max(llm_calls, 1),
+            "prompt_tokens_per_llm_call": ollama_stats["prompt_tokens"] / max(llm_calls, 1),
+            "cached_prompt_tokens_per_call": ollama_stats["cached_tokens"] / max(llm_calls, 1),
+            "gmail_throttled": server["gmail"]["throttled"],
+            "escalation_rate": escalation_rate,
+            "stages": timings.report(),
+            "client_peak_rss_mb": peak_rss_mb(),
+            "api_peak_rss_mb": server["peak_rss_mb"],
+        },
+        "gmail_calls_by_method": server["gmail"]["by_method"],
+    }
+
+    metrics = result["metrics"]
+    print(f"Revision {result['revision']}, {args.mode} mode, {args.messages} messages")
+    print(f"  {metrics['emails']} emails in {metrics['seconds']:.2f}s → {metrics['emails_per_second']:.1f} emails/s")
+    if metrics["time_to_first_label_seconds"] is not None:
+        print(f"  time to first label: {metrics['time_to_first_label_seconds']:.2f}s")
+    print(
+        f"  per email: {metrics['api_requests_per_email']:.3f} API requests, "
+        f"{metrics['gmail_http_requests_per_email']:.3f} Gmail HTTP requests "
+        f"({metrics['gmail_calls_per_email']:.3f} Gmail calls), {metrics['llm_calls_per_email']:.3f} LLM calls"
+    )
+    print(
+        f"  prompt tokens per LLM call: {metrics['prompt_tokens_per_llm_call']:.0f} evaluated, "
+        f"{metrics['cached_prompt_tokens_per_call']:.0f} reused from the prompt cache"
+    )
+    print(
+        f"  output tokens: {metrics['output_tokens_per_llm_call']:.1f} per LLM call, "
+        f"{metrics['output_tokens_per_email']:.2f} per email"
+    )
+    print(f"  Gmail 429s injected: {metrics['gmail_throttled']}")
+    if metrics["escalation_rate"] is not None:
+        print(f"  escalated to the LLM: {metrics['escalation_rate']:.1%}")
+    for stage, stats in metrics["stages"].items():
+        print(f"  {stage:18} p50 {stats['p50']:8.2f}  p95 {stats['p95']:8.2f}  p99 {stats['p99']:8.2f}  (n={stats['count']})")
+    print(f"  peak RSS: client {metrics['client_peak_rss_mb']:.1f} MB, API {metrics['api_peak_rss_mb']:.1f} MB")
+
+    if args.output:
+        write_result(result, args.output)
+    if args.baseline:
+        regressions = compare(result, read_result(args.baseline), args.threshold)
+        if regressions:
+            print(f"⚠️ {len(regressions)} metric(s) regressed by more than {args.threshold:.0%}")
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+    Per-record cost of the email records the API serves and GmailClient reads back:
+    the old ad-hoc dicts through the stdlib json module against email_agent.Email
+    (slots dataclasses sent as compact rows) through email_agent.dumps / loads, on one
+    page of synthetic messages.
+
+    Reports encode and decode time per record, encoded size per record and the memory
+    a decoded page holds. Save and compare runs like bench_e2e.py:
+
+      python benchmarks/bench_records.py --records 100000 --output before.json
+      python benchmarks/bench_records.py --records 100000 --baseline before.json
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from harness import ROOT, compare, read_result, revision, write_result
+
+sys.path.insert(0, str(ROOT))
+from email_agent import Attachment, Email, ORJSON_AVAILABLE, dumps, loads  # noqa: E402
+
+SENDERS = ["GitHub <noreply@github.com>", "Meezan Bank <alerts@meezanbank.com>", "Amazon <orders@amazon.com>",
+           "LinkedIn <jobs@linkedin.com>", "Medium Daily Digest <noreply@medium.com>"]
+SUBJECTS = ["Your order has shipped", "New sign-in to your account", "Weekly digest",
+            "Your statement is ready", "Invitation: Standup @ Mon 10am"]
+# Every this many messages carries a PDF attachment, like bench_e2e's mailbox
+ATTACHMENT_EVERY = 7
+
+def synthetic(count: int, seed: int = 7):
+    rng = random.Random(seed)
+    return [
+        Email(
+            id=f"{index:016x}",
+            thread_id=f"{index // 3:016x}",
+            subject=rng.choice(SUBJECTS),
+            sender=rng.choice(SENDERS),
+            date="Mon, 3 Mar 2025 09:12:44 +0500",
+            labels=["INBOX", "UNREAD"] if index % 2 else ["INBOX"],
+            snippet=f"{rng.choice(SUBJECTS)} — message {index} in the synthetic mailbox",
+            attachments=[Attachment(f"statement-{index}.pdf", "application/pdf", 48213)] if index % ATTACHMENT_EVERY == 0 else []
+        )
+        for index in range(count)
+    ]
+
+def as_dict(email: Email):
+    # The record parse_message built before Email existed
+    return {
+        "id": email.id,
+        "threadId": email.thread_id,
+        "subject": email.subject,
+        "from": email.sender,
+        "date": email.date,
+        "labels": email.labels,
+        "snipet": email.snippet,
+        "attachments": [
+            {"filename": attachment.filename, "mimeType": attachment.mime_type, "size": attachment.size}
+            for attachment in email.attachments
+        ]
+    }
+
+def best_of(fn, repeat: int):
+    """
+        Fastest of repeat runs of fn, with the cyclic collector off as timeit does; it would
+        otherwise rescan the page on every collection and dominate the time
+    """
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            started = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - started
+        finally:
+            gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def retained_bytes(build):
+    """
+        Bytes still allocated by what build() returns, measured once its temporaries are gone
+    """
+    gc.collect()
+    tracemalloc.start()
+    page = build()
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del page
+    return current
+
+def measure(page, encode, decode, repeat: int):
+    encode_seconds, encoded = best_of(lambda: encode(page), repeat)
+    decode_seconds, _ = best_of(lambda: decode(encoded), repeat)
+    return {
+        "encode_ns": encode_seconds / len(page) * 1e9,
+        "decode_ns": decode_seconds / len(page) * 1e9,
+        "encoded_bytes": len(encoded) / len(page),
+        "page_bytes": retained_bytes(lambda: decode(encoded)) / len(page),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--records", type=int, default=100000, help="messages on the page")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement; the fastest is kept")
+    parser.add_argument("--output", help="write the result to this JSON file")
+    parser.add_argument("--baseline", help="compare against a result written by --output")
+    parser.add_argument("--threshold", type=float, default=0.10)
+    args = parser.parse_args()
+
+    emails = synthetic(args.records)
+    dicts = [as_dict(email) for email in emails]
+    results = {
+        "dict_json": measure(
+            dicts,
+            lambda page: json.dumps({"emails": page}).encode(),
+            lambda data: json.loads(data)["emails"],
+            args.repeat
+        ),
+        "records": measure(
+            emails,
+            lambda page: dumps({"emails": page}),
+            lambda data: [Email.from_row(row) for row in loads(data)["emails"]],
+            args.repeat
+        ),
+    }
+    result = {
+        "revision": revision(),
+        "params": {"records": args.records, "repeat": args.repeat, "orjson": ORJSON_AVAILABLE},
+        "metrics": results,
+    }
+
+    print(f"Revision {result['revision']}, {args.records} records, orjson {'on' if ORJSON_AVAILABLE else 'off'}")
+    print(f"  {'':12} {'encode':>12} {'decode':>12} {'encoded':>12} {'in memory':>12}")
+    for name, metrics in results.items():
+        print(
+            f"  {name:12} {metrics['encode_ns']:9.0f} ns {metrics['decode_ns']:9.0f} ns "
+            f"{metrics['encoded_bytes']:10.0f} B {metrics['page_bytes']:10.0f} B"
+        )
+    old, new = results["dict_json"], results["records"]
+    print(
+        f"  per record: encode {old['encode_ns'] / new['encode_ns']:.1f}x faster, "
+        f"decode {old['decode_ns'] / new['decode_ns']:.1f}x faster, "
+        f"{1 - new['page_bytes'] / old['page_bytes']:.0%} less memory"
+    )
+
+    if args.output:
+        write_result(result, args.output)
+    if args.baseline:
+        regressions = compare(result, read_result(args.baseline), args.threshold)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
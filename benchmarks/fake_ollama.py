@@ -0,0 +1,158 @@
+"""
+    Stand-in for the `ollama` package: chat() answers in the shape email_agent expects,
+    picking labels from the sender, embed() returns hashed bag-of-words vectors, and both
+    sleep to imitate prompt processing and generation. The first call for a model also
+    sleeps load_latency, like ollama loading it into memory. Like ollama's runner, chat() only
+    evaluates the part of a prompt after the prefix it shares with the previous one.
+    Without a format schema, answers come wrapped in a sentence the way small models ramble;
+    options["num_predict"] cuts answers off
+"""
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+import types
+import zlib
+
+# Label the fake model gives each sender domain; unknown domains get DEFAULT_LABEL
+DOMAIN_LABELS = {
+    "github.com": "GitHub",
+    "meezanbank.com": "Bank Alerts",
+    "amazon.com": "Shopping",
+    "daraz.pk": "Shopping",
+    "linkedin.com": "Jobs",
+    "medium.com": "Newsletters",
+    "google.com": "Calendar",
+    "uber.com": "Receipts",
+    "stripe.com": "Receipts",
+    "coursera.org": "Learning",
+}
+DEFAULT_LABEL = "Other"
+# Rough characters per token, used to size the simulated work
+CHARS_PER_TOKEN = 4
+# Length of the vectors returned by embed()
+EMBEDDING_DIM = 256
+
+class FakeOllama:
+    def __init__(self, token_latency: float = 0.005, prompt_token_latency: float = 0.0002, load_latency: float = 1.0):
+        """
+            token_latency seconds per generated token, prompt_token_latency seconds per
+            prompt token, load_latency seconds to load a model on its first call; concurrent
+            calls are served one at a time, like a single ollama runner
+        """
+        self.token_latency = token_latency
+        self.prompt_token_latency = prompt_token_latency
+        self.load_latency = load_latency
+        self.loads = 0
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.embed_calls = 0
+        self.embedded = 0
+        self.__runner = threading.Lock()
+        # Prompt currently held in the runner's KV cache
+        self.__cached_prompt = ""
+        self.__loaded = set()
+
+    def __load(self, model: str):
+        # Called with the runner held; returns the load time in seconds
+        if model in self.__loaded:
+            return 0.0
+        time.sleep(self.load_latency)
+        self.__loaded.add(model)
+        self.loads += 1
+        return self.load_latency
+
+    @staticmethod
+    def label_for(sender: str):
+        domain = sender.rsplit("@", 1)[-1].strip(" >").lower()
+        for known, label in DOMAIN_LABELS.items():
+            if domain == known or domain.endswith("." + known):
+                return label
+        return DEFAULT_LABEL
+
+    def chat(self, model: str, messages: list[dict], options: dict = None, format=None, **kwargs):
+        prompt = messages[-1]["content"]
+        if isinstance(format, dict) and "labels" in format.get("properties", {}):
+            # Batch prompt: one "- ID:" / "- From:" pair per email
+            ids = re.findall(r"^- ID: (.+)$", prompt, re.MULTILINE)
+            senders = re.findall(r"^- From: (.+)$", prompt, re.MULTILINE)
+            content = json.dumps({"labels": [
+                {"id": msg_id, "label": self.label_for(sender)} for msg_id, sender in zip(ids, senders)
+            ]})
+        else:
+            sender = re.search(r"^- From: (.+)$", prompt, re.MULTILINE)
+            label = self.label_for(sender.group(1) if sender else "")
+            if format is not None:
+                content = json.dumps({"label": label})
+            else:
+                content = f"Based on the sender, the most fitting label for this email is: {label}"
+        num_predict = (options or {}).get("num_predict")
+        if num_predict is not None and num_predict >= 0:
+            content = content[:num_predict * CHARS_PER_TOKEN]
+
+        rendered = "".join(f"<|{message['role']}|>{message['content']}" for message in messages)
+        output_tokens = len(content) // CHARS_PER_TOKEN + 1
+        with self.__runner:
+            load_seconds = self.__load(model)
+            cached_tokens = len(os.path.commonprefix([self.__cached_prompt, rendered])) // CHARS_PER_TOKEN
+            prompt_tokens = len(rendered) // CHARS_PER_TOKEN - cached_tokens
+            self.__cached_prompt = rendered
+            time.sleep(prompt_tokens * self.prompt_token_latency + output_tokens * self.token_latency)
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.output_tokens += output_tokens
+        return {
+            "model": model,
+            "message": {"role": "assistant", "content": content},
+            "done": True,
+            "load_duration": int(load_seconds * 1e9),
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": output_tokens
+        }
+
+    def embed(self, model: str, input, **kwargs):
+        texts = [input] if isinstance(input, str) else list(input)
+        embeddings = []
+        for text in texts:
+            vector = [0.0] * EMBEDDING_DIM
+            for word in re.findall(r"\w+", text.lower()):
+                vector[zlib.crc32(word.encode()) % EMBEDDING_DIM] += 1.0
+            norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+            embeddings.append([value / norm for value in vector])
+        prompt_tokens = sum(len(text) for text in texts) // CHARS_PER_TOKEN
+        with self.__runner:
+            self.__load(model)
+            time.sleep(prompt_tokens * self.prompt_token_latency)
+            self.embed_calls += 1
+            self.embedded += len(texts)
+            self.prompt_tokens += prompt_tokens
+        return {"model": model, "embeddings": embeddings, "prompt_eval_count": prompt_tokens}
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "cached_tokens": self.cached_tokens,
+            "loads": self.loads,
+            "embed_calls": self.embed_calls,
+            "embedded": self.embedded
+        }
+
+
+def install(token_latency: float = 0.005, prompt_token_latency: float = 0.0002, load_latency: float = 1.0):
+    """
+        Registers the fake as the `ollama` module; must run before the first model call
+    """
+    fake = FakeOllama(token_latency, prompt_token_latency, load_latency)
+    module = types.ModuleType("ollama")
+    module.chat = fake.chat
+    module.embed = fake.embed
+    sys.modules["ollama"] = module
+    return fake
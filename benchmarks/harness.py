@@ -0,0 +1,105 @@
+"""
+    Helpers shared by the benchmark scripts: benchmark secrets, percentiles, peak RSS
+    and result files that can be compared across commits
+"""
+import json
+import math
+import resource
+import subprocess
+import sys
+import types
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+
+BENCH_SECRETS = {
+    "google_secrets": {
+        "client_id": "bench-client",
+        "client_secret": "bench-client-secret",
+        "client_redirect_uri": "http://localhost:8000/auth/callback"
+    },
+    "jwt_secrets_api": {
+        "jwt_secret": "bench-secret",
+        "jwt_decode_secret": "bench-decode-secret",
+        "jwt_algorithm": "HS256",
+        "jwt_expiry_seconds": 3600
+    },
+    # The front-ends wrap the API token with the API's decode secret
+    "web_secrets": {"jwt_secret": "bench-decode-secret"},
+}
+# Metrics where a lower value is better; every other metric is better when higher
+LOWER_IS_BETTER = ("seconds", "latency", "_ms", "_ns", "bytes", "per_email", "per_llm_call", "rss", "throttled", "escalation")
+# Percentiles over fewer samples than this are printed but never flagged as regressions
+MIN_SAMPLES = 100
+
+def install_settings():
+    """
+        settings.py holds real credentials and is not checked in, so benchmarks always
+        run against their own secrets
+    """
+    sys.modules["settings"] = types.SimpleNamespace(secrets=BENCH_SECRETS)
+
+def percentiles(samples: list[float]):
+    if not samples:
+        return {"p50": None, "p95": None, "p99": None, "count": 0}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "count": len(ordered)}
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def revision():
+    try:
+        sha = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{sha}-dirty" if dirty else sha
+
+def flatten(metrics: dict, prefix: str = ""):
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare(result: dict, baseline: dict, threshold: float = 0.10):
+    """
+        Prints every metric next to the baseline's and returns the names of those that got
+        worse by more than threshold. Runs with different parameters are not comparable
+    """
+    if result["params"] != baseline["params"]:
+        print(f"⚠️ Baseline {baseline['revision']} was run with different parameters, deltas are not meaningful")
+    current, previous = flatten(result["metrics"]), flatten(baseline["metrics"])
+    regressions = []
+    print(f"{'metric':40} {baseline['revision']:>14} {result['revision']:>14} {'change':>8}")
+    for name, value in current.items():
+        before = previous.get(name)
+        if before is None or before == 0 or name.endswith(".count"):
+            continue
+        change = (value - before) / abs(before)
+        worse = change > threshold if any(marker in name for marker in LOWER_IS_BETTER) else change < -threshold
+        if name.rpartition(".")[2] in ("p50", "p95", "p99"):
+            worse = worse and current.get(f"{name.rpartition('.')[0]}.count", 0) >= MIN_SAMPLES
+        if worse:
+            regressions.append(name)
+        print(f"{name:40} {before:14.3f} {value:14.3f} {change:+8.1%}{'  ⚠️' if worse else ''}")
+    return regressions
+
+def write_result(result: dict, path: str):
+    Path(path).write_text(json.dumps(result, indent=2))
+
+def read_result(path: str):
+    return json.loads(Path(path).read_text())
@@ -0,0 +1,246 @@
+"""
+    In-process stand-in for the Gmail REST API, served through httpx.MockTransport.
+    The mailbox is synthetic and deterministic for a given size and seed
+"""
+import asyncio
+import json
+import math
+import random
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, UTC
+from email.utils import format_datetime
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+SENDERS = [
+    ("GitHub", "noreply@github.com"),
+    ("Meezan Bank", "alerts@meezanbank.com"),
+    ("Amazon", "shipment-tracking@amazon.com"),
+    ("LinkedIn", "jobs-noreply@linkedin.com"),
+    ("Medium Daily Digest", "noreply@medium.com"),
+    ("Google Calendar", "calendar-notification@google.com"),
+    ("Uber Receipts", "noreply@uber.com"),
+    ("Stripe", "receipts@stripe.com"),
+    ("Coursera", "no-reply@t.mail.coursera.org"),
+    ("Daraz", "noreply@daraz.pk"),
+]
+SUBJECTS = [
+    "Your order has shipped",
+    "Transaction alert on your account",
+    "New sign-in to your account",
+    "Weekly digest",
+    "Invitation: team sync",
+    "Your receipt",
+    "[repo] Pull request review requested",
+    "New jobs matching your profile",
+]
+SYSTEM_LABELS = ["INBOX", "SENT", "IMPORTANT", "UNREAD", "CATEGORY_UPDATES", "CATEGORY_PROMOTIONS"]
+# Every n-th message is multipart/mixed and carries a PDF attachment
+ATTACHMENT_EVERY = 7
+# Time between two consecutive messages of the synthetic mailbox, newest first
+MESSAGE_INTERVAL = timedelta(minutes=17)
+
+class MockGmail:
+    def __init__(self, size: int = 1000, latency: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 0.0, seed: int = 0):
+        """
+            size messages, each HTTP request delayed by latency seconds.
+            throttle_rate is the share of requests answered with 429 (and Retry-After
+            when retry_after is set), so the client's retry and backoff paths are exercised
+        """
+        self.size = size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.__random = random.Random(seed)
+        self.__seed = seed
+        self.__started = datetime(2025, 1, 1, tzinfo=UTC)
+        self.__user_labels = {}
+        self.__applied = {}
+        self.__lock = threading.Lock()
+        # HTTP requests received and Gmail calls made (a batch counts once / per part)
+        self.http_requests = Counter()
+        self.calls = Counter()
+        self.throttled = 0
+
+    @property
+    def applied(self):
+        return self.__applied
+
+    def reset_counters(self):
+        self.http_requests.clear()
+        self.calls.clear()
+        self.throttled = 0
+
+    def stats(self):
+        return {
+            "http_requests": sum(self.http_requests.values()),
+            "calls": sum(self.calls.values()),
+            "throttled": self.throttled,
+            "by_method": dict(self.calls),
+            "labeled": len(self.__applied),
+        }
+
+    def __message(self, index: int, params: dict):
+        msg_id = f"{index:012x}"
+        rng = random.Random(self.__seed * 1_000_003 + index)
+        name, address = SENDERS[min(int(rng.paretovariate(1.2)) - 1, len(SENDERS) - 1)]
+        if params.get("format", [""])[0] == "full":
+            return {
+                "id": msg_id,
+                "payload": {"parts": [
+                    {"filename": "", "mimeType": "text/html", "body": {"size": 2048}},
+                    {"filename": f"statement-{index}.pdf", "mimeType": "application/pdf", "body": {"size": 48213}},
+                ]}
+            }
+        date = self.__started - MESSAGE_INTERVAL * index
+        return {
+            "id": msg_id,
+            "threadId": f"{index // 3:012x}",
+            "labelIds": ["INBOX"] + sorted(self.__applied.get(msg_id, ())),
+            "snippet": f"{rng.choice(SUBJECTS)} — message {index} in the synthetic mailbox",
+            "historyId": str(100000 + self.size - index),
+            "payload": {
+                "mimeType": "multipart/mixed" if index % ATTACHMENT_EVERY == 0 else "text/html",
+                "headers": [
+                    {"name": "Subject", "value": rng.choice(SUBJECTS)},
+                    {"name": "From", "value": f'"{name}" <{address}>'},
+                    {"name": "Date", "value": format_datetime(date)},
+                ]
+            }
+        }
+
+    def __query_range(self, query: str):
+        """
+            Index range [first, last) of the messages matching the after:/before: dates
+            (YYYY/MM/DD) in query; message i is dated MESSAGE_INTERVAL * i before the start
+        """
+        first, last = 0, self.size
+        for operator, value in re.findall(r"\b(after|before):(\d{4}/\d{1,2}/\d{1,2})", query):
+            bound = datetime.strptime(value, "%Y/%m/%d").replace(tzinfo=UTC)
+            steps = (self.__started - bound) / MESSAGE_INTERVAL
+            if operator == "after":
+                last = min(last, math.floor(steps) + 1)
+            else:
+                first = max(first, math.floor(steps) + 1)
+        return first, last
+
+    def __index(self, msg_id: str):
+        try:
+            index = int(msg_id, 16)
+        except ValueError:
+            return None
+        return index if 0 <= index < self.size else None
+
+    def __call(self, method: str, path: str, params: dict, body: bytes):
+        """
+            Returns (status code, JSON body) for one Gmail call
+        """
+        route = path if path == "/messages/batchModify" else re.sub(r"^/(messages|threads)/[^/]+", r"/\1/{id}", path)
+        self.calls[f"{method} {route}"] += 1
+        if path == "/labels" and method == "GET":
+            labels = [{"id": name, "name": name, "type": "system"} for name in SYSTEM_LABELS]
+            labels += [{"id": label_id, "name": name, "type": "user"} for name, label_id in self.__user_labels.items()]
+            return 200, {"labels": labels}
+        if path == "/labels" and method == "POST":
+            name = json.loads(body)["name"]
+            with self.__lock:
+                # Gmail label names are unique regardless of case
+                if any(existing.casefold() == name.casefold() for existing in self.__user_labels):
+                    return 409, {"error": {"code": 409, "message": "Label name exists or conflicts"}}
+                label_id = self.__user_labels[name] = f"Label_{len(self.__user_labels) + 1}"
+            return 200, {"id": label_id, "name": name, "type": "user"}
+        if path == "/messages" and method == "GET":
+            first, last = self.__query_range(params.get("q", [""])[0])
+            start = max(int(params.get("pageToken", ["0"])[0]), first)
+            count = int(params.get("maxResults", ["100"])[0])
+            end = min(start + count, last)
+            page = {
+                "messages": [{"id": f"{i:012x}", "threadId": f"{i // 3:012x}"} for i in range(start, end)],
+                "resultSizeEstimate": max(last - first, 0)
+            }
+            if end < last:
+                page["nextPageToken"] = str(end)
+            return 200, page
+        if path == "/messages/batchModify":
+            data = json.loads(body)
+            with self.__lock:
+                for msg_id in data["ids"]:
+                    self.__applied.setdefault(msg_id, set()).update(data.get("addLabelIds", []))
+            return 204, None
+        match = re.fullmatch(r"/threads/([^/]+)(/modify)?", path)
+        if match:
+            # Thread t holds messages 3t, 3t + 1 and 3t + 2
+            thread = self.__index(match.group(1))
+            if thread is None or thread * 3 >= self.size:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            # Oldest message first, as Gmail returns them
+            msg_ids = [f"{i:012x}" for i in reversed(range(thread * 3, min(thread * 3 + 3, self.size)))]
+            if match.group(2):
+                add_label_ids = json.loads(body).get("addLabelIds", [])
+                with self.__lock:
+                    for msg_id in msg_ids:
+                        self.__applied.setdefault(msg_id, set()).update(add_label_ids)
+            with self.__lock:
+                messages = [
+                    {"id": msg_id, "labelIds": ["INBOX"] + sorted(self.__applied.get(msg_id, ()))}
+                    for msg_id in msg_ids
+                ]
+            return 200, {"id": match.group(1), "messages": messages}
+        match = re.fullmatch(r"/messages/([^/]+)(/modify)?", path)
+        if match:
+            index = self.__index(match.group(1))
+            if index is None:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            if match.group(2):
+                with self.__lock:
+                    self.__applied.setdefault(match.group(1), set()).update(json.loads(body).get("addLabelIds", []))
+            return 200, self.__message(index, params)
+        if path == "/profile":
+            return 200, {"emailAddress": "bench@example.com", "messagesTotal": self.size, "historyId": str(100000 + self.size)}
+        if path == "/history":
+            return 200, {"historyId": str(100000 + self.size)}
+        return 404, {"error": {"code": 404, "message": f"No mock for {method} {path}"}}
+
+    def __batch(self, request: httpx.Request):
+        boundary = "mock_batch_response"
+        out = []
+        for content_id, line, part_body in re.findall(
+            r"Content-ID:\s*<([^>]+)>\s*\r?\n\r?\n([A-Z]+ \S+) HTTP/1.1\r?\n(?:[^\r\n]+\r?\n)*\r?\n((?!--)[^\r\n]+)?",
+            request.content.decode()
+        ):
+            method, target = line.split(" ", 1)
+            url = urlsplit(target)
+            status_code, body = self.__call(
+                method, url.path.split("/users/me", 1)[1], parse_qs(url.query), part_body.encode()
+            )
+            out.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status_code} OK\r\nContent-Type: application/json\r\n\r\n{json.dumps(body)}\r\n"
+            )
+        return httpx.Response(
+            200,
+            content="".join(out) + f"--{boundary}--\r\n",
+            headers={"Content-Type": f"multipart/mixed; boundary={boundary}"}
+        )
+
+    async def handler(self, request: httpx.Request):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        path = request.url.path
+        self.http_requests["batch" if path.startswith("/batch/") else request.method] += 1
+        if self.throttle_rate and self.__random.random() < self.throttle_rate:
+            self.throttled += 1
+            headers = {"Retry-After": str(self.retry_after)} if self.retry_after else {}
+            return httpx.Response(429, headers=headers, json={"error": {"code": 429, "message": "User-rate limit exceeded"}})
+        if path.startswith("/batch/"):
+            return self.__batch(request)
+        status_code, body = self.__call(
+            request.method, path.split("/users/me", 1)[1], parse_qs(request.url.query.decode()), request.content
+        )
+        return httpx.Response(status_code) if body is None else httpx.Response(status_code, json=body)
+
+    def transport(self):
+        return httpx.MockTransport(self.handler)
@@ -0,0 +1,71 @@
+"""
+    Runs api/app.py under uvicorn against a MockGmail mailbox and the fake ollama.
+    Started by bench_e2e.py in its own process, since the API and the front-end
+    helpers both import a top-level `utils` package
+"""
+import argparse
+import sys
+from collections import Counter
+
+import uvicorn
+
+import fake_ollama
+from harness import ROOT, install_settings, peak_rss_mb
+from mock_gmail import MockGmail
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--messages", type=int, default=1000)
+    parser.add_argument("--gmail-latency", type=float, default=0.02)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=0.0)
+    parser.add_argument("--quota", type=float, default=None)
+    parser.add_argument("--token-latency", type=float, default=0.005)
+    parser.add_argument("--prompt-token-latency", type=float, default=0.0002)
+    parser.add_argument("--load-latency", type=float, default=1.0)
+    parser.add_argument("--no-warmup", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    install_settings()
+    fake = fake_ollama.install(args.token_latency, args.prompt_token_latency, args.load_latency)
+    sys.path.insert(0, str(ROOT / "api"))
+    import app as api
+    api.WARM_UP_ON_START = not args.no_warmup
+
+    mock = MockGmail(args.messages, args.gmail_latency, args.throttle_rate, args.retry_after, args.seed)
+    if args.quota:
+        api.data_store = api.DataManager(mock.transport(), args.quota)
+    else:
+        api.data_store = api.DataManager(mock.transport())
+    # Stands in for a completed Google login; bench_e2e redeems it through /token
+    session_id, _ = api.data_store.sessions.start()
+    api.data_store.sessions.complete(session_id, "bench@example.com", "bench-google-token")
+
+    api_requests = Counter()
+
+    @api.app.middleware("http")
+    async def count_requests(request, call_next):
+        if not request.url.path.startswith("/__bench"):
+            api_requests[request.method] += 1
+        return await call_next(request)
+
+    @api.app.get("/__bench/stats")
+    async def bench_stats():
+        return {
+            "gmail": mock.stats(),
+            "ollama": fake.stats(),
+            "api_requests": sum(api_requests.values()),
+            "gmail_concurrency_limit": api.data_store.gmail_api.concurrency_limit,
+            "peak_rss_mb": peak_rss_mb()
+        }
+
+    @api.app.get("/__bench/session")
+    async def bench_session():
+        return {"session_id": session_id}
+
+    uvicorn.run(api.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,25 @@
-from .agent import Agent
\ No newline at end of file
+from .agent import Agent, HistoryPolicy, KEEP_ALIVE
+from .labels import LabelIndex, LABEL_MATCH_THRESHOLD, normalize_label, sanitize_label
+from .metrics import Metrics
+from .records import Attachment, Email, Label, EMAIL_FIELDS, ORJSON_AVAILABLE, dumps, loads
+from .rules import SenderRules
+from .startup import WarmUp, load_ollama
+from .threads import ThreadLabeler, group_by_thread, representative
+from .util import candidate_labels, write_atomic, TOP_K_LABELS
+
+# Names served by a submodule that is only imported when one of them is first used;
+# neighbours needs numpy, which most front-ends never touch
+_LAZY = {
+    "EmbeddingClassifier": "neighbours",
+    "VectorIndex": "neighbours",
+    "EMBED_MODEL": "neighbours",
+    "SIMILARITY_THRESHOLD": "neighbours",
+}
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+    value = getattr(importlib.import_module(f".{_LAZY[name]}", __name__), name)
+    globals()[name] = value
+    return value
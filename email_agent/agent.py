@@ -1,28 +1,330 @@
-from .system_prompt import SystemPrompts
-from .util import refine_input_prompt
-import ollama
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+from enum import Enum
+from .labels import sanitize_label, MAX_LABEL_CHARS
+from .metrics import Metrics
+from .rules import SenderRules
+from .startup import load_ollama
+from .system_prompt import SystemPrompts, FEW_SHOT_EXAMPLES
+from .util import candidate_labels, refine_input_prompt, refine_batch_prompt, TOP_K_LABELS
+
+# How long ollama keeps the model (and its prompt cache) loaded after a call
+KEEP_ALIVE = "30m"
+
+# Most tokens a single-email answer ({"label": ...}) may generate
+LABEL_MAX_TOKENS = 24
+# Tokens a batch answer may generate per email, on top of BATCH_MAX_TOKENS for the JSON around them
+BATCH_TOKENS_PER_EMAIL = 32
+BATCH_MAX_TOKENS = 16
+# Model calls per email before an unusable answer is cut to size or replaced by FALLBACK_LABEL
+LABEL_ATTEMPTS = 2
+FALLBACK_LABEL = "Other"
+# User turn closing the warm-up call; everything before it is the prefix every call starts with
+WARM_UP_PROMPT = "Reply with OK."
+
+def label_schema():
+    """
+        Structured output schema of a single-email answer: one label of at most MAX_LABEL_CHARS
+        characters. Which label to pick is left to the prompt, since any existing label is
+        also a valid new one and an enum next to a free string would not constrain anything
+    """
+    return {
+        "type": "object",
+        "properties": {"label": {"type": "string", "maxLength": MAX_LABEL_CHARS}},
+        "required": ["label"]
+    }
+
+def batch_response_schema(msg_ids: list[str]):
+    """
+        Structured output schema of a multi-email answer; IDs are limited to the batch's emails
+    """
+    return {
+        "type": "object",
+        "properties": {
+            "labels": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"enum": list(msg_ids)},
+                        "label": label_schema()["properties"]["label"]
+                    },
+                    "required": ["id", "label"]
+                }
+            }
+        },
+        "required": ["labels"]
+    }
+
+def parse_label(content: str):
+    """
+        Returns (label text, complete) from a {"label": ...} answer. An answer cut off by
+        num_predict, or one that is not JSON at all, is incomplete; whatever label text it
+        holds is still returned for the last-resort fallback
+    """
+    try:
+        answer = json.loads(content)
+    except (json.JSONDecodeError, TypeError):
+        match = re.search(r'"label"\s*:\s*"([^"]*)', content or "")
+        return (match.group(1) if match else content), False
+    if isinstance(answer, dict) and isinstance(answer.get("label"), str):
+        return answer["label"], True
+    return None, False
+
+class HistoryPolicy(Enum):
+    # System prompt and fixed few-shot examples only
+    STATELESS = 'stateless'
+    # Additionally resend the last `history_size` exchanges
+    SLIDING_WINDOW = 'sliding_window'
+    # Additionally send a one-line summary of the last `history_size` labels
+    SUMMARY = 'summary'
 
 class Agent:
-    def __init__(self, model:str = "llama3.2:1b"):
-        # Start a chat session with system prompt
+    def __init__(self, model:str = "llama3.2:1b", history_policy:HistoryPolicy = HistoryPolicy.STATELESS, history_size:int = 5, rules:SenderRules = None, batch_size:int = 8, metrics:Metrics = None, top_k_labels:int = TOP_K_LABELS, keep_alive:str = KEEP_ALIVE):
+        """
+            history_policy bounds what is resent on every call so the prompt size stays
+            flat no matter how many emails a session has processed; the history is locked, so
+            one agent can serve several classifier threads.
+            rules, when given, answers from learned sender/domain labels before calling the LLM.
+            batch_size is the number of emails packed into one request by generate_labels.
+            Each email is offered its top_k_labels best matching existing labels rather than
+            the whole catalogue, topped up with the sender's learned label and the most used
+            labels when fewer match. The system prompt and few-shot examples open every call
+            unchanged, so ollama can reuse them from its prompt cache; keep_alive keeps the
+            model loaded between calls.
+            Answers are constrained to a JSON schema (an existing label or a new one of at most
+            MAX_LABEL_CHARS), capped at LABEL_MAX_TOKENS generated tokens and sanitized; an
+            answer that is still unusable is asked for once more.
+            metrics, when given, records call latency and ollama's token counts and durations
+        """
         self.__model = model
-        self.__history = [{"role": "system", "content": SystemPrompts.EMAIL_AGENT.value}]
+        self.__top_k_labels = top_k_labels
+        self.__keep_alive = keep_alive
+        self.__metrics = metrics
+        self.__batch_size = batch_size
+        self.__rules = rules
+        self.__history_policy = history_policy
+        self.__prefix = [{"role": "system", "content": SystemPrompts.EMAIL_AGENT.value}]
+        for email_data, existing_labels, label in FEW_SHOT_EXAMPLES:
+            self.__prefix.append({"role": "user", "content": refine_input_prompt(email_data, existing_labels)})
+            self.__prefix.append({"role": "assistant", "content": json.dumps({"label": label})})
+        # Shared by the pipeline's classifier workers and by API jobs that reuse the agent
+        self.__recent = deque(maxlen=history_size)
+        # Emails per label, the candidates offered when too few labels match an email;
+        # starts from the senders the rules have learned for each label
+        self.__usage = rules.label_counts() if rules is not None else Counter()
+        self.__lock = threading.Lock()
 
-    def generate_label(self, email_data, existing_labels):
-        user_prompt = refine_input_prompt(email_data, existing_labels)
-        self.__history.append({'role': 'user', 'content': user_prompt})
+    @property
+    def model(self):
+        return self.__model
+    @property
+    def history_policy(self):
+        return self.__history_policy
+    @property
+    def rules(self):
+        return self.__rules
+    @property
+    def batch_size(self):
+        return self.__batch_size
+
+    def __build_messages(self, user_prompt):
+        messages = list(self.__prefix)
+        if self.__history_policy != HistoryPolicy.STATELESS:
+            # Snapshot, since other workers append while this prompt is built
+            with self.__lock:
+                recent = list(self.__recent)
+        if self.__history_policy == HistoryPolicy.SLIDING_WINDOW:
+            for _, past_prompt, past_label in recent:
+                messages.append({"role": "user", "content": past_prompt})
+                messages.append({"role": "assistant", "content": json.dumps({"label": past_label})})
+        elif self.__history_policy == HistoryPolicy.SUMMARY and recent:
+            summary = "; ".join(f"{sender} → {past_label}" for sender, _, past_label in recent)
+            messages.append({"role": "system", "content": f"Recently assigned labels: {summary}"})
+        messages.append({"role": "user", "content": user_prompt})
+        return messages
 
-        response = ollama.chat(
+    def __chat(self, messages, num_predict, **kwargs):
+        started = time.perf_counter() if self.__metrics is not None else None
+        response = load_ollama().chat(
             model=self.__model,
-            messages=self.__history,
+            messages=messages,
             options={
                 "temperature": 0.3,
                 "top_p": 0.95,
-                "repeat_penalty": 1.1
-            }
+                "repeat_penalty": 1.1,
+                "num_predict": num_predict
+            },
+            keep_alive=self.__keep_alive,
+            **kwargs
+        )
+        if self.__metrics is not None:
+            self.__record_usage(response, time.perf_counter() - started)
+        return response
+
+    def __record_usage(self, response, seconds):
+        metrics = self.__metrics
+        metrics.observe("llm_request_seconds", seconds, model=self.__model)
+        # ollama reports durations in nanoseconds
+        for field, name in (
+            ("load_duration", "llm_load_seconds"),
+            ("prompt_eval_duration", "llm_prompt_eval_seconds"),
+            ("eval_duration", "llm_eval_seconds"),
+        ):
+            if response.get(field) is not None:
+                metrics.observe(name, response.get(field) / 1e9, model=self.__model)
+        # Tokens served from ollama's prompt cache are not part of prompt_eval_count
+        metrics.observe("llm_prompt_tokens", response.get("prompt_eval_count") or 0, model=self.__model)
+        metrics.inc("llm_prompt_tokens_total", response.get("prompt_eval_count") or 0, model=self.__model)
+        metrics.observe("llm_output_tokens", response.get("eval_count") or 0, model=self.__model)
+        metrics.inc("llm_output_tokens_total", response.get("eval_count") or 0, model=self.__model)
+
+    def warm_up(self):
+        """
+            Loads the model with a one-token call that opens with the same system prompt and
+            few-shot examples as every labeling call, so the first email pays neither the
+            model load nor the evaluation of that prefix
+        """
+        self.__chat(self.__prefix + [{"role": "user", "content": WARM_UP_PROMPT}], 1)
+
+    def __remember(self, email_data, user_prompt, label):
+        with self.__lock:
+            self.__usage[label] += 1
+            # Keep the exchange around for the bounded history policies
+            if self.__history_policy != HistoryPolicy.STATELESS:
+                self.__recent.append((email_data.sender, user_prompt, label))
+        if self.__rules is not None:
+            self.__rules.learn(email_data, label)
+
+    def __count_rule_hits(self, labels):
+        with self.__lock:
+            self.__usage.update(labels)
+        if self.__metrics is not None and labels:
+            self.__metrics.inc("labels_total", len(labels), source="rules")
+
+    def __popular_labels(self):
+        with self.__lock:
+            return [label for label, _ in self.__usage.most_common()]
+
+    def __candidates(self, email_data, existing_labels, popular):
+        suggested = self.__rules.suggest(email_data) if self.__rules is not None else None
+        fallback = [suggested, *popular] if suggested is not None else popular
+        return candidate_labels(email_data, existing_labels, self.__top_k_labels, fallback)
+
+    def __ask(self, email_data, existing_labels, popular=None):
+        candidates = self.__candidates(email_data, existing_labels, self.__popular_labels() if popular is None else popular)
+        user_prompt = refine_input_prompt(email_data, candidates)
+        messages = self.__build_messages(user_prompt)
+        label = text = None
+        for attempt in range(LABEL_ATTEMPTS):
+            if attempt and self.__metrics is not None:
+                self.__metrics.inc("llm_retries_total", model=self.__model)
+            response = self.__chat(messages, LABEL_MAX_TOKENS, format=label_schema())
+            text, complete = parse_label(response['message']['content'])
+            label = sanitize_label(text) if complete else None
+            if label is not None:
+                break
+        source = "llm"
+        if label is None:
+            label = sanitize_label(text, truncate=True)
+            source = "fallback"
+            if label is None:
+                label = FALLBACK_LABEL
+        else:
+            # A fallback is only good enough for this email, never a rule or history entry
+            self.__remember(email_data, user_prompt, label)
+        if self.__metrics is not None:
+            self.__metrics.inc("labels_total", source=source)
+        return label, source
+
+    def generate_label(self, email_data, existing_labels):
+        if self.__rules is not None:
+            label = self.__rules.lookup(email_data)
+            if label is not None:
+                self.__count_rule_hits([label])
+                return label
+        return self.__ask(email_data, existing_labels)[0]
+
+    def generate_labels(self, emails, existing_labels, batch_size:int = None):
+        """
+            Labels many emails with one ollama call per batch_size emails.
+            Returns {email id: label}; entries missing or malformed in a batch
+            response fall back to single-email calls
+        """
+        labels = {}
+        pending = []
+        for email_data in emails:
+            label = self.__rules.lookup(email_data) if self.__rules is not None else None
+            if label is not None:
+                labels[email_data.id] = label
+            else:
+                pending.append(email_data)
+        self.__count_rule_hits(list(labels.values()))
+        labels.update(self.ask_labels(pending, existing_labels, batch_size))
+        return labels
+
+    def ask_labels(self, emails, existing_labels, batch_size:int = None, fallbacks:set = None):
+        """
+            generate_labels without the sender rules: every email goes to the LLM.
+            IDs of emails that only got a fallback label (a cut-down answer or FALLBACK_LABEL)
+            are added to fallbacks, when given, so callers do not learn from them
+        """
+        batch_size = batch_size or self.__batch_size
+        existing_labels = list(existing_labels)
+        labels = {}
+        pending = list(emails)
+        for i in range(0, len(pending), batch_size):
+            batch = pending[i:i + batch_size]
+            popular = self.__popular_labels()
+            decided = self.__ask_batch(batch, existing_labels, popular) if len(batch) > 1 else {}
+            for email_data in batch:
+                label = decided.get(email_data.id)
+                if label is None:
+                    label, source = self.__ask(email_data, existing_labels, popular)
+                    if source == "fallback" and fallbacks is not None:
+                        fallbacks.add(email_data.id)
+                labels[email_data.id] = label
+        return labels
+
+    def __ask_batch(self, batch, existing_labels, popular):
+        candidates = {
+            email_data.id: self.__candidates(email_data, existing_labels, popular)
+            for email_data in batch
+        }
+        offered = sorted({label for labels in candidates.values() for label in labels})
+        user_prompt = refine_batch_prompt(batch, offered)
+        response = self.__chat(
+            [
+                {"role": "system", "content": SystemPrompts.EMAIL_AGENT.value},
+                {"role": "user", "content": user_prompt}
+            ],
+            BATCH_TOKENS_PER_EMAIL * len(batch) + BATCH_MAX_TOKENS,
+            format=batch_response_schema(candidates.keys())
         )
+        try:
+            entries = json.loads(response['message']['content'])
+        except (json.JSONDecodeError, TypeError):
+            return {}
+        if isinstance(entries, dict):
+            entries = entries.get("labels", [])
+        if not isinstance(entries, list):
+            return {}
 
-        label = response['message']['content'].strip()
-        # Add assistant reply to history (for continuity)
-        self.__history.append({"role": "assistant", "content": label})
-        return label
\ No newline at end of file
+        by_id = {email_data.id: email_data for email_data in batch}
+        decided = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                continue
+            msg_id, label = str(entry.get("id", "")), entry.get("label")
+            label = sanitize_label(label) if isinstance(label, str) else None
+            # Unusable entries are left to the single-email path, which retries
+            if msg_id not in by_id or msg_id in decided or label is None:
+                continue
+            decided[msg_id] = label
+            self.__remember(by_id[msg_id], refine_input_prompt(by_id[msg_id], candidates[msg_id]), decided[msg_id])
+        if self.__metrics is not None and decided:
+            self.__metrics.inc("labels_total", len(decided), source="llm_batch")
+        return decided
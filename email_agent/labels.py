@@ -0,0 +1,183 @@
+import re
+import threading
+import unicodedata
+
+# Minimum similarity (0-1) between normalized names for a generated label to reuse an existing one,
+# measured as 1 - edit distance / length of the longer name, so 0.85 allows one typo per ~7
+# characters; 1.0 only merges names that differ in case, whitespace or punctuation
+LABEL_MATCH_THRESHOLD = 0.85
+# Leading characters of the normalized names a fuzzy match must share; different words that
+# are one or two edits apart ("shipping" / "shopping", "voices" / "invoices") rarely do
+LABEL_MATCH_PREFIX = 3
+# Longest label the agent accepts, in words and in characters
+MAX_LABEL_WORDS = 3
+MAX_LABEL_CHARS = 40
+# Characters a label may contain besides letters, digits and spaces
+LABEL_PUNCTUATION = "&'.+-"
+
+def normalize_label(name: str):
+    """
+        Case, whitespace and punctuation-insensitive key, e.g. "Open CV" / "openCV" / "open-cv" → "opencv"
+    """
+    return re.sub(r"[\W_]+", "", unicodedata.normalize("NFKC", name or "").casefold())
+
+def sanitize_label(text: str, truncate: bool = False):
+    """
+        Cleans a generated label: drops quotes, markdown and any characters outside letters,
+        digits, spaces and LABEL_PUNCTUATION, and collapses whitespace. Returns None when
+        nothing is left or the label is longer than MAX_LABEL_WORDS words or MAX_LABEL_CHARS
+        characters, unless truncate, which cuts it down to size instead
+    """
+    text = unicodedata.normalize("NFKC", text or "").strip().splitlines()
+    if not text:
+        return None
+    # Anything outside the allowed set becomes a space, including "/", which Gmail reads as nesting
+    label = "".join(
+        char if char.isalnum() or char in LABEL_PUNCTUATION else " "
+        for char in text[0]
+    )
+    words = label.split()
+    # Strip punctuation left dangling at either end, e.g. a trailing "." or a "- " bullet
+    while words and not any(char.isalnum() for char in words[0]):
+        words.pop(0)
+    while words and not any(char.isalnum() for char in words[-1]):
+        words.pop()
+    if not words:
+        return None
+    if len(words) > MAX_LABEL_WORDS:
+        if not truncate:
+            return None
+        words = words[:MAX_LABEL_WORDS]
+    # Trailing "+" is kept for names like "C++"
+    label = " ".join(words).strip(".'&- ") or None
+    if label is not None and len(label) > MAX_LABEL_CHARS:
+        if not truncate:
+            return None
+        label = label[:MAX_LABEL_CHARS].rstrip(".'&- ")
+    return label
+
+def edit_distance(a: str, b: str, limit: int):
+    """
+        Levenshtein distance between a and b, or limit + 1 once it is certain to exceed limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+class LabelIndex:
+    def __init__(self, label_dict: dict[str, str] = None, threshold: float = LABEL_MATCH_THRESHOLD):
+        """
+            Label name → label ID catalogue that resolves generated names to existing labels,
+            first by normalized name and then by fuzzy similarity of at least threshold
+            between names that start with the same LABEL_MATCH_PREFIX characters.
+            Safe to share between threads: names already resolved are looked up without
+            the lock, anything else waits for concurrent add calls
+        """
+        self.__threshold = threshold
+        self.__lock = threading.RLock()
+        self.__ids = {}
+        self.__names = {}
+        self.__by_key = {}
+        # Normalized names by their first LABEL_MATCH_PREFIX characters, the fuzzy candidates
+        self.__by_prefix = {}
+        # Generated name → existing label it resolved to, and names that matched nothing
+        # (forgotten whenever a label is added)
+        self.__resolved = {}
+        self.__unmatched = set()
+        for name, label_id in (label_dict or {}).items():
+            self.add(name, label_id)
+
+    @property
+    def threshold(self):
+        return self.__threshold
+
+    def __len__(self):
+        return len(self.__ids)
+
+    def names(self):
+        with self.__lock:
+            return list(self.__ids.keys())
+
+    def ids(self):
+        with self.__lock:
+            return set(self.__ids.values())
+
+    def name_of(self, label_id: str):
+        """
+            Name of the label with ID label_id, or None
+        """
+        return self.__names.get(label_id)
+
+    def get(self, name: str):
+        """
+            ID of the existing label name resolves to, or None
+        """
+        with self.__lock:
+            existing = self.resolve(name)
+            return self.__ids[existing] if existing is not None else None
+
+    def add(self, name: str, label_id: str):
+        with self.__lock:
+            self.__ids[name] = label_id
+            self.__names.setdefault(label_id, name)
+            key = normalize_label(name)
+            if key not in self.__by_key:
+                self.__by_key[key] = name
+                self.__by_prefix.setdefault(key[:LABEL_MATCH_PREFIX], []).append(key)
+            self.__unmatched.clear()
+
+    def resolve(self, name: str):
+        """
+            Name of the existing label that name refers to, or None if it is a new label
+
+            >>> index = LabelIndex({"OpenCV": "1", "Receipts": "2", "Newsletters": "3"})
+            >>> index.resolve("Open CV"), index.resolve("openCV"), index.resolve("Receipt"), index.resolve("Newsleters")
+            ('OpenCV', 'OpenCV', 'Receipts', 'Newsletters')
+            >>> index = LabelIndex({"Shopping": "1", "Invoices": "2", "Coursera": "3"})
+            >>> index.resolve("Shipping"), index.resolve("Voices"), index.resolve("Course")
+            (None, None, None)
+        """
+        # Single dict lookup, atomic without the lock; resolved names never change
+        existing = self.__resolved.get(name)
+        if existing is not None:
+            return existing
+        with self.__lock:
+            return self.__resolve(name)
+
+    def __resolve(self, name: str):
+        if name in self.__unmatched:
+            return None
+        key = normalize_label(name)
+        if not key:
+            return None
+        existing = self.__by_key.get(key)
+        if existing is None and self.__threshold < 1.0:
+            existing = self.__closest(key)
+        if existing is not None:
+            self.__resolved[name] = existing
+        else:
+            self.__unmatched.add(name)
+        return existing
+
+    def __closest(self, key: str):
+        best, best_distance = None, None
+        for candidate in self.__by_prefix.get(key[:LABEL_MATCH_PREFIX], ()):
+            # Most edits the threshold allows between names this long; the epsilon absorbs
+            # float error, e.g. 0.15 * 20 = 2.9999...
+            limit = int((1 - self.__threshold) * max(len(key), len(candidate)) + 1e-9)
+            if best_distance is not None:
+                limit = min(limit, best_distance - 1)
+            if limit < 1:
+                continue
+            distance = edit_distance(key, candidate, limit)
+            if distance <= limit:
+                best, best_distance = self.__by_key[candidate], distance
+        return best
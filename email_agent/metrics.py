@@ -0,0 +1,158 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Prefix of every exported metric name
+NAMESPACE = "email_labeler"
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Bucket upper bounds of histograms that count tokens rather than seconds
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+# name: (type, help)
+DEFINITIONS = {
+    "http_request_seconds": ("histogram", "API request latency by route"),
+    "gmail_request_seconds": ("histogram", "Gmail REST call latency by Gmail method, retries included"),
+    "gmail_requests_total": ("counter", "Gmail HTTP requests by Gmail method and status code"),
+    "gmail_retries_total": ("counter", "Gmail calls retried after a throttled or failed attempt"),
+    "gmail_quota_units_total": ("counter", "Gmail quota units spent by Gmail method"),
+    "api_call_seconds": ("histogram", "Front-end GmailClient calls to the API by endpoint"),
+    "stage_seconds": ("histogram", "Labeling stage latency (list, fetch, classify, create_label, apply)"),
+    "emails_total": ("counter", "Emails processed by outcome"),
+    "labels_total": ("counter", "Labels decided by source (rules, neighbour, thread, llm, llm_batch, fallback)"),
+    "escalations_total": ("counter", "Emails the embedding classifier could not match and passed to the LLM"),
+    "llm_request_seconds": ("histogram", "Wall-clock latency of ollama chat calls"),
+    "llm_load_seconds": ("histogram", "Model load time reported by ollama"),
+    "llm_prompt_eval_seconds": ("histogram", "Prompt evaluation time reported by ollama"),
+    "llm_eval_seconds": ("histogram", "Generation time reported by ollama"),
+    "llm_prompt_tokens": ("histogram", "Prompt tokens evaluated per ollama call; cached prefix tokens are not counted"),
+    "llm_prompt_tokens_total": ("counter", "Prompt tokens evaluated by ollama (prompt_eval_count)"),
+    "llm_output_tokens": ("histogram", "Tokens generated per ollama call (eval_count)"),
+    "llm_output_tokens_total": ("counter", "Tokens generated by ollama (eval_count)"),
+    "llm_retries_total": ("counter", "Single-email calls repeated because the answer was not a usable label"),
+    "llm_warmup_seconds": ("histogram", "Startup calls that load the model before the first email"),
+    "time_to_first_label_seconds": ("histogram", "Seconds from the start of a run or job to its first decided label"),
+}
+
+def _buckets(name: str):
+    return TOKEN_BUCKETS if name.endswith("_tokens") else BUCKETS
+
+def _label_key(labels: dict):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key: tuple, extra: tuple = ()):
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+def _format_value(value: float):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class Metrics:
+    def __init__(self, trace_path: str = None):
+        """
+            In-process counters and histograms rendered in the Prometheus text format.
+            Components take an optional Metrics and skip all instrumentation when it is None.
+            With trace_path, trace() appends one JSON line per event (e.g. per labeled email)
+        """
+        self.__counters = {}
+        self.__histograms = {}
+        self.__lock = threading.Lock()
+        self.__trace_path = trace_path
+        self.__trace_file = None
+
+    @property
+    def tracing(self):
+        return self.__trace_path is not None
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, _label_key(labels))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels):
+        """
+            Records value (seconds, or tokens for *_tokens histograms)
+        """
+        key = (name, _label_key(labels))
+        buckets = _buckets(name)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = [[0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def time(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def trace(self, **fields):
+        if self.__trace_path is None:
+            return
+        line = json.dumps({"ts": time.time(), **fields}, default=str)
+        with self.__lock:
+            if self.__trace_file is None:
+                self.__trace_file = open(self.__trace_path, "a", buffering=1)
+            self.__trace_file.write(line + "\n")
+
+    def summary(self):
+        """
+            {metric name: {label values: count/sum/mean or counter value}}, for printing
+        """
+        with self.__lock:
+            result = {}
+            for (name, key), value in self.__counters.items():
+                result.setdefault(name, {})[", ".join(str(v) for _, v in key)] = value
+            for (name, key), (_, total, count) in self.__histograms.items():
+                result.setdefault(name, {})[", ".join(str(v) for _, v in key)] = {
+                    "count": count, "sum": total, "mean": total / count if count else 0.0
+                }
+        return result
+
+    def render(self):
+        with self.__lock:
+            counters = dict(self.__counters)
+            histograms = {key: (list(buckets), total, count) for key, (buckets, total, count) in self.__histograms.items()}
+
+        lines = []
+        for name, (kind, help_text) in DEFINITIONS.items():
+            full_name = f"{NAMESPACE}_{name}"
+            if kind == "counter":
+                series = sorted((key, value) for (metric, key), value in counters.items() if metric == name)
+            else:
+                series = sorted((key, value) for (metric, key), value in histograms.items() if metric == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for key, value in series:
+                if kind == "counter":
+                    lines.append(f"{full_name}{_format_labels(key)} {_format_value(value)}")
+                    continue
+                buckets, total, count = value
+                for bound, bucket_count in zip(_buckets(name), buckets):
+                    lines.append(f"{full_name}_bucket{_format_labels(key, (('le', repr(bound)),))} {bucket_count}")
+                lines.append(f"{full_name}_bucket{_format_labels(key, (('le', '+Inf'),))} {count}")
+                lines.append(f"{full_name}_sum{_format_labels(key)} {_format_value(total)}")
+                lines.append(f"{full_name}_count{_format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+    def close(self):
+        with self.__lock:
+            if self.__trace_file is not None:
+                self.__trace_file.close()
+                self.__trace_file = None
@@ -0,0 +1,216 @@
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from .agent import Agent, KEEP_ALIVE
+from .metrics import Metrics
+from .startup import load_ollama
+from .records import Email
+from .util import write_atomic
+
+# ollama embedding model used to place emails in vector space
+EMBED_MODEL = "nomic-embed-text"
+# Minimum cosine similarity to the nearest labeled email for its label to be reused
+SIMILARITY_THRESHOLD = 0.9
+# Rows the memory-mapped index starts with; it doubles whenever it fills up
+INITIAL_CAPACITY = 1024
+
+def embedding_text(email_data: Email):
+    """
+        What an email is embedded as: sender first, since it says the most about the label
+    """
+    return f"From: {email_data.sender}\nSubject: {email_data.subject}\n{email_data.snippet}"
+
+class VectorIndex:
+    def __init__(self, path: str = "label_index", model: str = EMBED_MODEL):
+        """
+            Unit-length email vectors and their labels. Vectors live in a memory-mapped
+            `<path>.npy` so the index is not loaded into memory up front; labels are appended
+            to `<path>.labels`, one JSON string per line, and the model and row count are kept
+            in `<path>.json`, so an add writes only what it adds. An index built with a
+            different model is discarded
+        """
+        self.__vectors_path = Path(f"{path}.npy")
+        self.__labels_path = Path(f"{path}.labels")
+        self.__meta_path = Path(f"{path}.json")
+        self.__model = model
+        self.__vectors = None
+        self.__labels = []
+        self.__lock = threading.Lock()
+        if self.__meta_path.exists() and self.__vectors_path.exists():
+            meta = json.loads(self.__meta_path.read_text())
+            if meta.get("model") == model:
+                self.__vectors = np.load(self.__vectors_path, mmap_mode="r+")
+                self.__labels = self.__load_labels(meta)
+
+    def __len__(self):
+        return len(self.__labels)
+
+    def search(self, queries: np.ndarray):
+        """
+            For each row of queries, returns (label of the nearest vector, cosine similarity);
+            (None, 0.0) while the index is empty
+        """
+        with self.__lock:
+            count = len(self.__labels)
+            if not count:
+                return [(None, 0.0)] * len(queries)
+            similarities = queries @ self.__vectors[:count].T
+            nearest = similarities.argmax(axis=1)
+            return [(self.__labels[row], float(similarities[i, row])) for i, row in enumerate(nearest)]
+
+    def add(self, vectors: np.ndarray, labels: list[str]):
+        if not len(labels):
+            return
+        with self.__lock:
+            count = len(self.__labels)
+            self.__reserve(count + len(labels), vectors.shape[1])
+            self.__vectors[count:count + len(labels)] = vectors
+            self.__vectors.flush()
+            # The count is saved last, so labels of an add that did not finish are ignored
+            with open(self.__labels_path, "a" if count else "w", encoding="utf-8") as f:
+                f.write("".join(json.dumps(label) + "\n" for label in labels))
+            self.__labels.extend(labels)
+            self.__save_meta()
+
+    def __load_labels(self, meta: dict):
+        count = meta["count"]
+        if not self.__labels_path.exists():
+            return []
+        labels = []
+        with open(self.__labels_path, "rb+") as f:
+            while len(labels) < count:
+                line = f.readline()
+                if not line:
+                    break
+                labels.append(json.loads(line))
+            # Drop anything past the saved count before the next add appends to it
+            f.truncate(f.tell())
+        return labels
+
+    def __reserve(self, rows: int, dim: int):
+        if self.__vectors is not None and self.__vectors.shape[0] >= rows:
+            return
+        capacity = max(INITIAL_CAPACITY, self.__vectors.shape[0] if self.__vectors is not None else 0)
+        while capacity < rows:
+            capacity *= 2
+        # Grow into a new file and swap it in, so a crash never leaves a half-copied index
+        tmp_path = self.__vectors_path.with_suffix(".tmp.npy")
+        grown = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(capacity, dim))
+        if self.__vectors is not None:
+            grown[:len(self.__labels)] = self.__vectors[:len(self.__labels)]
+        grown.flush()
+        del grown
+        self.__vectors = None
+        os.replace(tmp_path, self.__vectors_path)
+        self.__vectors = np.load(self.__vectors_path, mmap_mode="r+")
+
+    def __save_meta(self):
+        write_atomic(self.__meta_path, json.dumps({"model": self.__model, "count": len(self.__labels)}))
+
+
+class EmbeddingClassifier:
+    def __init__(self, agent: Agent, index_path: str = "label_index", embed_model: str = EMBED_MODEL, threshold: float = SIMILARITY_THRESHOLD, metrics: Metrics = None, keep_alive: str = KEEP_ALIVE):
+        """
+            Labels an email with the label of the most similar email labeled before, and only
+            escalates to agent (the LLM) when nothing in the index is at least threshold similar.
+            LLM decisions are added to the index, so escalations drop as it fills up;
+            fallback labels given to unusable answers are not.
+            Drop-in replacement for Agent in the labeling pipeline.
+            keep_alive keeps the embedding model loaded between calls
+        """
+        self.__agent = agent
+        self.__keep_alive = keep_alive
+        self.__embed_model = embed_model
+        self.__threshold = threshold
+        self.__metrics = metrics
+        self.__index = VectorIndex(index_path, embed_model)
+        self.__classified = 0
+        self.__escalated = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def model(self):
+        return self.__agent.model
+    @property
+    def rules(self):
+        return self.__agent.rules
+    @property
+    def batch_size(self):
+        return self.__agent.batch_size
+    @property
+    def index(self):
+        return self.__index
+    @property
+    def escalated(self):
+        return self.__escalated
+    @property
+    def escalation_rate(self):
+        return self.__escalated / self.__classified if self.__classified else 0.0
+
+    def __embed(self, emails):
+        # One embedding request for the whole batch
+        response = load_ollama().embed(
+            model=self.__embed_model,
+            input=[embedding_text(email_data) for email_data in emails],
+            keep_alive=self.__keep_alive
+        )
+        vectors = np.asarray(response["embeddings"], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms == 0, 1, norms)
+
+    def warm_up(self):
+        """
+            Loads the embedding model with a one-word request, then warms the agent's model
+        """
+        load_ollama().embed(model=self.__embed_model, input=["warm-up"], keep_alive=self.__keep_alive)
+        self.__agent.warm_up()
+
+    def generate_label(self, email_data, existing_labels):
+        return self.generate_labels([email_data], existing_labels)[email_data.id]
+
+    def generate_labels(self, emails, existing_labels, batch_size:int = None):
+        """
+            Returns {email id: label}, like Agent.generate_labels
+        """
+        rules = self.__agent.rules
+        labels = {}
+        pending = []
+        for email_data in emails:
+            label = rules.lookup(email_data) if rules is not None else None
+            if label is not None:
+                labels[email_data.id] = label
+            else:
+                pending.append(email_data)
+        if self.__metrics is not None and labels:
+            self.__metrics.inc("labels_total", len(labels), source="rules")
+        if not pending:
+            return labels
+
+        vectors = self.__embed(pending)
+        escalate, escalate_rows = [], []
+        for row, (email_data, (label, similarity)) in enumerate(zip(pending, self.__index.search(vectors))):
+            if label is not None and similarity >= self.__threshold:
+                labels[email_data.id] = label
+            else:
+                escalate.append(email_data)
+                escalate_rows.append(row)
+
+        if escalate:
+            fallbacks = set()
+            decided = self.__agent.ask_labels(escalate, existing_labels, batch_size, fallbacks)
+            labels.update(decided)
+            # Fallback labels would otherwise be handed on to every similar email
+            learned = [(row, email_data) for row, email_data in zip(escalate_rows, escalate) if email_data.id not in fallbacks]
+            self.__index.add(vectors[[row for row, _ in learned]], [decided[email_data.id] for _, email_data in learned])
+
+        with self.__lock:
+            self.__classified += len(pending)
+            self.__escalated += len(escalate)
+        if self.__metrics is not None:
+            self.__metrics.inc("labels_total", len(pending) - len(escalate), source="neighbour")
+            self.__metrics.inc("escalations_total", len(escalate))
+        return labels
@@ -0,0 +1,86 @@
+import json
+from dataclasses import dataclass, field, fields
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+@dataclass(slots=True)
+class Attachment:
+    filename: str
+    mime_type: str = None
+    size: int = None
+
+    def to_row(self):
+        return (self.filename, self.mime_type, self.size)
+
+@dataclass(slots=True)
+class Email:
+    """
+        One message as the API serves it and the agent labels it. Only the metadata the
+        labeler reads is kept: headers, label IDs, Gmail's snippet and attachment names.
+        On the wire an email is a compact row, its field values in EMAIL_FIELDS order,
+        with attachments as [filename, mime_type, size] rows
+    """
+    id: str
+    thread_id: str = None
+    subject: str = "No Subject"
+    sender: str = "Unknown Sender"
+    date: str = "Unknown Date"
+    labels: list[str] = field(default_factory=list)
+    snippet: str = ""
+    attachments: list[Attachment] = field(default_factory=list)
+
+    def to_row(self):
+        return (self.id, self.thread_id, self.subject, self.sender, self.date, self.labels, self.snippet, self.attachments)
+
+    @classmethod
+    def from_row(cls, row: list):
+        email = cls(*row)
+        if email.attachments:
+            email.attachments = [Attachment(*attachment) for attachment in email.attachments]
+        return email
+
+@dataclass(slots=True)
+class Label:
+    id: str
+    name: str
+    type: str = None
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(data["id"], data["name"], data.get("type"))
+
+# Order of the values in an email row and an attachment row
+EMAIL_FIELDS = tuple(f.name for f in fields(Email))
+ATTACHMENT_FIELDS = tuple(f.name for f in fields(Attachment))
+
+if ORJSON_AVAILABLE:
+    # Hands dataclasses to _default instead of serializing them as objects
+    _ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATACLASS
+
+def _default(obj):
+    if isinstance(obj, (Email, Attachment)):
+        return obj.to_row()
+    if isinstance(obj, Label):
+        return {"id": obj.id, "name": obj.name, "type": obj.type}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def dumps(obj):
+    """
+        UTF-8 JSON bytes of obj, which may hold Email, Attachment and Label records;
+        uses orjson when it is installed
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, default=_default, option=_ORJSON_OPTIONS)
+    return json.dumps(obj, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+def loads(data):
+    """
+        Parses JSON bytes or str into plain lists and dicts; emails are rebuilt with Email.from_row
+    """
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
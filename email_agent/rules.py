@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+from collections import Counter
+from email.utils import parseaddr
+from pathlib import Path
+
+from .records import Email
+from .util import write_atomic
+
+# Mailbox providers shared by unrelated senders; only full addresses are learned for these
+PUBLIC_MAIL_DOMAINS = frozenset({
+    "gmail.com", "googlemail.com", "outlook.com", "hotmail.com", "live.com",
+    "msn.com", "yahoo.com", "ymail.com", "icloud.com", "me.com", "aol.com",
+    "proton.me", "protonmail.com", "gmx.com", "zoho.com", "yandex.com"
+})
+# Second-level names under country code TLDs, e.g. example.co.uk or example.com.pk
+COUNTRY_SECOND_LEVEL = frozenset({"co", "com", "org", "net", "gov", "edu", "ac"})
+# Fewest seconds between autosaves; rules learned in between are written by the next
+# autosave or by flush, which runs at the end of every pipeline run and API job
+AUTOSAVE_INTERVAL = 5.0
+
+class SenderRules:
+    def __init__(self, path: str = "sender_rules.json", autosave: bool = True):
+        """
+            Learned sender address / domain → label mapping consulted before the LLM.
+            The mapping is persisted as JSON at path. With autosave, a decision that changes
+            it is written at most every AUTOSAVE_INTERVAL seconds; call flush once a run is
+            done to write the rest
+        """
+        self.__path = Path(path)
+        self.__autosave = autosave
+        self.__dirty = False
+        self.__saved_at = time.monotonic()
+        self.__addresses = {}
+        self.__domains = {}
+        self.__hits = 0
+        self.__misses = 0
+        # Lookups, updates and saves may come from several classifier workers
+        self.__lock = threading.Lock()
+        if self.__path.exists():
+            data = json.loads(self.__path.read_text())
+            self.__addresses = data.get("addresses", {})
+            self.__domains = data.get("domains", {})
+
+    @property
+    def hits(self):
+        return self.__hits
+    @property
+    def misses(self):
+        return self.__misses
+    @property
+    def hit_rate(self):
+        total = self.__hits + self.__misses
+        return self.__hits / total if total else 0.0
+
+    @staticmethod
+    def parse_sender(from_header: str):
+        """
+            Returns (address, organisation domain) for a From header, e.g.
+            '"Lenovo" <noreply@mail.lenovo.com>' → ('noreply@mail.lenovo.com', 'lenovo.com')
+        """
+        _, address = parseaddr(from_header or "")
+        address = address.lower()
+        if "@" not in address:
+            return None, None
+        parts = address.rsplit("@", 1)[1].split(".")
+        keep = 3 if len(parts) > 2 and len(parts[-1]) == 2 and parts[-2] in COUNTRY_SECOND_LEVEL else 2
+        return address, ".".join(parts[-keep:])
+
+    def lookup(self, email_data: Email):
+        address, domain = self.parse_sender(email_data.sender)
+        with self.__lock:
+            label = self.__addresses.get(address)
+            if label is None and domain not in PUBLIC_MAIL_DOMAINS:
+                label = self.__domains.get(domain)
+            if label is None:
+                self.__misses += 1
+            else:
+                self.__hits += 1
+        return label
+
+    def suggest(self, email_data: Email):
+        """
+            The label lookup would return, without counting a hit or miss
+        """
+        address, domain = self.parse_sender(email_data.sender)
+        with self.__lock:
+            label = self.__addresses.get(address)
+            if label is None and domain not in PUBLIC_MAIL_DOMAINS:
+                label = self.__domains.get(domain)
+        return label
+
+    def label_counts(self):
+        """
+            Number of learned sender addresses per label
+        """
+        with self.__lock:
+            return Counter(self.__addresses.values())
+
+    def learn(self, email_data: Email, label: str):
+        address, domain = self.parse_sender(email_data.sender)
+        if not address or not label:
+            return
+        with self.__lock:
+            if self.__addresses.get(address) != label:
+                self.__addresses[address] = label
+                self.__dirty = True
+            if domain not in PUBLIC_MAIL_DOMAINS and self.__domains.get(domain) != label:
+                self.__domains[domain] = label
+                self.__dirty = True
+            due = self.__autosave and self.__dirty and time.monotonic() - self.__saved_at >= AUTOSAVE_INTERVAL
+        if due:
+            self.save()
+
+    def flush(self):
+        """
+            Saves the mapping if a rule changed since it was last saved
+        """
+        if self.__dirty:
+            self.save()
+
+    def save(self, merge: bool = False):
+        """
+            With merge, rules another process saved to the same file since it was loaded are
+            kept, and this instance's rules win where both have one. The caller serialises
+            merging saves across processes
+        """
+        with self.__lock:
+            if merge and self.__path.exists():
+                data = json.loads(self.__path.read_text())
+                self.__addresses = {**data.get("addresses", {}), **self.__addresses}
+                self.__domains = {**data.get("domains", {}), **self.__domains}
+            write_atomic(self.__path, json.dumps(
+                {"addresses": self.__addresses, "domains": self.__domains},
+                indent=2
+            ))
+            self.__dirty = False
+            self.__saved_at = time.monotonic()
@@ -0,0 +1,56 @@
+import threading
+import time
+
+from .metrics import Metrics
+
+def load_ollama():
+    """
+        The ollama module, imported on first use: it brings in httpx and pydantic, which
+        front-ends that never call a model should not pay for at startup
+    """
+    import ollama
+    return ollama
+
+class WarmUp:
+    def __init__(self, labeler, metrics: Metrics = None):
+        """
+            Runs labeler.warm_up() (Agent, EmbeddingClassifier or ThreadLabeler) on a daemon
+            thread, so the model loads while the caller does something else, e.g. waits for
+            the Google login or lists the first page. A failed warm-up (no ollama server,
+            unknown model) is only kept in error; the first real call raises it again.
+            metrics, when given, records the warm-up as llm_warmup_seconds
+        """
+        self.__labeler = labeler
+        self.__metrics = metrics
+        self.__seconds = None
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, name="warm-up", daemon=True)
+
+    @property
+    def seconds(self):
+        return self.__seconds
+    @property
+    def error(self):
+        return self.__error
+
+    def start(self):
+        self.__thread.start()
+        return self
+
+    def wait(self, timeout: float = None):
+        """
+            Seconds the warm-up took, or None if it failed or is still running after timeout
+        """
+        self.__thread.join(timeout)
+        return self.__seconds
+
+    def __run(self):
+        started = time.perf_counter()
+        try:
+            self.__labeler.warm_up()
+        except Exception as e:
+            self.__error = e
+            return
+        self.__seconds = time.perf_counter() - started
+        if self.__metrics is not None:
+            self.__metrics.observe("llm_warmup_seconds", self.__seconds, model=self.__labeler.model)
@@ -1,12 +1,15 @@
 from enum import Enum
 
+from .records import Attachment, Email
+
 class SystemPrompts(Enum):
     EMAIL_AGENT="""
 You are an **intelligent email categorizer**.
 Your job is to **assign exactly ONE label** to each email based on its metadata.
 
 ### Rules for Labeling:
-1. **Always return only the label** (no explanations, no extra words).
+1. **Always answer with JSON only**, in the form {"label": "<Label>"} (no explanations, no extra words).
+   * Reuse one of the existing labels when it fits; otherwise give a new one.
 
 2. **Organization First Rule**:
    * If the subject contains an organization name → **use it as the label**.
@@ -38,7 +41,9 @@ Your job is to **assign exactly ONE label** to each email based on its metadata.
 }
 ```
 Output:
-Onic
+```json
+{"label": "Onic"}
+```
 
 * Input:
 ```json
@@ -48,7 +53,9 @@ Onic
 }
 ```
 Output:
-Lenovo
+```json
+{"label": "Lenovo"}
+```
 
 * Input:
 ```json
@@ -58,5 +65,34 @@ Lenovo
 }
 ```
 Output:
-OpenCV
-"""
\ No newline at end of file
+```json
+{"label": "OpenCV"}
+```
+"""
+
+# (email_data, existing_labels, label) triples replayed as fixed user/assistant turns
+FEW_SHOT_EXAMPLES = [
+    (
+        Email(
+            id="example-1",
+            subject="Your March statement is ready",
+            sender="\"Meezan Bank\" <estatements@meezanbank.com>",
+            date="Mon, 3 Mar 2025 09:12:44 +0500",
+            snippet="Your e-statement for the month of February is now available.",
+            attachments=[Attachment("statement.pdf", "application/pdf", 84211)]
+        ),
+        ["Lenovo", "OpenCV"],
+        "Meezan Bank"
+    ),
+    (
+        Email(
+            id="example-2",
+            subject="New sign-in to your account",
+            sender="\"GitHub\" <noreply@github.com>",
+            date="Tue, 4 Mar 2025 18:40:02 +0000",
+            snippet="We noticed a new sign-in to your GitHub account."
+        ),
+        ["Lenovo", "OpenCV", "Meezan Bank"],
+        "GitHub"
+    ),
+]
@@ -0,0 +1,103 @@
+import threading
+
+from .metrics import Metrics
+
+def group_by_thread(emails):
+    """
+        {thread ID: emails of that thread, in the order given}. An email without a
+        thread_id is a thread of its own
+    """
+    threads = {}
+    for email_data in emails:
+        threads.setdefault(email_data.thread_id or email_data.id, []).append(email_data)
+    return threads
+
+def representative(messages):
+    """
+        The message a thread is classified by. Gmail lists newest first, so the last one
+        is the oldest seen: the message that started the conversation, not a short reply to it
+    """
+    return messages[-1]
+
+class ThreadLabeler:
+    def __init__(self, labeler, metrics: Metrics = None):
+        """
+            Classifies each Gmail thread once, from its representative message, and gives
+            every other message of the thread the same label. Decisions are kept for the
+            labeler's lifetime, so messages of a thread that arrive in a later batch or page
+            reuse them without a model call. labeler is an Agent or an EmbeddingClassifier;
+            like those, this is a drop-in labeler for the pipeline. Two calls that hold the same
+            undecided thread both classify it and the first decision wins, so callers with
+            several workers send each thread to one of them (see utils.ThreadRoutes)
+        """
+        self.__labeler = labeler
+        self.__metrics = metrics
+        self.__decided = {}
+        self.__reused = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def model(self):
+        return self.__labeler.model
+    @property
+    def rules(self):
+        return self.__labeler.rules
+    @property
+    def batch_size(self):
+        return self.__labeler.batch_size
+    @property
+    def labeler(self):
+        return self.__labeler
+    @property
+    def reused(self):
+        return self.__reused
+
+    def thread_label(self, thread_id: str):
+        """
+            The label decided for thread_id, or None if it has not been classified
+        """
+        return self.__decided.get(thread_id)
+
+    def assign(self, thread_id: str, label: str):
+        """
+            Gives thread_id label without classifying it, e.g. the user label one of its
+            messages already has; a label decided earlier is kept
+        """
+        with self.__lock:
+            self.__decided.setdefault(thread_id, label)
+
+    def warm_up(self):
+        self.__labeler.warm_up()
+
+    def generate_label(self, email_data, existing_labels):
+        return self.generate_labels([email_data], existing_labels)[email_data.id]
+
+    def generate_labels(self, emails, existing_labels, batch_size:int = None):
+        """
+            Returns {email id: label}, like Agent.generate_labels, with one classification per thread
+        """
+        threads = group_by_thread(emails)
+        with self.__lock:
+            pending = {
+                thread_id: representative(messages)
+                for thread_id, messages in threads.items()
+                if thread_id not in self.__decided
+            }
+        generated = self.__labeler.generate_labels(list(pending.values()), existing_labels, batch_size) if pending else {}
+
+        labels = {}
+        with self.__lock:
+            for thread_id, messages in threads.items():
+                if thread_id in pending:
+                    # A worker classifying the same thread concurrently may have decided first;
+                    # its label wins so the thread stays consistent
+                    label = self.__decided.setdefault(thread_id, generated[pending[thread_id].id])
+                else:
+                    label = self.__decided[thread_id]
+                for email_data in messages:
+                    labels[email_data.id] = label
+            reused = len(emails) - len(pending)
+            self.__reused += reused
+        if self.__metrics is not None and reused:
+            self.__metrics.inc("labels_total", reused, source="thread")
+        return labels
@@ -1,15 +1,109 @@
-def refine_input_prompt(email_data: dict, existing_labels: list[str]):
-    return f"""
-Email:
-- ID: {email_data['id']}
-- Subject: {email_data['subject']}
-- From: {email_data['from']}
-- Date: {email_data['date']}
-- Text Snipet: {email_data['snipet']}
+import functools
+import itertools
+import os
+import re
+from pathlib import Path
+
+from .labels import normalize_label
+from .records import Email
+
+# Existing labels offered to the model per email; catalogues this small or smaller are sent whole
+TOP_K_LABELS = 12
+# Words shorter than this are ignored when matching labels against an email
+MIN_TERM_LENGTH = 3
+
+def write_atomic(path: Path, text: str):
+    """
+        Replaces the file at path with text through a temporary file next to it, so an
+        interrupted run never leaves it truncated
+    """
+    path = Path(path)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    tmp_path.write_text(text, encoding="utf-8")
+    os.replace(tmp_path, path)
+
+def describe_email(email_data: Email, with_id: bool = False):
+    # The ID only matters when several emails share one prompt; it is placed last
+    # so emails that differ only in their ID share as much of the prompt as possible
+    return f"""Email:
+- Subject: {email_data.subject}
+- From: {email_data.sender}
+- Date: {email_data.date}
+- Text Snippet: {email_data.snippet}
 - Attachments: { ', '.join([
-                f"File Name: {attachment['filename']} - Mime Type: {attachment['mimeType']} - Size: {attachment['size']}"
-                for attachment in email_data["attachments"]
-            ]) if len(email_data['attachments']) > 0 else "No attachments" }
+                f"File Name: {attachment.filename} - Mime Type: {attachment.mime_type} - Size: {attachment.size}"
+                for attachment in email_data.attachments
+            ]) if email_data.attachments else "No attachments" }""" + (
+        f"\n- ID: {email_data.id}" if with_id else ""
+    )
+
+def _terms(text: str):
+    return {term for term in re.findall(r"\w+", (text or "").casefold()) if len(term) >= MIN_TERM_LENGTH}
+
+@functools.lru_cache(maxsize=4096)
+def _label_terms(label: str):
+    return normalize_label(label), frozenset(_terms(label))
+
+def candidate_labels(email_data: Email, existing_labels: list[str], k: int = TOP_K_LABELS, fallback: list[str] = ()):
+    """
+        The k existing labels most likely to fit the email, best first: labels named in the
+        sender (display name, address or domain) or subject, then labels sharing words with
+        subject and snippet. When fewer than k match, the rest are filled from fallback (e.g.
+        the sender's learned label and the most used labels, in that order) and then from the
+        catalogue in sorted order, so the model always has real labels to choose from while
+        the prompt stays the same size however large the catalogue grows
+    """
+    existing_labels = list(existing_labels)
+    if len(existing_labels) <= k:
+        # Sorted so the same catalogue always renders the same prompt
+        return sorted(existing_labels)
+
+    sender_key = normalize_label(email_data.sender)
+    subject_key = normalize_label(email_data.subject)
+    email_terms = _terms(email_data.subject) | _terms(email_data.snippet) | _terms(email_data.sender)
+    scored = []
+    for label in existing_labels:
+        key, terms = _label_terms(label)
+        score = 0.0
+        if len(key) >= MIN_TERM_LENGTH:
+            score += 3.0 if key in sender_key else 0.0
+            score += 2.0 if key in subject_key else 0.0
+        if terms:
+            # Prefix matches count, so "Receipts" matches "receipt" and "Jobs" matches "job"
+            matched = sum(
+                any(term.startswith(word) or word.startswith(term) for word in email_terms)
+                for term in terms
+            )
+            score += matched / len(terms)
+        if score > 0:
+            scored.append((-score, label))
+    candidates = [label for _, label in sorted(scored)[:k]]
+    if len(candidates) < k:
+        existing, chosen = set(existing_labels), set(candidates)
+        for label in itertools.chain(fallback, sorted(existing_labels)):
+            if len(candidates) >= k:
+                break
+            if label in existing and label not in chosen:
+                candidates.append(label)
+                chosen.add(label)
+    return candidates
+
+def refine_input_prompt(email_data: Email, existing_labels: list[str]):
+    # Fixed instructions first and the email last, so consecutive prompts share the longest prefix
+    return f"""
+Assign a Label to the email below in AT MOST 3 words, reusing an Existing Label when one fits.
+Answer with JSON ONLY, in the form {{"label": "<Label>"}}.
+Existing Labels: {", ".join(existing_labels)}
+{describe_email(email_data)}
+"""
+
+def refine_batch_prompt(emails: list[Email], existing_labels: list[str]):
+    emails_block = "\n\n".join(describe_email(email_data, with_id=True) for email_data in emails)
+    return f"""
+Assign a Label to EACH of the emails below in AT MOST 3 words per label.
+Answer with JSON ONLY, in the form {{"labels": [{{"id": "<email ID>", "label": "<Label>"}}, ...]}}, with exactly one entry per email ID.
+There are {len(emails)} emails.
 Existing Labels: {", ".join(existing_labels)}
-Assign a Label to the above email in AT MOST 3 words. Answer with the Label ALONE and NOTHING ELSE.
-"""
\ No newline at end of file
+
+{emails_block}
+"""
@@ -1,42 +1,62 @@
+import time
 import webbrowser
 import streamlit as st
 
-from email_agent import Agent
 from utils import encode_tok, GmailClient
 
 API_BASE = "http://localhost:8000"
 MAX_PAGES = 1
+# Emails listed per Gmail page (up to 500)
+PAGE_SIZE = 100
+# Model the API-side job labels emails with
+MODEL = "llama3.2:1b"
+# Number of model batches the job keeps in flight against the ollama server
+CLASSIFIER_WORKERS = 2
+# Classify each Gmail thread once and label all of its messages together
+LABEL_BY_THREAD = True
+# Seconds between job progress polls
+POLL_INTERVAL = 1.0
+# Seconds before the model is asked to warm up again; the API keeps it loaded for about as long
+WARM_UP_TTL = 600
 
 st.set_page_config(page_title="Gmail Fetcher", layout="centered")
 st.title("📧 Gmail Fetcher via FastAPI + Streamlit")
 st.markdown("Login with Google, fetch emails, and auto-label them.")
 
+@st.cache_resource
+def get_client(api_token: str):
+    """
+        One GmailClient per API token, shared by every rerun and browser tab instead of
+        built on each click, so its pooled connections to the API stay open
+    """
+    return GmailClient(API_BASE, api_token)
+
+@st.cache_resource(ttl=WARM_UP_TTL)
+def warm_up_model(api_token: str, model: str):
+    """
+        Asks the API to load the model once per token and model, before the first job needs it
+    """
+    return get_client(api_token).warm_up(model)
+
 # --- State ---
 if "api_token" not in st.session_state:
     st.session_state.api_token = None
-if "client" not in st.session_state:
-    st.session_state.client = None
-if "email_labeler" not in st.session_state:
-    st.session_state.email_labeler = None
-if "log_messages" not in st.session_state:
-    st.session_state.log_messages = []
-
-
-def log_message(msg: str):
-    """Append message to logs and refresh display."""
-    st.session_state.log_messages.append(msg)
+if "job_id" not in st.session_state:
+    st.session_state.job_id = None
+if "login_session" not in st.session_state:
+    st.session_state.login_session = None
 
 
 # --- Step 1: Login ---
 st.subheader("Step 1: Login with Google")
 if st.button("🔑 Login with Google", use_container_width=True):
-    webbrowser.open_new_tab(f"{API_BASE}/auth/login")
+    login = GmailClient.start_login(API_BASE)
+    st.session_state.login_session = login["session_id"]
+    webbrowser.open_new_tab(login["login_url"])
     st.info("A new tab has been opened for Google login. Complete the flow and return here.")
-    token_json = GmailClient.get_token(API_BASE)
+    token_json = GmailClient.get_token(API_BASE, st.session_state.login_session)
     if token_json.get("api_token"):
         st.session_state.api_token = encode_tok(token_json)
-        st.session_state.client = GmailClient(API_BASE, st.session_state.api_token)
-        st.session_state.email_labeler = Agent()
         st.success("✅ Login successful and API token saved")
     else:
         st.error("❌ Login failed. Please try again.")
@@ -45,58 +65,74 @@ if st.button("🔑 Login with Google", use_container_width=True):
 # --- Step 2: Token status ---
 st.subheader("Step 2: API Token Status")
 if st.button("Fetch existing Token", use_container_width=True):
-    token_json = GmailClient.get_token(API_BASE)
+    # Picks up a login that finished after the wait in step 1 gave up
+    token_json = GmailClient.get_token(API_BASE, st.session_state.login_session) if st.session_state.login_session else {}
     if token_json.get("api_token"):
         st.session_state.api_token = encode_tok(token_json)
-        st.session_state.client = GmailClient(API_BASE, st.session_state.api_token)
-        st.session_state.email_labeler = Agent()
         st.success("✅ API Token loaded successfully")
     else:
         st.warning("⚠️ No API token found. Please login first.")
 
-if st.session_state.api_token:
+client = get_client(st.session_state.api_token) if st.session_state.api_token else None
+if client is not None:
     st.info("🔒 API Token is active")
+    try:
+        warm_up_model(st.session_state.api_token, MODEL)
+    except Exception as e:
+        # Only a head start: the job loads the model itself if this did not
+        st.caption(f"Model warm-up failed: {e}")
 else:
     st.warning("No API token loaded. Please login first.")
 
 
-# --- Step 3: Fetch + Label ---
+# --- Step 3: Start + Poll Labeling Job ---
 st.subheader("Step 3: Label Emails")
-if st.button("📩 Fetch Emails", use_container_width=True):
-    if not st.session_state.api_token:
+by_thread = st.checkbox("Label whole conversations together", value=LABEL_BY_THREAD)
+if st.button("📩 Start Labeling", use_container_width=True):
+    if client is None:
         st.error("You need to login first.")
     else:
-        st.session_state.log_messages = []  # clear old logs
         try:
-            client = st.session_state.client
-            labeler = st.session_state.email_labeler
-
-            label_dict = client.get_labels()
-            messages = client.get_emails(MAX_PAGES)
-
-            if not messages:
-                st.warning("No emails found.")
-            else:
-                for msg in messages:
-                    # Skip if email already has a known label
-                    if any(lbl in label_dict.values() for lbl in msg.get("labels", [])):
-                        log_message(f"SKIPPED: Email {msg['id']} already labeled.")
-                        continue
-
-                    # Generate label
-                    lbl = labeler.generate_label(msg, label_dict.keys())
-                    label_id = label_dict.get(lbl)
-
-                    if label_id:
-                        client.apply_label(msg["id"], label_id)
-                        log_message(f"EMAIL assigned label: {lbl}")
-                    else:
-                        new_label_id = client.create_label(lbl)
-                        label_dict[lbl] = new_label_id
-                        client.apply_label(msg["id"], new_label_id)
-                        log_message(f"NEW label created: {lbl} → assigned to email {msg['id']}")
-
-                st.success("✅ All emails processed successfully")
-
+            job = client.start_label_job(MAX_PAGES, MODEL, CLASSIFIER_WORKERS, PAGE_SIZE, by_thread)
+            st.session_state.job_id = job["id"]
         except Exception as e:
             st.error(f"Exception: {e}")
+
+# The job runs on the API, so after a refresh pick up whichever one is still running
+if client is not None and not st.session_state.job_id:
+    try:
+        running = [job for job in client.list_jobs() if job["status"] == "running"]
+        if running:
+            st.session_state.job_id = running[-1]["id"]
+    except Exception as e:
+        st.error(f"Exception: {e}")
+
+if client is not None and st.session_state.job_id:
+    try:
+        job = client.get_job(st.session_state.job_id)
+        done = job["labeled"] + job["skipped"]
+        if job["total"]:
+            st.progress(min(done / job["total"], 1.0), text=f"{done} / {job['total']} emails")
+
+        labeled_col, skipped_col, created_col = st.columns(3)
+        labeled_col.metric("Labeled", job["labeled"])
+        skipped_col.metric("Skipped", job["skipped"])
+        created_col.metric("New labels", job["created"])
+        rate_col, first_col, eta_col = st.columns(3)
+        rate_col.metric("Emails / sec", f"{job['emails_per_second']:.2f}")
+        first_col.metric("First label", f"{job['first_label_seconds']:.1f}s" if job["first_label_seconds"] is not None else "—")
+        eta_col.metric("ETA", f"{job['eta_seconds']:.0f}s" if job["eta_seconds"] is not None else "—")
+
+        if job["status"] == "running":
+            if st.button("🛑 Cancel", use_container_width=True):
+                client.cancel_job(job["id"])
+            time.sleep(POLL_INTERVAL)
+            st.rerun()
+        elif job["status"] == "completed":
+            st.success("✅ All emails processed successfully")
+        elif job["status"] == "cancelled":
+            st.warning("Labeling job was cancelled.")
+        else:
+            st.error(f"Exception: {job['error']}")
+    except Exception as e:
+        st.error(f"Exception: {e}")
@@ -1,53 +1,242 @@
+import argparse
+import os
 import sys
-from email_agent import Agent
-from utils import encode_tok, GmailClient
+import webbrowser
+from datetime import date
+from email_agent import Agent, Metrics, SenderRules, ThreadLabeler, WarmUp
+from utils import (
+    encode_tok, date_shards, GmailClient, LabelingPipeline, MessageStore,
+    ShardCheckpoint, ShardedLabeler, SyncCheckpoint
+)
 
 API_BASE = "http://localhost:8000"
 MAX_PAGES = 1
+# Emails listed per Gmail page (up to 500)
+PAGE_SIZE = 10
+# Learned sender/domain → label mapping consulted before the LLM
+SENDER_RULES_PATH = "sender_rules.json"
+# Number of label applications sent to the API in one bulk request
+APPLY_CHUNK_SIZE = 100
+# Number of emails packed into one model call
+LABEL_BATCH_SIZE = 8
+# Number of classifier workers calling the ollama server in parallel
+CLASSIFIER_WORKERS = 2
+# Last processed Gmail history ID per account, used for incremental runs
+SYNC_CHECKPOINT_PATH = "sync_checkpoint.json"
+# Local record of processed messages and the labels decided for them
+STORE_PATH = "email_labeler.db"
+# How similar (0-1) a generated label must be to an existing one to reuse it instead of creating it
+LABEL_MATCH_THRESHOLD = 0.85
+# Memory-mapped vectors of labeled emails used by --embeddings (label_index.npy / label_index.json)
+EMBEDDING_INDEX_PATH = "label_index"
+# Cosine similarity above which --embeddings reuses the nearest labeled email's label instead of asking the LLM
+EMBEDDING_SIMILARITY_THRESHOLD = 0.9
+# --bulk: oldest date given its own shard; everything before it is one last shard
+BULK_SINCE = date(2004, 4, 1)
+# --bulk: months of mail covered by one shard
+BULK_SHARD_MONTHS = 1
+# --bulk: worker processes, each running its own pipeline over one shard at a time
+BULK_PROCESSES = os.cpu_count() or 1
+# --bulk: emails listed per Gmail page
+BULK_PAGE_SIZE = 100
+# --bulk: finished shards, so an interrupted backfill resumes with the shards still pending
+BULK_CHECKPOINT_PATH = "bulk_checkpoint.json"
+
+
+def print_breakdown(metrics: Metrics):
+    summary = metrics.summary()
+    for name, title in (
+        ("api_call_seconds", "API calls"),
+        ("stage_seconds", "Pipeline stages"),
+        ("llm_request_seconds", "LLM calls"),
+    ):
+        if name not in summary:
+            continue
+        print(f"{title}:")
+        for labels, stats in sorted(summary[name].items()):
+            print(f"  {labels:22} {stats['count']:6} × {stats['mean'] * 1000:9.1f} ms = {stats['sum']:8.2f}s")
+    for name, title in (
+        ("llm_prompt_tokens_total", "Prompt tokens"),
+        ("llm_output_tokens_total", "Output tokens"),
+        ("escalations_total", "Escalated to the LLM"),
+    ):
+        if name in summary:
+            print(f"{title}: {sum(summary[name].values()):.0f}")
+    for model, stats in sorted(summary.get("llm_prompt_tokens", {}).items()):
+        print(f"Prompt tokens per call ({model}): {stats['mean']:.0f} evaluated, cached prefix excluded")
+
+
+def print_warm_up(warm_up: WarmUp):
+    if warm_up.error is not None:
+        print(f"⚠️ Model warm-up failed: {warm_up.error}")
+    elif warm_up.seconds is not None:
+        print(f"Model warmed up in {warm_up.seconds:.2f}s")
+
+
+def run_bulk(args, api_token: str):
+    shards = date_shards(args.since, args.shard_months)
+    checkpoint = ShardCheckpoint(BULK_CHECKPOINT_PATH)
+    labeler = ShardedLabeler(
+        API_BASE,
+        api_token,
+        shards,
+        checkpoint,
+        processes=args.processes,
+        batch_size=LABEL_BATCH_SIZE,
+        workers=CLASSIFIER_WORKERS,
+        page_size=BULK_PAGE_SIZE,
+        apply_chunk_size=APPLY_CHUNK_SIZE,
+        rules_path=SENDER_RULES_PATH,
+        store_path=STORE_PATH,
+        label_threshold=LABEL_MATCH_THRESHOLD,
+        by_thread=args.threads
+    )
+    pending = sum(not checkpoint.is_done(query) for query in shards)
+    print(f"Backfilling {pending} of {len(shards)} shards with {args.processes} processes...")
+
+    def on_shard(query, stats, error):
+        if error is not None:
+            print(f"❌ {query}: {error}")
+        else:
+            print(f"{query}: {stats['labeled']} labeled, {stats['skipped']} skipped, {stats['created']} new labels in {stats['seconds']:.1f}s")
+
+    totals = labeler.run(on_shard=on_shard)
+    print(
+        f"Labeled {totals['labeled']} emails ({totals['created']} new labels, "
+        f"{totals['skipped']} skipped) across {totals['shards']} shards"
+    )
+    if totals["failed"]:
+        print(f"⚠️ {len(totals['failed'])} shards failed and will be retried on the next --bulk run")
+        sys.exit(1)
+    print("✅ Backfill complete")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Label Gmail emails from the terminal")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="scan the mailbox from the top instead of only fetching emails added since the last run"
+    )
+    parser.add_argument(
+        "--metrics",
+        action="store_true",
+        help="time every stage and print a breakdown after the run"
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="append one JSON line per labeled email to PATH (implies --metrics)"
+    )
+    parser.add_argument(
+        "--embeddings",
+        action="store_true",
+        help="label by the most similar previously labeled email and only ask the LLM when nothing is close enough"
+    )
+    parser.add_argument(
+        "--threads",
+        action="store_true",
+        help="classify each conversation once and label all of its messages with one thread-level request"
+    )
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="backfill the whole mailbox, split into date range shards labeled by several processes"
+    )
+    parser.add_argument(
+        "--since",
+        type=date.fromisoformat,
+        default=BULK_SINCE,
+        help="--bulk: date (YYYY-MM-DD) of the oldest shard boundary"
+    )
+    parser.add_argument("--shard-months", type=int, default=BULK_SHARD_MONTHS, help="--bulk: months per shard")
+    parser.add_argument("--processes", type=int, default=BULK_PROCESSES, help="--bulk: worker processes")
+    args = parser.parse_args()
+    if args.bulk and (args.embeddings or args.metrics or args.trace):
+        parser.error("--bulk cannot be combined with --embeddings, --metrics or --trace")
+    metrics = Metrics(args.trace) if args.metrics or args.trace else None
+
     print("📧 Gmail Fetcher via FastAPI (Terminal Version)")
 
+    # The model loads while the login is completed in the browser
+    if args.bulk:
+        warm_up = WarmUp(Agent()).start()
+    else:
+        labeler = Agent(rules=SenderRules(SENDER_RULES_PATH), batch_size=LABEL_BATCH_SIZE, metrics=metrics)
+        if args.embeddings:
+            # Imported here so runs without --embeddings never load numpy
+            from email_agent import EmbeddingClassifier
+            labeler = embeddings = EmbeddingClassifier(
+                labeler,
+                index_path=EMBEDDING_INDEX_PATH,
+                threshold=EMBEDDING_SIMILARITY_THRESHOLD,
+                metrics=metrics
+            )
+        if args.threads:
+            labeler = ThreadLabeler(labeler, metrics=metrics)
+        warm_up = WarmUp(labeler, metrics=metrics).start()
+
     # --- Step 1: Get API Token ---
-    print("Fetching API token...")
-    token_json = GmailClient.get_token(API_BASE)
+    login = GmailClient.start_login(API_BASE)
+    print(f"Log in with Google to continue: {login['login_url']}")
+    webbrowser.open_new_tab(login["login_url"])
+    print("Waiting for the login to finish...")
+    token_json = GmailClient.get_token(API_BASE, login["session_id"])
     if not token_json.get("api_token"):
-        print("❌ No API token found. Please login first via the FastAPI backend.")
+        print("❌ Login did not finish. Please try again.")
         sys.exit(1)
 
     api_token = encode_tok(token_json)
-    client = GmailClient(API_BASE, api_token)
-    labeler = Agent()
+    if args.bulk:
+        run_bulk(args, api_token)
+        return
+    client = GmailClient(API_BASE, api_token, metrics=metrics)
     print("✅ API Token loaded")
 
     # --- Step 2: Fetch and Label Emails ---
-    print("Fetching emails...")
-    messages = client.get_emails(MAX_PAGES)
-    if not messages:
-        print("⚠️ No emails found.")
-        return
+    print("Fetching and labeling emails...")
 
-    label_dict = client.get_labels()
-
-    for msg in messages:
-        # Skip if email already has matching label
-        if any(lbl in label_dict.values() for lbl in msg["labels"]):
-            continue
-
-        # Generate label
-        lbl = labeler.generate_label(msg, label_dict.keys())
-        label_id = label_dict.get(lbl)
-
-        if label_id:
-            client.apply_label(msg["id"], label_id)
-            print(f"Applied existing label: {lbl}")
-        else:
-            new_label_id = client.create_label(lbl)
-            label_dict[lbl] = new_label_id
-            client.apply_label(msg["id"], new_label_id)
+    def on_result(msg, lbl, created):
+        if created:
             print(f"Created and applied new label: {lbl}")
+        else:
+            print(f"Applied existing label: {lbl}")
+
+    pipeline = LabelingPipeline(
+        client,
+        labeler,
+        pages=MAX_PAGES,
+        page_size=PAGE_SIZE,
+        workers=CLASSIFIER_WORKERS,
+        apply_chunk_size=APPLY_CHUNK_SIZE,
+        checkpoint=None if args.full else SyncCheckpoint(SYNC_CHECKPOINT_PATH),
+        store=MessageStore(STORE_PATH),
+        metrics=metrics,
+        label_threshold=LABEL_MATCH_THRESHOLD,
+        by_thread=args.threads
+    )
+    stats = pipeline.run(on_result=on_result)
+    client.close()
+    if not stats["labeled"] and not stats["skipped"]:
+        print("⚠️ No emails found.")
+        return
 
+    print(
+        f"Labeled {stats['labeled']} emails ({stats['created']} new labels, "
+        f"{stats['skipped']} skipped) in {stats['seconds']:.1f}s"
+    )
+    if stats["first_label_seconds"] is not None:
+        print(f"Time to first label: {stats['first_label_seconds']:.2f}s")
+    print_warm_up(warm_up)
+    rules = labeler.rules
+    print(f"Sender rules: {rules.hits} hits / {rules.misses} misses ({rules.hit_rate:.0%} of LLM calls saved)")
+    if args.threads:
+        print(f"Threads: {stats['threads']} labeled as a whole, {stats['reused']} emails took their thread's label, {stats['kept']} kept a label they already had")
+    if args.embeddings:
+        print(f"Embeddings: {embeddings.escalated} emails escalated to the LLM ({embeddings.escalation_rate:.0%}), {len(embeddings.index)} in the index")
+    if metrics is not None:
+        print_breakdown(metrics)
+        metrics.close()
     print("✅ All emails labeled successfully")
 
 
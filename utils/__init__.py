@@ -1,58 +1,176 @@
-from jose import jwt
-
 from settings import secrets
 
 def encode_tok(token):
+    # python-jose (and the cryptography backend under it) is only needed once the login is done
+    from jose import jwt
     return jwt.encode(token, secrets['web_secrets']['jwt_secret'], algorithm='HS256')
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from email_agent import Email, Label, loads
+
+from .pipeline import LabelBatcher, LabelRegistry, LabelingPipeline, ThreadRoutes
+from .shards import date_shards, ShardCheckpoint, ShardedLabeler
+from .store import MessageStore
+from .sync import SyncCheckpoint
+
+# Keep-alive connections a GmailClient holds open to the API; should cover the
+# pipeline's classifier workers plus the thread that fetches and applies labels
+CONNECTION_POOL_SIZE = 10
 
 class GmailClient:
-    def __init__(self, api_base: str, token: str):
+    def __init__(self, api_base: str, token: str, metrics=None, pool_size: int = CONNECTION_POOL_SIZE):
+        """
+            All calls share one requests.Session, so connections to the API are reused
+            instead of opened per call.
+            metrics (email_agent.Metrics), when given, times every API call by endpoint
+        """
         self.api_base = api_base
         self.headers = {"Authorization": f"Bearer {token}"}
+        self.__metrics = metrics
+        self.__session = requests.Session()
+        self.__session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session.mount("http://", adapter)
+        self.__session.mount("https://", adapter)
+
+    def close(self):
+        self.__session.close()
+
+    @staticmethod
+    def start_login(api_base):
+        """
+            Returns {"session_id", "login_url"}; the login is finished in a browser at login_url
+        """
+        return requests.post(f"{api_base}/auth/login").json()
 
     @staticmethod
-    def get_token(api_base):
-        return requests.get(f"{api_base}/token").json()
+    def get_token(api_base, session_id):
+        """
+            Waits for the login session_id to finish and returns its API token once
+        """
+        return requests.get(f"{api_base}/token", params={"session_id": session_id}).json()
+
+    def __request(self, method: str, path: str, call: str, check: bool = True, **kwargs):
+        if self.__metrics is None:
+            r = self.__session.request(method, f"{self.api_base}{path}", **kwargs)
+        else:
+            with self.__metrics.time("api_call_seconds", call=call):
+                r = self.__session.request(method, f"{self.api_base}{path}", **kwargs)
+        if check and not r.ok:
+            # Releases the connection of a streamed response before raising
+            r.close()
+            r.raise_for_status()
+        return r
 
     def get_labels(self):
-        r = requests.get(f"{self.api_base}/labels", headers=self.headers)
-        r.raise_for_status()
-        labels = r.json().get("labels_user", [])
-        return {lbl["name"]: lbl["id"] for lbl in labels}
+        r = self.__request("GET", "/labels", "labels.list")
+        labels = map(Label.from_dict, loads(r.content).get("labels_user", []))
+        return {lbl.name: lbl.id for lbl in labels}
 
-    def get_emails(self, pages=1):
+    def iter_pages(self, pages=1, page_size=10, query=None):
+        """
+            Yields one list of Email records per API page, so callers can start working
+            on the first page before the later ones are fetched.
+            query is a Gmail search query, e.g. "after:2024/01/01 before:2024/02/01"
+        """
         pages = min(pages, 10000)
         next_page_token = True
-        params = {'pageToken': "false"}
-        mssgs = []
+        params = {'PageToken': "false", 'page_size': page_size}
+        if query:
+            params['q'] = query
         while next_page_token and pages > 0:
-            r = requests.get(
-                f"{self.api_base}/emails",
-                headers=self.headers, 
-                params=params
-            )
-            r.raise_for_status()
-            data = r.json()
-            mssgs.extend(data.get("emails", []))
+            r = self.__request("GET", "/emails", "emails.page", params=params)
+            data = loads(r.content)
+            yield [Email.from_row(row) for row in data.get("emails", [])]
             next_page_token = data.get("nextPageToken")
-            params["pageToken"] = next_page_token
+            params["PageToken"] = next_page_token
             pages -= 1
-        return mssgs
+
+    def get_emails(self, pages=1, page_size=10, query=None):
+        return [msg for page in self.iter_pages(pages, page_size, query) for msg in page]
+
+    def iter_emails(self, pages=1, page_size=10, query=None):
+        """
+            Yields Email records one by one from the streaming endpoint as the API receives them;
+            memory stays flat no matter how many pages are followed.
+            With metrics, the time to open the stream is recorded as emails.stream
+        """
+        params = {"pages": min(pages, 10000), "page_size": page_size}
+        if query:
+            params["q"] = query
+        with self.__request("GET", "/emails/stream", "emails.stream", params=params, stream=True) as r:
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                record = loads(line)
+                # Emails are rows; the error and nextPageToken lines are objects
+                if isinstance(record, list):
+                    yield Email.from_row(record)
+                elif "error" in record:
+                    raise requests.HTTPError(record["error"], response=r)
+
+    def get_profile(self):
+        return self.__request("GET", "/profile", "profile").json()
+
+    def get_changes(self, since: str):
+        """
+            Emails added since history ID `since`, as Email records. The response carries the
+            history ID to resume from next time and fullSyncRequired when `since` has expired
+        """
+        changes = loads(self.__request("GET", "/emails/changes", "emails.changes", params={"since": since}).content)
+        changes["emails"] = [Email.from_row(row) for row in changes.get("emails", [])]
+        return changes
 
     def apply_label(self, msg_id: str, label_id: str):
-        return requests.post(
-            f"{self.api_base}/emails/{msg_id}/label",
-            headers=self.headers,
-            params={"label_id": label_id}
+        return self.__request(
+            "POST", f"/emails/{msg_id}/label", "emails.label", check=False, params={"label_id": label_id}
         )
 
+    def apply_labels_bulk(self, assignments: dict[str, list[str]]):
+        """
+            assignments maps label IDs to the message IDs that should receive them
+        """
+        return self.__request("POST", "/emails/labels:batch", "emails.labels_batch", json=assignments).json()
+
+    def apply_thread_labels_bulk(self, assignments: dict[str, list[str]]):
+        """
+            assignments maps label IDs to the thread IDs whose messages should all receive them
+        """
+        return self.__request("POST", "/threads/labels:batch", "threads.labels_batch", json=assignments).json()
+
     def create_label(self, name: str):
-        r = requests.post(
-            f"{self.api_base}/labels",
-            headers=self.headers,
-            params={"new_label_name": name}
-        )
-        r.raise_for_status()
+        r = self.__request("POST", "/labels", "labels.create", params={"new_label_name": name})
         return r.json().get("labelId")
+
+    def warm_up(self, model: str = "llama3.2:1b"):
+        """
+            Asks the API to load model on its ollama server ahead of the first job; returns
+            {"model", "status", "seconds"} without waiting for the load to finish
+        """
+        return self.__request("POST", "/models/warmup", "models.warmup", params={"model": model}).json()
+
+    def start_label_job(self, pages: int = 1, model: str = "llama3.2:1b", concurrency: int = 2, page_size: int = 100, by_thread: bool = False):
+        r = self.__request(
+            "POST",
+            "/jobs/label",
+            "jobs.start",
+            params={
+                "pages": pages,
+                "page_size": page_size,
+                "model": model,
+                "concurrency": concurrency,
+                "by_thread": by_thread
+            }
+        )
+        return r.json()
+
+    def list_jobs(self):
+        return self.__request("GET", "/jobs", "jobs.list").json().get("jobs", [])
+
+    def get_job(self, job_id: str):
+        return self.__request("GET", f"/jobs/{job_id}", "jobs.get").json()
+
+    def cancel_job(self, job_id: str):
+        return self.__request("DELETE", f"/jobs/{job_id}", "jobs.cancel").json()
@@ -0,0 +1,464 @@
+import queue
+import threading
+import time
+
+from email_agent import LabelIndex, LABEL_MATCH_THRESHOLD, ThreadLabeler, group_by_thread, representative
+
+# Marks the end of a stage's output on the queue between stages
+_DONE = object()
+
+class LabelBatcher:
+    def __init__(self, client, chunk_size: int = 100, on_flush=None, threads: bool = False):
+        """
+            Groups label applications by label ID and sends them through
+            GmailClient.apply_labels_bulk once chunk_size messages are pending.
+            With threads, the IDs added are thread IDs and go through
+            GmailClient.apply_thread_labels_bulk instead.
+            on_flush(assignments, response) is called after each successful bulk request
+        """
+        self.__client = client
+        self.__chunk_size = chunk_size
+        self.__on_flush = on_flush
+        self.__apply = client.apply_thread_labels_bulk if threads else client.apply_labels_bulk
+        self.__pending = {}
+        self.__count = 0
+
+    def add(self, msg_id: str, label_id: str):
+        self.__pending.setdefault(label_id, []).append(msg_id)
+        self.__count += 1
+        if self.__count >= self.__chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.__pending:
+            response = self.__apply(self.__pending)
+            if self.__on_flush is not None:
+                self.__on_flush(self.__pending, response)
+        self.__pending = {}
+        self.__count = 0
+
+
+class ThreadRoutes:
+    def __init__(self):
+        """
+            Thread-safe record of the threads a by_thread run has seen, so only one message per
+            thread reaches the classifiers: the thread's other messages wait here until it is
+            decided, and ones that arrive afterwards take the decision straight away
+        """
+        # Thread ID → messages waiting for its classification, or its (label name, label ID)
+        self.__routes = {}
+        self.__reused = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def reused(self):
+        return self.__reused
+
+    def __contains__(self, thread_id: str):
+        with self.__lock:
+            return thread_id in self.__routes
+
+    def join(self, thread_id: str, messages: list):
+        """
+            Adds messages of thread_id. Returns (decision, lead): the thread's (label name,
+            label ID) when it is decided, for all of messages; otherwise lead is the message
+            to classify when nobody is classifying the thread yet, and the rest wait for decide
+        """
+        with self.__lock:
+            state = self.__routes.get(thread_id)
+            if isinstance(state, tuple):
+                self.__reused += len(messages)
+                return state, None
+            if state is None:
+                lead = representative(messages)
+                self.__routes[thread_id] = [msg for msg in messages if msg is not lead]
+                return None, lead
+            state.extend(messages)
+            return None, None
+
+    def decide(self, thread_id: str, decision: tuple):
+        """
+            Records thread_id's (label name, label ID) and returns the messages that waited for it
+        """
+        with self.__lock:
+            waiting = self.__routes.get(thread_id)
+            self.__routes[thread_id] = decision
+            waiting = waiting if isinstance(waiting, list) else []
+            self.__reused += len(waiting)
+        return waiting
+
+
+class LabelRegistry:
+    def __init__(self, client, label_dict: dict[str, str], threshold: float = LABEL_MATCH_THRESHOLD, coordinator=None):
+        """
+            Thread-safe label catalogue. get_or_create reuses an existing label when the
+            generated name matches it (see email_agent.LabelIndex) and never creates
+            the same new label twice, even when several workers ask for it at once.
+            With a coordinator (a LabelRegistry shared by several processes), names this
+            registry does not know are resolved or created there instead of by client
+        """
+        self.__client = client
+        self.__index = LabelIndex(label_dict, threshold)
+        self.__lock = threading.Lock()
+        self.__coordinator = coordinator
+
+    def names(self):
+        return self.__index.names()
+
+    def ids(self):
+        return self.__index.ids()
+
+    def name_of(self, label_id: str):
+        return self.__index.name_of(label_id)
+
+    def get_or_create(self, name: str):
+        """
+            Returns (label name, label_id, created); the name is the existing label's
+            when the generated one matched it
+        """
+        existing = self.__index.resolve(name)
+        if existing is not None:
+            return existing, self.__index.get(existing), False
+        with self.__lock:
+            # Another worker may have created it while we waited for the lock
+            existing = self.__index.resolve(name)
+            if existing is not None:
+                return existing, self.__index.get(existing), False
+            if self.__coordinator is not None:
+                name, label_id, created = self.__coordinator.get_or_create(name)
+                self.__index.add(name, label_id)
+                return name, label_id, created
+            name = name.strip()
+            label_id = self.__client.create_label(name)
+            self.__index.add(name, label_id)
+            return name, label_id, True
+
+
+class LabelingPipeline:
+    def __init__(self, client, agent, pages: int = 1, workers: int = 2, queue_size: int = 32, apply_chunk_size: int = 100, checkpoint=None, store=None, page_size: int = 10, metrics=None, label_threshold: float = LABEL_MATCH_THRESHOLD, query: str = None, coordinator=None, by_thread: bool = False):
+        """
+            Fetch → classify → apply pipeline shared by the front-ends.
+            Emails are streamed from the GmailClient while `workers` classifier threads
+            call the Agent and the calling thread batches label writes. Queues between
+            stages hold at most queue_size items so a slow stage pushes back on the ones before it.
+            With a SyncCheckpoint, only emails added since the last successful run are fetched;
+            the first run, or one whose checkpoint has expired, falls back to a full scan.
+            With a MessageStore, emails decided in earlier runs are skipped (checked a model
+            batch at a time; their metadata is still fetched, since the API lists and fetches
+            together) and every applied decision is recorded.
+            With an email_agent.Metrics, classify batches and emails are counted and, when it
+            traces, every applied email gets a trace record.
+            label_threshold is how similar a generated label must be to an existing one to reuse it.
+            query limits a full scan to a Gmail search query (e.g. a date range shard), and
+            coordinator is handed to the LabelRegistry when several processes share labels.
+            With by_thread, each Gmail thread is classified once (agent is wrapped in an
+            email_agent.ThreadLabeler if it is not one): one of its messages goes to the
+            classifiers and the others wait for that decision (see ThreadRoutes). The thread is
+            labeled with a single thread modify, which also covers its messages that were not
+            listed; the API keeps a user label the thread already has instead of adding a
+            second one. A thread with a listed message that already has a user label, or with
+            a MessageStore one decided in an earlier run, keeps that label without being
+            classified
+        """
+        self.__client = client
+        self.__by_thread = by_thread
+        if by_thread and not isinstance(agent, ThreadLabeler):
+            agent = ThreadLabeler(agent, metrics)
+        self.__agent = agent
+        self.__pages = pages
+        self.__page_size = page_size
+        self.__checkpoint = checkpoint
+        self.__store = store
+        self.__metrics = metrics
+        self.__label_threshold = label_threshold
+        self.__query = query
+        self.__coordinator = coordinator
+        self.__workers = workers
+        self.__queue_size = queue_size
+        self.__apply_chunk_size = apply_chunk_size
+        self.__stop = threading.Event()
+        self.__cancelled = False
+        self.__errors = []
+
+    @property
+    def agent(self):
+        return self.__agent
+
+    def stop(self):
+        self.__cancelled = True
+        self.__stop.set()
+
+    def __put(self, q: queue.Queue, item):
+        # Blocks while the queue is full, but gives up once the pipeline is stopping
+        while not self.__stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __fail(self, e: Exception):
+        self.__errors.append(e)
+        self.__stop.set()
+
+    def __source(self):
+        """
+            Returns (emails to process, (account, history ID to checkpoint after the run))
+        """
+        if self.__checkpoint is None:
+            return self.__client.iter_emails(self.__pages, self.__page_size, self.__query), None
+
+        # Read the current history ID before listing so nothing that arrives mid-run is lost
+        profile = self.__client.get_profile()
+        account = profile["emailAddress"]
+        since = self.__checkpoint.get(account)
+        if since:
+            changes = self.__client.get_changes(since)
+            if not changes["fullSyncRequired"]:
+                return changes["emails"], (account, changes["historyId"])
+        return self.__client.iter_emails(self.__pages, self.__page_size, self.__query), (account, profile["historyId"])
+
+    def __pages_of(self, emails):
+        """
+            The emails in dispatch order, in lists checked against the store and grouped by
+            thread together: one model batch at a time with a store or by_thread, otherwise
+            one by one
+        """
+        size = self.__agent.batch_size if self.__store is not None or self.__by_thread else 1
+        page = []
+        for msg in emails:
+            page.append(msg)
+            if len(page) >= size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def __fetch(self, emails, registry: LabelRegistry, routes: ThreadRoutes, classify_q: queue.Queue, apply_q: queue.Queue):
+        try:
+            known_ids = registry.ids()
+            for page in self.__pages_of(emails):
+                decided = self.__store.decided_ids([msg.id for msg in page]) if self.__store is not None else ()
+                pending = []
+                for msg in page:
+                    # Skip if email already has a known label or was decided in an earlier run;
+                    # reported by the apply stage
+                    if msg.id in decided or any(lbl in known_ids for lbl in msg.labels):
+                        if not self.__put(apply_q, (msg, None, None, False, None)):
+                            return
+                        continue
+                    if not self.__by_thread:
+                        if not self.__put(classify_q, msg):
+                            return
+                        continue
+                    pending.append(msg)
+                if pending and not self.__route(page, pending, known_ids, registry, routes, classify_q, apply_q):
+                    return
+        except Exception as e:
+            self.__fail(e)
+        finally:
+            for _ in range(self.__workers):
+                self.__put(classify_q, _DONE)
+
+    def __route(self, page, pending, known_ids, registry: LabelRegistry, routes: ThreadRoutes, classify_q: queue.Queue, apply_q: queue.Queue):
+        # Labels threads already have: from a listed message with a user label, then from the store
+        thread_labels = {}
+        for msg in page:
+            label_id = next((lbl for lbl in msg.labels if lbl in known_ids), None)
+            if label_id is not None:
+                thread_labels.setdefault(msg.thread_id or msg.id, registry.name_of(label_id))
+        if self.__store is not None:
+            for thread_id, label in self.__store.thread_labels([msg.thread_id for msg in pending]).items():
+                thread_labels.setdefault(thread_id, label)
+
+        for thread_id, messages in group_by_thread(pending).items():
+            created = False
+            label = thread_labels.get(thread_id)
+            if label is not None and thread_id not in routes:
+                lbl, label_id, created = registry.get_or_create(label)
+                routes.decide(thread_id, (lbl, label_id))
+            decision, lead = routes.join(thread_id, messages)
+            if decision is not None:
+                lbl, label_id = decision
+                for msg in messages:
+                    if not self.__put(apply_q, (msg, lbl, label_id, created, 0.0)):
+                        return False
+                    created = False
+                if self.__metrics is not None:
+                    self.__metrics.inc("labels_total", len(messages), source="thread")
+            elif lead is not None and not self.__put(classify_q, lead):
+                return False
+        return True
+
+    def __classify(self, registry: LabelRegistry, routes: ThreadRoutes, classify_q: queue.Queue, apply_q: queue.Queue):
+        try:
+            done = False
+            while not done and not self.__stop.is_set():
+                try:
+                    msg = classify_q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if msg is _DONE:
+                    break
+                # Take whatever else is already queued, up to one model batch
+                batch = [msg]
+                while len(batch) < self.__agent.batch_size:
+                    try:
+                        msg = classify_q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if msg is _DONE:
+                        done = True
+                        break
+                    batch.append(msg)
+
+                started = time.perf_counter()
+                generated = self.__agent.generate_labels(batch, registry.names())
+                elapsed = time.perf_counter() - started
+                latency_ms = elapsed * 1000 / len(batch)
+                if self.__metrics is not None:
+                    self.__metrics.observe("stage_seconds", elapsed, stage="classify")
+                for msg in batch:
+                    lbl, label_id, created = registry.get_or_create(generated[msg.id])
+                    if not self.__put(apply_q, (msg, lbl, label_id, created, latency_ms)):
+                        return
+                    if not self.__by_thread:
+                        continue
+                    # The thread's messages that waited for this one
+                    waiting = routes.decide(msg.thread_id or msg.id, (lbl, label_id))
+                    for follower in waiting:
+                        if not self.__put(apply_q, (follower, lbl, label_id, False, 0.0)):
+                            return
+                    if self.__metrics is not None and waiting:
+                        self.__metrics.inc("labels_total", len(waiting), source="thread")
+        except Exception as e:
+            self.__fail(e)
+        finally:
+            self.__put(apply_q, _DONE)
+
+    def run(self, on_result=None, on_skip=None):
+        """
+            Runs the pipeline to completion. on_result(msg, label, created) and on_skip(msg)
+            are invoked from the calling thread. Returns counters for the run, including
+            first_label_seconds, the time from the start of the run to its first decided label
+            (None when nothing was labeled), which tracks cold-start cost, and by_thread,
+            threads (thread modifies sent), reused (emails that took their thread's decision
+            without being classified) and kept (threads that kept a user label they already had)
+        """
+        on_result = on_result or (lambda msg, lbl, created: None)
+        on_skip = on_skip or (lambda msg: None)
+        self.__stop.clear()
+        self.__cancelled = False
+        self.__errors = []
+        stats = {"labeled": 0, "skipped": 0, "created": 0, "threads": 0, "reused": 0, "kept": 0, "seconds": 0.0, "first_label_seconds": None}
+        started = time.perf_counter()
+
+        registry = LabelRegistry(self.__client, self.__client.get_labels(), self.__label_threshold, self.__coordinator)
+        emails, sync_point = self.__source()
+        classify_q = queue.Queue(maxsize=self.__queue_size)
+        apply_q = queue.Queue(maxsize=self.__queue_size)
+        routes = ThreadRoutes()
+        threads = [threading.Thread(target=self.__fetch, args=(emails, registry, routes, classify_q, apply_q), daemon=True)]
+        threads += [
+            threading.Thread(target=self.__classify, args=(registry, routes, classify_q, apply_q), daemon=True)
+            for _ in range(self.__workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Apply stage runs on the calling thread. Labels are applied per message ID or,
+        # by thread, once per thread ID; records holds the store rows waiting on each
+        records = {}
+        queued = set()
+
+        # Thread ID → user label the API kept for a thread instead of the decided one
+        kept = {}
+
+        def settle(key, record):
+            if key in kept:
+                record["label_id"] = kept[key]
+                record["applied_label"] = registry.name_of(kept[key]) or record["applied_label"]
+            return record
+
+        def record_applied(assignments, response):
+            if self.__by_thread and response:
+                kept.update(response.get("kept", {}))
+                stats["kept"] = len(kept)
+            # Decisions are only stored once Gmail has accepted them
+            if self.__store is not None:
+                self.__store.upsert_messages([
+                    settle(key, record) for keys in assignments.values() for key in keys for record in records.pop(key)
+                ])
+
+        batcher = LabelBatcher(self.__client, self.__apply_chunk_size, on_flush=record_applied, threads=self.__by_thread)
+        metrics = self.__metrics
+        tracing = metrics is not None and metrics.tracing
+        finished = 0
+        try:
+            while finished < self.__workers:
+                try:
+                    item = apply_q.get(timeout=0.1)
+                except queue.Empty:
+                    if self.__stop.is_set() and not any(t.is_alive() for t in threads[1:]):
+                        break
+                    continue
+                if item is _DONE:
+                    finished += 1
+                    continue
+                msg, lbl, label_id, created, latency_ms = item
+                if label_id is None:
+                    stats["skipped"] += 1
+                    if metrics is not None:
+                        metrics.inc("emails_total", outcome="skipped")
+                    on_skip(msg)
+                    continue
+                key = (msg.thread_id or msg.id) if self.__by_thread else msg.id
+                record = None
+                if self.__store is not None:
+                    record = self.__store.record(msg, lbl, label_id, self.__agent.model, latency_ms)
+                    if created:
+                        self.__store.upsert_labels({lbl: label_id})
+                if key not in queued:
+                    queued.add(key)
+                    records[key] = [record] if record is not None else []
+                    batcher.add(key, label_id)
+                elif key in records:
+                    # The thread's modify is still pending and will cover this message too
+                    if record is not None:
+                        records[key].append(record)
+                elif record is not None:
+                    # Already labeled through its thread
+                    self.__store.upsert_messages([settle(key, record)])
+                if stats["first_label_seconds"] is None:
+                    stats["first_label_seconds"] = time.perf_counter() - started
+                    if metrics is not None:
+                        metrics.observe("time_to_first_label_seconds", stats["first_label_seconds"])
+                stats["labeled"] += 1
+                stats["created"] += int(created)
+                if metrics is not None:
+                    metrics.inc("emails_total", outcome="labeled")
+                    if tracing:
+                        metrics.trace(id=msg.id, label=lbl, created=created, classify_ms=latency_ms)
+                on_result(msg, lbl, created)
+            batcher.flush()
+            if self.__by_thread:
+                stats["threads"] = len(queued)
+                stats["reused"] = routes.reused
+        except Exception as e:
+            self.__fail(e)
+        finally:
+            self.__stop.set()
+            for thread in threads:
+                thread.join()
+            # Sender rules learned since their last autosave
+            if self.__agent.rules is not None:
+                self.__agent.rules.flush()
+
+        stats["seconds"] = time.perf_counter() - started
+        if self.__errors:
+            raise self.__errors[0]
+        # Only a run that got through every email may move the checkpoint forward
+        if sync_point is not None and not self.__cancelled:
+            self.__checkpoint.set(*sync_point)
+        return stats
@@ -0,0 +1,161 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+from multiprocessing.managers import SyncManager
+from pathlib import Path
+
+from email_agent import Agent, LABEL_MATCH_THRESHOLD, SenderRules, write_atomic
+
+from .pipeline import LabelRegistry, LabelingPipeline
+from .store import MessageStore
+
+# Pages a shard may follow; the API caps a stream at the same number
+SHARD_MAX_PAGES = 10000
+
+def date_shards(since: date, months: int = 1, today: date = None):
+    """
+        Disjoint Gmail search queries that together cover the whole mailbox, newest first:
+        an open-ended "after:" shard for the current period, one "after:/before:" range per
+        `months` months back to since, and a "before:" shard for anything older.
+        Boundaries fall on the first of a month, so the queries (which key the checkpoint)
+        do not change from one day to the next
+    """
+    today = today or date.today()
+    start = date(since.year, since.month, 1)
+    boundaries = []
+    while start <= today:
+        boundaries.append(start)
+        month = start.month - 1 + months
+        start = date(start.year + month // 12, month % 12 + 1, 1)
+    shards = [f"after:{boundaries[-1]:%Y/%m/%d}"]
+    for older, newer in reversed(list(zip(boundaries, boundaries[1:]))):
+        shards.append(f"after:{older:%Y/%m/%d} before:{newer:%Y/%m/%d}")
+    shards.append(f"before:{boundaries[0]:%Y/%m/%d}")
+    return shards
+
+
+class ShardCheckpoint:
+    def __init__(self, path: str = "bulk_checkpoint.json"):
+        """
+            Counters of every finished shard keyed by its query, persisted as JSON at path.
+            Only the coordinating process writes it
+        """
+        self.__path = Path(path)
+        self.__done = json.loads(self.__path.read_text()) if self.__path.exists() else {}
+
+    def is_done(self, query: str):
+        return query in self.__done
+
+    def done(self, query: str, stats: dict):
+        self.__done[query] = stats
+        write_atomic(self.__path, json.dumps(self.__done, indent=2))
+
+
+def _label_registry(api_base: str, api_token: str, threshold: float):
+    from . import GmailClient
+    client = GmailClient(api_base, api_token)
+    return LabelRegistry(client, client.get_labels(), threshold)
+
+class _CoordinatorManager(SyncManager):
+    pass
+
+# Served from the manager's process, so every shard resolves and creates labels against one catalogue
+_CoordinatorManager.register("LabelRegistry", _label_registry)
+
+
+def _run_shard(query: str, options: dict, coordinator, rules_lock):
+    from . import GmailClient
+    client = GmailClient(options["api_base"], options["api_token"])
+    # Rules learned by this shard are merged into the shared file once it is done
+    rules = SenderRules(options["rules_path"], autosave=False)
+    agent = Agent(model=options["model"], rules=rules, batch_size=options["batch_size"])
+    store = MessageStore(options["store_path"])
+    try:
+        pipeline = LabelingPipeline(
+            client,
+            agent,
+            pages=SHARD_MAX_PAGES,
+            page_size=options["page_size"],
+            workers=options["workers"],
+            apply_chunk_size=options["apply_chunk_size"],
+            store=store,
+            label_threshold=options["label_threshold"],
+            query=query,
+            coordinator=coordinator,
+            by_thread=options["by_thread"]
+        )
+        stats = pipeline.run()
+        with rules_lock:
+            rules.save(merge=True)
+        return stats
+    finally:
+        store.close()
+        client.close()
+
+
+class ShardedLabeler:
+    def __init__(self, api_base: str, api_token: str, shards: list[str], checkpoint: ShardCheckpoint, processes: int = None, model: str = "llama3.2:1b", batch_size: int = 8, workers: int = 2, page_size: int = 100, apply_chunk_size: int = 100, rules_path: str = "sender_rules.json", store_path: str = "email_labeler.db", label_threshold: float = LABEL_MATCH_THRESHOLD, by_thread: bool = False):
+        """
+            Bulk backfill: every shard (a Gmail search query, see date_shards) runs its own
+            LabelingPipeline, Agent and GmailClient in one of `processes` worker processes.
+            New labels go through one coordinating LabelRegistry so two shards never create
+            the same label. Finished shards are recorded in checkpoint and skipped when the
+            backfill is run again; emails of an interrupted shard that the MessageStore
+            already holds are not classified again. An open-ended shard (no "before:") is
+            never recorded, since new mail keeps arriving in it.
+            by_thread is passed on to every shard's LabelingPipeline
+        """
+        self.__shards = shards
+        self.__checkpoint = checkpoint
+        self.__processes = processes or os.cpu_count() or 1
+        self.__options = {
+            "api_base": api_base,
+            "api_token": api_token,
+            "model": model,
+            "batch_size": batch_size,
+            "workers": workers,
+            "page_size": page_size,
+            "apply_chunk_size": apply_chunk_size,
+            "rules_path": rules_path,
+            "store_path": store_path,
+            "label_threshold": label_threshold,
+            "by_thread": by_thread,
+        }
+
+    def run(self, on_shard=None):
+        """
+            Runs every pending shard. on_shard(query, stats, error) is called in this process
+            as shards finish, with stats None and the exception for a failed one. Returns
+            totals and the queries of failed shards, which stay pending for the next run
+        """
+        on_shard = on_shard or (lambda query, stats, error: None)
+        totals = {"shards": 0, "labeled": 0, "skipped": 0, "created": 0, "threads": 0, "failed": []}
+        pending = [query for query in self.__shards if not self.__checkpoint.is_done(query)]
+        if not pending:
+            return totals
+
+        options = self.__options
+        with _CoordinatorManager() as manager:
+            coordinator = manager.LabelRegistry(options["api_base"], options["api_token"], options["label_threshold"])
+            rules_lock = manager.Lock()
+            with ProcessPoolExecutor(max_workers=min(self.__processes, len(pending))) as pool:
+                futures = {
+                    pool.submit(_run_shard, query, options, coordinator, rules_lock): query
+                    for query in pending
+                }
+                for future in as_completed(futures):
+                    query = futures[future]
+                    try:
+                        stats = future.result()
+                    except Exception as e:
+                        totals["failed"].append(query)
+                        on_shard(query, None, e)
+                        continue
+                    if "before:" in query:
+                        self.__checkpoint.done(query, stats)
+                    totals["shards"] += 1
+                    for key in ("labeled", "skipped", "created", "threads"):
+                        totals[key] += stats[key]
+                    on_shard(query, stats, None)
+        return totals
@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+import time
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+from email_agent import Email, SenderRules
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    thread_id TEXT,
+    sender_domain TEXT,
+    subject TEXT,
+    date TEXT,
+    applied_label TEXT,
+    label_id TEXT,
+    model TEXT,
+    latency_ms REAL,
+    decided_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_sender_domain ON messages (sender_domain);
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages (date);
+CREATE INDEX IF NOT EXISTS idx_messages_thread_id ON messages (thread_id);
+CREATE TABLE IF NOT EXISTS labels (
+    name TEXT PRIMARY KEY,
+    label_id TEXT NOT NULL
+);
+"""
+
+UPSERT_MESSAGE = """
+INSERT INTO messages (id, thread_id, sender_domain, subject, date, applied_label, label_id, model, latency_ms, decided_at)
+VALUES (:id, :thread_id, :sender_domain, :subject, :date, :applied_label, :label_id, :model, :latency_ms, :decided_at)
+ON CONFLICT (id) DO UPDATE SET
+    thread_id = excluded.thread_id,
+    sender_domain = excluded.sender_domain,
+    subject = excluded.subject,
+    date = excluded.date,
+    applied_label = excluded.applied_label,
+    label_id = excluded.label_id,
+    model = excluded.model,
+    latency_ms = excluded.latency_ms,
+    decided_at = excluded.decided_at
+"""
+
+UPSERT_LABEL = """
+INSERT INTO labels (name, label_id) VALUES (?, ?)
+ON CONFLICT (name) DO UPDATE SET label_id = excluded.label_id
+"""
+
+# SQLite limits the number of bound parameters per statement
+_MAX_PARAMS = 900
+
+class MessageStore:
+    def __init__(self, path: str = "email_labeler.db"):
+        """
+            Embedded SQLite store of processed messages and the labels decided for them.
+            Runs in WAL mode so readers never block the pipeline's bulk writes
+        """
+        self.__conn = sqlite3.connect(path, check_same_thread=False)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.execute("PRAGMA synchronous=NORMAL")
+        self.__conn.executescript(SCHEMA)
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def record(msg: Email, label: str, label_id: str, model: str = None, latency_ms: float = None):
+        """
+            Builds a messages row from an email record and the decision made for it.
+            Dates are stored in UTC, so they sort and compare as text whatever the sender's offset
+
+            >>> MessageStore.record(Email("m1", date="Mon, 3 Mar 2025 09:12:44 +0500"), "Bank", "L1")["date"]
+            '2025-03-03T04:12:44+00:00'
+        """
+        _, domain = SenderRules.parse_sender(msg.sender)
+        try:
+            date = parsedate_to_datetime(msg.date)
+            # "-0000" means no known zone and parses naive; it is UTC per RFC 5322
+            if date.tzinfo is None:
+                date = date.replace(tzinfo=timezone.utc)
+            date = date.astimezone(timezone.utc).isoformat()
+        except (TypeError, ValueError):
+            date = None
+        return {
+            "id": msg.id,
+            "thread_id": msg.thread_id,
+            "sender_domain": domain,
+            "subject": msg.subject,
+            "date": date,
+            "applied_label": label,
+            "label_id": label_id,
+            "model": model,
+            "latency_ms": latency_ms,
+            "decided_at": time.time()
+        }
+
+    def upsert_messages(self, records: list[dict]):
+        with self.__lock, self.__conn:
+            self.__conn.executemany(UPSERT_MESSAGE, records)
+
+    def upsert_labels(self, label_dict: dict[str, str]):
+        with self.__lock, self.__conn:
+            self.__conn.executemany(UPSERT_LABEL, label_dict.items())
+
+    def decided_ids(self, msg_ids: list[str]):
+        """
+            The IDs among msg_ids that already have a decided label
+        """
+        decided = set()
+        with self.__lock:
+            for i in range(0, len(msg_ids), _MAX_PARAMS):
+                chunk = msg_ids[i:i + _MAX_PARAMS]
+                rows = self.__conn.execute(
+                    f"SELECT id FROM messages WHERE applied_label IS NOT NULL AND id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                decided.update(row[0] for row in rows)
+        return decided
+
+    def thread_labels(self, thread_ids: list[str]):
+        """
+            {thread ID: label most recently decided for one of its messages}, for the
+            thread_ids that have one
+        """
+        thread_ids = [thread_id for thread_id in thread_ids if thread_id]
+        labels = {}
+        with self.__lock:
+            for i in range(0, len(thread_ids), _MAX_PARAMS):
+                chunk = thread_ids[i:i + _MAX_PARAMS]
+                rows = self.__conn.execute(
+                    "SELECT thread_id, applied_label FROM messages WHERE applied_label IS NOT NULL "
+                    f"AND thread_id IN ({','.join('?' * len(chunk))}) ORDER BY decided_at",
+                    chunk
+                )
+                # Later decisions overwrite earlier ones
+                labels.update(rows)
+        return labels
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
@@ -0,0 +1,26 @@
+import json
+from pathlib import Path
+
+from email_agent import write_atomic
+
+class SyncCheckpoint:
+    def __init__(self, path: str = "sync_checkpoint.json"):
+        """
+            Last processed Gmail history ID per account, persisted as JSON at path
+        """
+        self.__path = Path(path)
+        self.__history_ids = json.loads(self.__path.read_text()) if self.__path.exists() else {}
+
+    def get(self, account: str):
+        return self.__history_ids.get(account)
+
+    def set(self, account: str, history_id: str):
+        self.__history_ids[account] = history_id
+        self.__save()
+
+    def clear(self, account: str):
+        if self.__history_ids.pop(account, None) is not None:
+            self.__save()
+
+    def __save(self):
+        write_atomic(self.__path, json.dumps(self.__history_ids, indent=2))